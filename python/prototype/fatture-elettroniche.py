@@ -1,10 +1,26 @@
 import requests
-import xml.etree.ElementTree as ET
+import io
+import os
+import sys
 from zeep import Client
 from datetime import datetime
 import base64
 import json
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from xml_invoice_amounts import to_decimal
+from xml_invoice_fields import FieldSpec, extract_record
+
+# Campi estratti da parse_fattura, in un solo passaggio sul documento
+_DOCUMENTO = ('FatturaElettronicaBody', 'DatiGenerali', 'DatiGeneraliDocumento')
+SDI_FIELDS = (
+    FieldSpec('numero', _DOCUMENTO + ('Numero',), required=True),
+    FieldSpec('data', _DOCUMENTO + ('Data',), required=True),
+    FieldSpec('importo_totale', _DOCUMENTO + ('ImportoTotaleDocumento',), 'amount'),
+    FieldSpec('partita_iva', ('FatturaElettronicaHeader', 'CedentePrestatore', 'DatiAnagrafici',
+                              'IdFiscaleIVA', 'IdCodice'), required=True),
+)
+
 class SDIClient:
     def __init__(self, certificato_path, password, ambiente="test"):
         self.certificato_path = certificato_path
@@ -76,18 +92,14 @@ class SDIClient:
             dict: Dati principali della fattura
         """
         try:
-            root = ET.fromstring(xml_content)
-            
-            # Namespace della fattura elettronica
-            ns = {'p': 'http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2'}
-            
-            # Estrai informazioni base
-            dati = {
-                'numero': root.find('.//p:NumeroFattura', ns).text,
-                'data': root.find('.//p:Data', ns).text,
-                'importo_totale': float(root.find('.//p:ImportoTotaleDocumento', ns).text),
-                'partita_iva': root.find('.//p:IdCodice', ns).text
-            }
+            # Un solo passaggio streaming, invece di una ricerca './/' per campo
+            dati = extract_record(io.BytesIO(xml_content.encode('utf-8')), SDI_FIELDS)
+            if dati is None:
+                raise ValueError("FatturaElettronicaBody not found")
+            # Gli importi sono estratti come interi (centesimi): riportali a Decimal
+            for spec in SDI_FIELDS:
+                if spec.type == 'amount' and dati[spec.name] is not None:
+                    dati[spec.name] = to_decimal(dati[spec.name], spec.scale)
             
             return dati
             
@@ -114,4 +126,4 @@ if __name__ == "__main__":
     # Processa le fatture
     for fattura_xml in fatture:
         dati_fattura = client.parse_fattura(fattura_xml)
-        print(json.dumps(dati_fattura, indent=2))
+        print(json.dumps(dati_fattura, indent=2, default=str))
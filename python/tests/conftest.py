@@ -0,0 +1,41 @@
+import os
+import sys
+
+import pytest
+
+# The modules live flat in python/, next to this folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from xml_invoice_generator import GeneratorOptions, generate_corpus
+
+@pytest.fixture(scope='session')
+def corpus(tmp_path_factory) -> str:
+    """A small synthetic corpus: 40 invoices of 5 suppliers, some lotti and installments."""
+    folder = str(tmp_path_factory.mktemp('corpus'))
+    generate_corpus(folder, 40, GeneratorOptions(suppliers=5, installment_ratio=0.5, seed=1))
+    return folder
+
+@pytest.fixture(scope='session')
+def sign():
+    """sign(content, detached=False) -> a DER CMS SignedData over content, with a throwaway key."""
+    pytest.importorskip('cryptography')
+    import datetime
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.hazmat.primitives.serialization import pkcs7
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'Cedente di prova')])
+    certificate = (x509.CertificateBuilder().subject_name(name).issuer_name(name)
+                   .public_key(key.public_key()).serial_number(1)
+                   .not_valid_before(datetime.datetime(2020, 1, 1))
+                   .not_valid_after(datetime.datetime(2040, 1, 1))
+                   .sign(key, hashes.SHA256()))
+
+    def sign(content: bytes, detached: bool = False) -> bytes:
+        options = [pkcs7.PKCS7Options.DetachedSignature] if detached else []
+        return (pkcs7.PKCS7SignatureBuilder().set_data(content).add_signer(certificate, key, hashes.SHA256())
+                .sign(serialization.Encoding.DER, options))
+    return sign
@@ -0,0 +1,18 @@
+import datetime
+import shutil
+
+from xml_invoice_aggregates import AggregateStore
+from xml_invoice_processor import aggregate_by_cedente, process_folder
+
+START, END = datetime.date(2023, 1, 1), datetime.date(2024, 12, 31)
+
+def test_same_folder_named_differently(corpus, tmp_path, monkeypatch):
+    folder = tmp_path / 'in'
+    shutil.copytree(corpus, folder)
+    monkeypatch.chdir(tmp_path)
+    with AggregateStore(str(tmp_path / 'a.sqlite')) as store:
+        assert store.refresh('in').added == 40
+        for name in ('./in', str(folder), 'in/'):
+            summary = store.refresh(name)
+            assert (summary.added, summary.changed, summary.removed) == (0, 0, 0)
+        assert store.totals(START, END) == aggregate_by_cedente(process_folder(corpus, START, END))
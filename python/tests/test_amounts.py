@@ -0,0 +1,48 @@
+import datetime
+import random
+import re
+from decimal import ROUND_HALF_UP, Decimal
+
+import pytest
+
+from xml_invoice_amounts import amount_kind, amount_scale, format_amount, parse_amount, to_decimal
+from xml_invoice_processor import aggregate_by_cedente, iter_xml_files, process_folder
+
+@pytest.mark.parametrize('text, scale, units', [
+    ('6.10', 2, 610), ('-0.05', 2, -5), ('+12', 2, 1200), ('.5', 2, 50), ('7.', 2, 700),
+    (' 1.005\n', 2, 101), ('-1.005', 2, -101), ('1.00499', 2, 100), ('0.123456789', 8, 12345679),
+    ('99999999999.99', 2, 9999999999999), ('2.5', 0, 3),
+])
+def test_parse_amount(text, scale, units):
+    assert parse_amount(text, scale) == units
+
+@pytest.mark.parametrize('text', ['', '.', '-', '1,00', '1e3', '1.2.3', 'abc'])
+def test_invalid_amount(text):
+    with pytest.raises(ValueError, match='Invalid amount'):
+        parse_amount(text)
+
+def test_matches_decimal_rounding():
+    rnd = random.Random(5)
+    for _ in range(2000):
+        text = f"{rnd.choice(['', '-'])}{rnd.randrange(10 ** 9)}.{rnd.randrange(10 ** 6):06d}"
+        scale = rnd.randrange(6)
+        expected = Decimal(text).quantize(Decimal(1).scaleb(-scale), rounding=ROUND_HALF_UP)
+        assert to_decimal(parse_amount(text, scale), scale) == expected
+        assert format_amount(parse_amount(text, scale), scale) == str(expected)
+
+def test_kinds():
+    assert amount_kind() == 'amount' and amount_scale('amount') == 2
+    assert amount_scale(amount_kind(8)) == 8
+    assert amount_scale('str') is None
+
+def test_totals_are_exact(corpus):
+    fatture = process_folder(corpus, datetime.date.min, datetime.date.max)
+    expected = Decimal(0)
+    for path in iter_xml_files(corpus):
+        with open(path, encoding='utf-8') as f:
+            xml = f.read()
+        # The ImportoPagamento of the first DettaglioPagamento of every body
+        for body in xml.split('<FatturaElettronicaBody>')[1:]:
+            expected += Decimal(re.search(r'<ImportoPagamento>([^<]*)<', body).group(1))
+    assert to_decimal(sum(t.totale_pagamenti for t in aggregate_by_cedente(fatture))) == expected
+    assert all(isinstance(f.importo_pagamento, int) for f in fatture)
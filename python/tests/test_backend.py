@@ -0,0 +1,46 @@
+import datetime
+import xml.etree.ElementTree as ET
+
+import pytest
+
+pytest.importorskip('lxml')
+
+from xml_invoice_backend import get_backend, set_default_backend
+from xml_invoice_processor import iter_xml_files, parse_files, process_folder, process_xml_file_tree
+
+START, END = datetime.date.min, datetime.date.max
+
+@pytest.fixture
+def backend(request):
+    set_default_backend(request.param)
+    yield request.param
+    set_default_backend('auto')
+
+@pytest.mark.parametrize('backend', ['lxml'], indirect=True)
+def test_lxml_matches_etree(corpus, backend):
+    results = process_folder(corpus, START, END, workers=2)
+    trees = [process_xml_file_tree(path) for path in iter_xml_files(corpus)]
+    set_default_backend('etree')
+    assert results == process_folder(corpus, START, END)
+    assert trees == [process_xml_file_tree(path) for path in iter_xml_files(corpus)]
+
+@pytest.mark.parametrize('backend', ['lxml', 'etree'], indirect=True)
+def test_syntax_errors_are_parse_errors(tmp_path, backend):
+    bad = tmp_path / 'bad.xml'
+    bad.write_text('<FatturaElettronica><FatturaElettronicaHeader>', encoding='utf-8')
+    [(_, values, error)] = parse_files([str(bad)])
+    assert values is None and error
+    with pytest.raises(ET.ParseError):
+        process_xml_file_tree(str(bad))
+
+def test_entities_are_not_resolved(tmp_path):
+    secret = tmp_path / 'secret.txt'
+    secret.write_text('riservato', encoding='utf-8')
+    xxe = tmp_path / 'xxe.xml'
+    xxe.write_text(f'<!DOCTYPE a [<!ENTITY x SYSTEM "file://{secret}">]><a>&x;</a>', encoding='utf-8')
+    root = get_backend('lxml').parse(str(xxe))
+    assert 'riservato' not in ''.join(root.itertext())
+
+def test_unknown_backend():
+    with pytest.raises(ValueError, match='Unknown parser backend'):
+        set_default_backend('sax')
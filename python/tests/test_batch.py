@@ -0,0 +1,32 @@
+import dataclasses
+import datetime
+
+import pytest
+
+pytest.importorskip('numpy')
+
+from xml_invoice_batch import FatturaBatch, process_folder_batch
+from xml_invoice_processor import aggregate_by_cedente, process_folder
+
+START, END = datetime.date(2023, 1, 1), datetime.date(2024, 12, 31)
+
+def _columns(fattura):
+    # The batch keeps the eight detail columns only
+    return dataclasses.astuple(fattura)[:8]
+
+def test_matches_process_folder(corpus):
+    fatture = process_folder(corpus, START, END)
+    batch = process_folder_batch(corpus, START, END)
+    assert len(batch) == len(fatture)
+    assert [_columns(f) for f in batch.iter_fatture()] == [_columns(f) for f in fatture]
+    assert batch.aggregate_by_cedente() == aggregate_by_cedente(fatture)
+
+def test_filter_dates(corpus):
+    fatture = process_folder(corpus, START, END)
+    start, end = datetime.date(2023, 6, 1), datetime.date(2023, 12, 31)
+    batch = FatturaBatch.from_fatture(fatture).filter_dates(start, end)
+    in_range = [f for f in fatture if start <= f.data <= end]
+    assert [_columns(f) for f in batch.iter_fatture()] == [_columns(f) for f in in_range]
+    # Cedenti keep the order they were first seen in the whole batch
+    key = lambda t: t.cedente_id_fiscale
+    assert sorted(batch.aggregate_by_cedente(), key=key) == sorted(aggregate_by_cedente(in_range), key=key)
@@ -0,0 +1,59 @@
+import datetime
+import json
+import os
+import shutil
+
+from xml_invoice_cache import ParseCache, file_digest
+from xml_invoice_metrics import RunMetrics
+from xml_invoice_processor import iter_folder_records, iter_xml_files, parse_files
+
+START, END = datetime.date.min, datetime.date.max
+
+def _records(folder, cache, workers=1, metrics=None):
+    # Cache hits come back as lists where tuples were: compare as JSON
+    return json.loads(json.dumps(list(iter_folder_records(str(folder), START, END, workers=workers,
+                                                          cache=cache, metrics=metrics))))
+
+def test_cached_run_matches(corpus, tmp_path):
+    expected = _records(corpus, None)
+    with ParseCache(str(tmp_path / 'c.sqlite'), '6') as cache:
+        assert _records(corpus, cache, workers=2) == expected
+        assert (cache.hits, cache.misses) == (0, 40)
+    with ParseCache(str(tmp_path / 'c.sqlite'), '6') as cache:
+        assert _records(corpus, cache) == expected
+        assert (cache.hits, cache.misses) == (40, 0)
+
+def test_workers_compute_the_digest(corpus):
+    paths = list(iter_xml_files(corpus))[:3]
+    for path, _, _, digest, _ in parse_files(paths, digests=True):
+        assert digest == file_digest(path)
+
+def test_versions_are_kept_apart(corpus, tmp_path):
+    db = str(tmp_path / 'c.sqlite')
+    for version in ('6', '6+abc', '6'):
+        with ParseCache(db, version) as cache:
+            _records(corpus, cache)
+    with ParseCache(db, '6+abc') as cache:
+        _records(corpus, cache)
+        assert cache.hits == 40
+
+def test_moved_file_found_by_digest(corpus, tmp_path):
+    folder = tmp_path / 'in'
+    shutil.copytree(corpus, folder)
+    with ParseCache(str(tmp_path / 'c.sqlite')) as cache:
+        _records(folder, cache)
+    os.rename(folder / '0000', folder / 'moved')
+    with ParseCache(str(tmp_path / 'c.sqlite')) as cache:
+        _records(folder, cache)
+        assert (cache.hits, cache.misses) == (40, 0)
+
+def test_cached_errors_keep_their_type(corpus, tmp_path):
+    folder = tmp_path / 'in'
+    shutil.copytree(corpus, folder)
+    (folder / 'bad.xml').write_text('<FatturaElettronica>', encoding='utf-8')
+    for expected_hits in (0, 41):
+        metrics = RunMetrics()
+        with ParseCache(str(tmp_path / 'c.sqlite')) as cache:
+            _records(folder, cache, metrics=metrics)
+            assert cache.hits == expected_hits
+        assert metrics.errors == {'ParseError': 1}
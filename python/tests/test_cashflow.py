@@ -0,0 +1,98 @@
+import csv
+import datetime
+import re
+
+import pytest
+
+pytest.importorskip('numpy')
+
+from xml_invoice_cashflow import ScheduleBuilder, ageing_columns, cashflow_tables
+from xml_invoice_processor import Fattura, Rata, iter_fatture_from_file, iter_xml_files, main, process_folder
+
+START, END = datetime.date(2023, 1, 1), datetime.date(2024, 12, 31)
+
+def _fattura(id_fiscale, rate):
+    data = datetime.date(2024, 1, 1)
+    return Fattura(id_fiscale, f'{id_fiscale} SRL', 'RF01', 'EUR', data, '1', data, 0,
+                   rate=[Rata(datetime.date.fromisoformat(scadenza), importo, 'TP01')
+                         for scadenza, importo in rate])
+
+def test_installments_add_up_to_the_document(corpus):
+    fatture = process_folder(corpus, START, END)
+    assert any(len(f.rate) > 1 for f in fatture)
+    for fattura in fatture:
+        documento = sum(r.imponibile + r.imposta for r in fattura.riepilogo_iva)
+        assert sum(rata.importo for rata in fattura.rate) == documento
+        assert (fattura.rate[0].data_scadenza, fattura.rate[0].importo) == (
+            fattura.data_scadenza_pagamento, fattura.importo_pagamento)
+
+def test_relative_terms(corpus, tmp_path):
+    for path in iter_xml_files(corpus):
+        with open(path, encoding='utf-8') as f:
+            xml = f.read()
+        if xml.count('<FatturaElettronicaBody') == 1 and xml.count('<DataScadenzaPagamento') >= 3:
+            break
+    # The first installment keeps its date (data_scadenza_pagamento), the next two get
+    # terms, the others no date at all
+    first = xml.index('<DataScadenzaPagamento>')
+    terms = iter(['<GiorniTerminiPagamento>30</GiorniTerminiPagamento>',
+                  '<DataRiferimentoTerminiPagamento>2024-02-10</DataRiferimentoTerminiPagamento>'
+                  '<GiorniTerminiPagamento>5</GiorniTerminiPagamento>'])
+    xml = re.sub(r'<DataScadenzaPagamento>[^<]*</DataScadenzaPagamento>',
+                 lambda m: next(terms, '') if m.start() > first else m.group(0), xml)
+    (tmp_path / 'a.xml').write_text(xml, encoding='utf-8')
+    fattura = next(iter_fatture_from_file(str(tmp_path / 'a.xml')))
+    assert [rata.data_scadenza for rata in fattura.rate] == (
+        [fattura.data_scadenza_pagamento, fattura.data + datetime.timedelta(days=30),
+         datetime.date(2024, 2, 15)] + [fattura.data] * (len(fattura.rate) - 3))
+
+@pytest.fixture
+def index():
+    builder = ScheduleBuilder()
+    fatture = [_fattura('A', [('2024-01-31', 100), ('2024-02-01', 200), ('2024-04-15', 400)]),
+               _fattura('B', [('2023-10-01', 1000), ('2024-02-29', 50)])]
+    assert list(builder.collect(fatture)) == fatture
+    assert len(builder) == 5
+    return builder.build()
+
+def test_cash_flow_by_month(index):
+    [flussi, _] = cashflow_tables(index, 'month', datetime.date(2024, 3, 1))
+    d = datetime.date
+    assert flussi[3] == [
+        (d(2023, 10, 1), d(2023, 10, 31), 1, 1000, 1000),
+        (d(2024, 1, 1), d(2024, 1, 31), 1, 100, 1100),
+        (d(2024, 2, 1), d(2024, 2, 29), 2, 250, 1350),
+        (d(2024, 4, 1), d(2024, 4, 30), 1, 400, 1750),
+    ]
+
+def test_cash_flow_by_week(index):
+    weeks = index.cash_flow('week')
+    assert all(p.inizio.weekday() == 0 and (p.fine - p.inizio).days == 6 for p in weeks)
+    assert [(p.inizio, p.rate, p.importo) for p in weeks][1] == (datetime.date(2024, 1, 29), 2, 300)
+    assert weeks[-1].cumulato == 1750
+    assert index.due_between(datetime.date(2024, 1, 31), datetime.date(2024, 2, 29)) == (3, 350)
+
+def test_ageing(index):
+    [_, scaduto] = cashflow_tables(index, 'month', datetime.date(2024, 3, 1))
+    assert [name for name, _ in scaduto[2]] == [name for name, _ in ageing_columns()]
+    # 30 days overdue is still in the first bucket, one day more moves to the next
+    assert scaduto[3] == [('A', 'A SRL', 400, 300, 0, 0, 0, 300),
+                          ('B', 'B SRL', 0, 50, 0, 0, 1000, 1050)]
+    [a, _] = index.ageing(datetime.date(2024, 3, 2))
+    assert (a.non_scaduto, a.scaduto) == (400, [200, 100, 0, 0])
+
+def _csv(path):
+    with open(path, newline='', encoding='utf-8') as f:
+        return list(csv.DictReader(f))
+
+def test_companion_files(corpus, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    main(corpus, START.isoformat(), END.isoformat(), use_cache=False, use_index=False,
+         output_file=str(tmp_path / 'out.csv'), cashflow='month', as_of_str='2024-01-01')
+    fatture = process_folder(corpus, START, END)
+    rate = _csv(tmp_path / 'out-rate.csv')
+    assert len(rate) == sum(len(f.rate) for f in fatture)
+    flussi = _csv(tmp_path / 'out-flussi.csv')
+    assert sum(int(row['rate']) for row in flussi) == len(rate)
+    assert flussi[-1]['cumulato'] == f"{sum(r.importo for f in fatture for r in f.rate) / 100:.2f}"
+    assert len(_csv(tmp_path / 'out-scaduto.csv')) == len({f.cedente_id_fiscale for f in fatture})
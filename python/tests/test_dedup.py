@@ -0,0 +1,89 @@
+import csv
+import datetime
+import os
+import re
+import shutil
+
+import pytest
+
+from xml_invoice_dedup import DuplicateIndex
+from xml_invoice_lines import export_lines
+from xml_invoice_processor import iter_folder_records, iter_xml_files
+
+def _run(folder, index_file, policy='first-wins'):
+    """(file name, numero) of every invoice kept, and the duplicate report rows."""
+    with DuplicateIndex(str(index_file), policy) as index:
+        kept = [(os.path.basename(path), v[5])
+                for path, values in iter_folder_records(str(folder), datetime.date.min, datetime.date.max,
+                                                        dedup=index)
+                for v in values]
+        return kept, list(index.report_rows())
+
+def _set_numero(path, numero):
+    with open(path, encoding='utf-8') as f:
+        xml = f.read()
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(re.sub(r'<Numero>[^<]*</Numero>', f'<Numero>{numero}</Numero>', xml, count=1))
+    # Make sure the stat changes even on coarse mtime clocks
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+
+@pytest.fixture
+def single(corpus, tmp_path):
+    """A folder holding one single-body invoice of the corpus, as A.xml."""
+    folder = tmp_path / 'in'
+    folder.mkdir()
+    for path in iter_xml_files(corpus):
+        with open(path, encoding='utf-8') as f:
+            if f.read().count('<FatturaElettronicaBody') == 1:
+                shutil.copy(path, folder / 'A.xml')
+                return folder
+
+@pytest.mark.parametrize('policy', ['first-wins', 'newest-wins'])
+def test_copies_are_dropped(single, tmp_path, policy):
+    shutil.copy(single / 'A.xml', single / 'B.xml')
+    kept, report = _run(single, tmp_path / 'i.sqlite', policy)
+    assert len(kept) == 1
+    assert [row[-1] for row in report] == ['scartata']
+    # A second run over the same files keeps the same invoice
+    assert _run(single, tmp_path / 'i.sqlite', policy)[0] == kept
+
+def test_report_only_keeps_both(single, tmp_path):
+    shutil.copy(single / 'A.xml', single / 'B.xml')
+    kept, report = _run(single, tmp_path / 'i.sqlite', 'report-only')
+    assert [name for name, _ in kept] == ['A.xml', 'B.xml']
+    assert [row[-1] for row in report] == ['segnalata']
+
+@pytest.mark.parametrize('owner', ['A.xml', 'Z.xml'])
+def test_edited_file_releases_its_keys(single, tmp_path, owner):
+    # The owner walked before or after the new copy
+    os.rename(single / 'A.xml', single / owner)
+    [(_, numero)], _ = _run(single, tmp_path / 'i.sqlite')
+    shutil.copy(single / owner, single / 'B.xml')
+    _set_numero(single / owner, '999')
+    kept, report = _run(single, tmp_path / 'i.sqlite')
+    assert sorted(kept) == sorted([(owner, '999'), ('B.xml', numero)])
+    assert report == []
+
+def test_removed_owner_releases_its_keys(single, tmp_path):
+    _run(single, tmp_path / 'i.sqlite')
+    shutil.move(single / 'A.xml', single / 'B.xml')
+    kept, report = _run(single, tmp_path / 'i.sqlite')
+    assert [name for name, _ in kept] == ['B.xml']
+    assert report == []
+
+def _line_keys(lines_file):
+    with open(lines_file, newline='', encoding='utf-8') as f:
+        return [(row['cedente_id_fiscale'], row['data'], row['numero']) for row in csv.DictReader(f)]
+
+def test_only_the_invoices_kept_by_dedup(corpus, tmp_path):
+    folder = tmp_path / 'in'
+    shutil.copytree(corpus, folder / 'a')
+    shutil.copytree(corpus, folder / 'b')
+    with DuplicateIndex(str(tmp_path / 'd.sqlite'), 'first-wins') as index:
+        index.kept = set()
+        for _ in iter_folder_records(str(folder), datetime.date.min, datetime.date.max, dedup=index):
+            pass
+    export_lines(iter_xml_files(corpus), str(tmp_path / 'once.csv'))
+    export_lines(iter_xml_files(str(folder)), str(tmp_path / 'kept.csv'), invoices=index.kept)
+    assert _line_keys(tmp_path / 'kept.csv') == _line_keys(tmp_path / 'once.csv')
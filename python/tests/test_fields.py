@@ -0,0 +1,79 @@
+import datetime
+import io
+import json
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from xml_invoice_cache import ParseCache
+from xml_invoice_fields import KNOWN_FIELDS, FieldSpec, extract_records, load_fields
+from xml_invoice_processor import check_fields, extractor_version, iter_xml_files, process_folder
+
+START, END = datetime.date.min, datetime.date.max
+
+XML = b"""<FatturaElettronica>
+<FatturaElettronicaHeader><DatiTrasmissione><CodiceDestinatario>ABC1234</CodiceDestinatario></DatiTrasmissione></FatturaElettronicaHeader>
+<FatturaElettronicaBody>
+  <DatiGenerali><DatiGeneraliDocumento><Causale>uno</Causale><Causale>due</Causale>
+    <ImportoTotaleDocumento>10.005</ImportoTotaleDocumento></DatiGeneraliDocumento></DatiGenerali>
+  <DatiBeniServizi><DatiRiepilogo><Imposta>1.10</Imposta></DatiRiepilogo>
+    <DatiRiepilogo><Imposta>2.20</Imposta></DatiRiepilogo></DatiBeniServizi>
+</FatturaElettronicaBody>
+<FatturaElettronicaBody>
+  <DatiGenerali><DatiGeneraliDocumento><Causale>tre</Causale></DatiGeneraliDocumento></DatiGenerali>
+</FatturaElettronicaBody>
+</FatturaElettronica>"""
+
+def test_values_per_body():
+    fields = [KNOWN_FIELDS[name] for name in
+              ('codice_destinatario', 'causale', 'importo_totale_documento', 'imposta')]
+    fields.append(FieldSpec('totale_mills', KNOWN_FIELDS['importo_totale_documento'].path, 'amount', scale=3))
+    records = list(extract_records(io.BytesIO(XML), fields))
+    assert records == [
+        # Header fields repeat on every body; amounts are exact integer units
+        {'codice_destinatario': 'ABC1234', 'causale': 'uno; due', 'importo_totale_documento': 1001,
+         'imposta': 330, 'totale_mills': 10005},
+        {'codice_destinatario': 'ABC1234', 'causale': 'tre', 'importo_totale_documento': None,
+         'imposta': None, 'totale_mills': None},
+    ]
+
+def test_required_field_missing():
+    with pytest.raises(ValueError, match='ImportoTotaleDocumento not found'):
+        list(extract_records(io.BytesIO(XML), [FieldSpec('t', KNOWN_FIELDS['importo_totale_documento'].path,
+                                                         required=True)]))
+
+def test_matches_element_find(corpus):
+    fields = [spec for spec in KNOWN_FIELDS.values() if spec.cardinality == 'one' and spec.type == 'str']
+    for path in iter_xml_files(corpus):
+        root = ET.parse(path).getroot()
+        bodies = root.findall('FatturaElettronicaBody')
+        with open(path, 'rb') as f:
+            records = list(extract_records(f, fields))
+        assert len(records) == len(bodies)
+        for body, record in zip(bodies, records):
+            for spec in fields:
+                scope, rest = (body, spec.path[1:]) if spec.path[0] == 'FatturaElettronicaBody' else (root, spec.path)
+                assert record[spec.name] == scope.findtext('/'.join(rest))
+
+def test_config(tmp_path):
+    config = tmp_path / 'fields.json'
+    config.write_text(json.dumps({'fields': ['causale', {'name': 'riferimento', 'path': 'A/B', 'type': 'int'}]}))
+    assert [spec.name for spec in load_fields(str(config))] == ['causale', 'riferimento']
+    for entry, message in [('nessuno', 'Unknown field'), ({'name': 'x'}, 'name and a path'),
+                           ({'name': 'x', 'path': 'A', 'type': 'float'}, 'type'),
+                           ({'name': 'x', 'path': 'A', 'colore': 1}, 'Unknown field settings')]:
+        config.write_text(json.dumps({'fields': [entry]}))
+        with pytest.raises(ValueError, match=message):
+            load_fields(str(config))
+    with pytest.raises(ValueError, match='numero'):
+        check_fields([FieldSpec('numero', ('A',))])
+
+def test_extra_fields_survive_the_cache(corpus, tmp_path):
+    fields = [KNOWN_FIELDS['importo_totale_documento'], KNOWN_FIELDS['causale'],
+              FieldSpec('data_documento', KNOWN_FIELDS['tipo_documento'].path[:-1] + ('Data',), 'date')]
+    expected = process_folder(corpus, START, END, fields=fields)
+    assert all(isinstance(f.extra['data_documento'], datetime.date) for f in expected)
+    for _ in range(2):
+        with ParseCache(str(tmp_path / 'c.sqlite'), extractor_version(fields)) as cache:
+            assert process_folder(corpus, START, END, cache=cache, fields=fields) == expected
+    assert cache.hits == 40
@@ -0,0 +1,19 @@
+import csv
+
+from xml_invoice_lines import export_lines
+from xml_invoice_processor import iter_xml_files
+
+def _keys(lines_file):
+    with open(lines_file, newline='', encoding='utf-8') as f:
+        return [(row['cedente_id_fiscale'], row['data'], row['numero']) for row in csv.DictReader(f)]
+
+def test_lines_of_every_invoice(corpus, tmp_path):
+    lines, files, errors = export_lines(iter_xml_files(corpus), str(tmp_path / 'l.csv'), batch_size=7)
+    assert (files, errors) == (40, 0)
+    assert len(_keys(tmp_path / 'l.csv')) == lines > 40
+
+def test_unreadable_file_is_counted(corpus, tmp_path):
+    bad = tmp_path / 'bad.xml'
+    bad.write_text('<FatturaElettronica><FatturaElettronicaBody>', encoding='utf-8')
+    lines, files, errors = export_lines([str(bad)] + list(iter_xml_files(corpus)), str(tmp_path / 'l.csv'))
+    assert (files, errors) == (40, 1)
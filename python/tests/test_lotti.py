@@ -0,0 +1,16 @@
+from xml_invoice_generator import GeneratorOptions, generate_corpus
+from xml_invoice_processor import iter_fatture_from_file, iter_xml_files, process_xml_file
+
+def test_every_body_of_a_lotto(tmp_path):
+    generate_corpus(str(tmp_path), 10, GeneratorOptions(suppliers=2, lotto_ratio=1, max_bodies=4, seed=3))
+    lotti = 0
+    for path in iter_xml_files(str(tmp_path)):
+        with open(path, encoding='utf-8') as f:
+            bodies = f.read().count('<FatturaElettronicaBody>')
+        fatture = list(iter_fatture_from_file(path))
+        assert len(fatture) == bodies
+        assert fatture[0] == process_xml_file(path)
+        # One header for all of them
+        assert len({(f.cedente_id_fiscale, f.cedente_denominazione) for f in fatture}) == 1
+        lotti += bodies > 1
+    assert lotti > 0
@@ -0,0 +1,56 @@
+import base64
+import datetime
+import os
+
+import pytest
+
+from xml_invoice_p7m import SignatureCache, extract_payload, verify_signature
+from xml_invoice_processor import iter_fatture_from_file, iter_xml_files, process_folder
+
+def _first_invoice(corpus):
+    path = next(iter(iter_xml_files(corpus)))
+    with open(path, 'rb') as f:
+        return path, f.read()
+
+@pytest.mark.parametrize('encoding', ['der', 'base64', 'pem'])
+def test_signed_invoice_reads_like_the_plain_one(corpus, tmp_path, sign, encoding):
+    path, content = _first_invoice(corpus)
+    envelope = sign(content)
+    if encoding != 'der':
+        envelope = base64.encodebytes(envelope)
+    if encoding == 'pem':
+        envelope = b'-----BEGIN PKCS7-----\n' + envelope + b'-----END PKCS7-----\n'
+    signed = tmp_path / 'IT01234567890_00001.xml.p7m'
+    signed.write_bytes(envelope)
+    assert list(iter_fatture_from_file(str(signed))) == list(iter_fatture_from_file(path))
+
+def test_payload_is_not_copied(sign):
+    envelope = bytearray(sign(b'<FatturaElettronica/>'))
+    [chunk] = extract_payload(memoryview(envelope))
+    assert bytes(chunk) == b'<FatturaElettronica/>'
+    assert chunk.obj is envelope
+
+def test_detached_signature_has_no_payload(sign):
+    with pytest.raises(ValueError, match='detached'):
+        extract_payload(memoryview(sign(b'<FatturaElettronica/>', detached=True)))
+
+def test_signatures(corpus, tmp_path, sign):
+    _, content = _first_invoice(corpus)
+    envelope = sign(content)
+    (tmp_path / 'good.xml.p7m').write_bytes(envelope)
+    # Same length, other content: the digest no longer matches
+    (tmp_path / 'tampered.xml.p7m').write_bytes(envelope.replace(b'<Numero>', b'<Numerx>', 1)
+                                                .replace(b'</Numero>', b'</Numerx>', 1))
+    good = verify_signature(str(tmp_path / 'good.xml.p7m'))
+    assert good.valid and 'Cedente di prova' in good.signer
+    assert not verify_signature(str(tmp_path / 'tampered.xml.p7m')).valid
+    with SignatureCache(str(tmp_path / 's.sqlite')) as cache:
+        assert cache.verify(str(tmp_path / 'good.xml.p7m')).valid
+        assert cache.verify(str(tmp_path / 'good.xml.p7m')).valid
+
+def test_signed_files_in_a_folder(corpus, tmp_path, sign):
+    for path in iter_xml_files(corpus):
+        with open(path, 'rb') as f:
+            (tmp_path / (os.path.basename(path) + '.p7m')).write_bytes(sign(f.read()))
+    start, end = datetime.date.min, datetime.date.max
+    assert process_folder(str(tmp_path), start, end) == process_folder(corpus, start, end)
@@ -0,0 +1,20 @@
+import datetime
+
+from xml_invoice_metrics import RunMetrics
+from xml_invoice_processor import iter_xml_files, parse_files, process_folder
+
+START, END = datetime.date(2023, 1, 1), datetime.date(2024, 12, 31)
+
+def test_workers_keep_the_file_order(corpus):
+    assert process_folder(corpus, START, END, workers=3) == process_folder(corpus, START, END)
+
+def test_results_come_in_input_order(corpus, tmp_path):
+    bad = tmp_path / 'bad.xml'
+    bad.write_text('<FatturaElettronica>', encoding='utf-8')
+    paths = list(iter_xml_files(corpus))
+    paths.insert(7, str(bad))
+    metrics = RunMetrics()
+    results = list(parse_files(paths, workers=2, metrics=metrics))
+    assert [path for path, _, _ in results] == paths
+    assert [path for path, _, error in results if error is not None] == [str(bad)]
+    assert metrics.errors == {'ParseError': 1}
@@ -0,0 +1,118 @@
+import binascii
+import datetime
+import filecmp
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from xml_invoice_processor import iter_xml_files
+from xml_invoice_sdi import FatturaRicevuta, SDIClient, SDIError
+from xml_invoice_sdi_mock import serve_in_thread
+
+START, END = datetime.date(2023, 1, 1), datetime.date(2024, 12, 31)
+
+@pytest.fixture
+def server(corpus, request):
+    server = serve_in_thread(corpus, **getattr(request, 'param', {}))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def _names(folder):
+    return sorted(os.listdir(folder))
+
+def test_download_period(server, corpus, tmp_path):
+    with SDIClient(server.url, connections=4) as client:
+        summary = client.scarica_periodo(START, END, str(tmp_path), window_days=30)
+    assert summary.downloaded == len(server.files) == 40
+    assert summary.failed == summary.skipped == 0
+    originals = {os.path.basename(path): path for path in iter_xml_files(corpus)}
+    assert _names(tmp_path) == sorted(originals)
+    for name in _names(tmp_path):
+        assert filecmp.cmp(tmp_path / name, originals[name], shallow=False)
+
+def test_existing_files_are_skipped(server, tmp_path):
+    with SDIClient(server.url, connections=4) as client:
+        client.scarica_periodo(START, END, str(tmp_path), window_days=30)
+        downloads = server.requests['DownloadFattura']
+        summary = client.scarica_periodo(START, END, str(tmp_path), window_days=30)
+    assert (summary.downloaded, summary.skipped) == (0, 40)
+    assert server.requests['DownloadFattura'] == downloads
+
+@pytest.mark.parametrize('server', [{'failure_rate': 0.3, 'seed': 7}], indirect=True)
+def test_failures_are_retried(server, tmp_path):
+    with SDIClient(server.url, connections=4, retries=10, backoff=0.001) as client:
+        summary = client.scarica_periodo(START, END, str(tmp_path), window_days=30)
+    assert (summary.downloaded, summary.failed) == (40, 0)
+    assert summary.retries > 0
+
+@pytest.mark.parametrize('server', [{'stall_rate': 1.0, 'stall': 2.0}], indirect=True)
+def test_timeout_fails_the_request(server):
+    with SDIClient(server.url, timeout=0.2, retries=1, backoff=0.001) as client:
+        with pytest.raises(SDIError, match='2 attempts'):
+            client.ricerca_fatture(START, END)
+        assert client.retried == 1
+
+def test_undecodable_download_is_counted(server, tmp_path, monkeypatch):
+    with SDIClient(server.url, connections=2) as client:
+        scarica = client.scarica_fattura
+
+        def corrupt(identificativo_sdi):
+            if identificativo_sdi == '1':
+                raise binascii.Error("Incorrect padding")
+            return scarica(identificativo_sdi)
+        monkeypatch.setattr(client, 'scarica_fattura', corrupt)
+        summary = client.scarica_periodo(START, END, str(tmp_path), window_days=30)
+    assert (summary.downloaded, summary.failed) == (39, 1)
+    assert not [name for name in _names(tmp_path) if name.endswith('.part')]
+
+def test_unwritable_file_leaves_no_part(server, tmp_path, monkeypatch):
+    def fail(src, dst):
+        raise OSError(28, "No space left on device")
+    monkeypatch.setattr(os, 'replace', fail)
+    with SDIClient(server.url, connections=2) as client:
+        summary = client.scarica_periodo(START, END, str(tmp_path), window_days=30)
+    assert (summary.downloaded, summary.failed) == (0, 40)
+    assert _names(tmp_path) == []
+
+def test_slow_answer_hits_the_deadline():
+    # A server sending its status line a byte at a time, each well within the socket timeout
+    listener = socket.create_server(('127.0.0.1', 0))
+
+    def drip():
+        conn, _ = listener.accept()
+        with conn:
+            conn.recv(65536)
+            for byte in b'HTTP/1.1 200 OK\r\n' * 10:
+                time.sleep(0.05)
+                try:
+                    conn.sendall(bytes([byte]))
+                except OSError:
+                    return
+
+    threading.Thread(target=drip, daemon=True).start()
+    host, port = listener.getsockname()
+    try:
+        with SDIClient(f'http://{host}:{port}/', timeout=0.3, retries=0) as client:
+            start = time.monotonic()
+            with pytest.raises(SDIError, match='TimeoutError'):
+                client.ricerca_fatture(START, END)
+            assert time.monotonic() - start < 1.0
+    finally:
+        listener.close()
+
+def test_entry_without_nome_file_is_counted(server, tmp_path, monkeypatch):
+    with SDIClient(server.url, connections=2) as client:
+        ricerca = client.ricerca_fatture
+
+        def without_name(data_inizio, data_fine):
+            entries = ricerca(data_inizio, data_fine)
+            return [FatturaRicevuta(e.identificativo_sdi, None, e.data) if i == 0 else e
+                    for i, e in enumerate(entries)]
+
+        monkeypatch.setattr(client, 'ricerca_fatture', without_name)
+        summary = client.scarica_periodo(START, END, str(tmp_path), window_days=3650)
+    assert (summary.downloaded, summary.failed) == (39, 1)
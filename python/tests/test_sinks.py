@@ -0,0 +1,74 @@
+import csv
+import dataclasses
+import datetime
+import gzip
+import json
+from decimal import Decimal
+
+import pytest
+
+from xml_invoice_amounts import to_decimal
+from xml_invoice_processor import aggregate_by_cedente, process_folder
+from xml_invoice_sinks import FATTURA_COLUMNS, export_batch, export_fatture, summary_path
+
+START, END = datetime.date(2023, 1, 1), datetime.date(2024, 12, 31)
+
+@pytest.fixture(scope='module')
+def fatture(corpus):
+    fatture = process_folder(corpus, START, END)
+    # A negative amount and one that float would not round-trip
+    fatture[0] = dataclasses.replace(fatture[0], importo_pagamento=-5)
+    fatture[1] = dataclasses.replace(fatture[1], importo_pagamento=1234567890123)
+    return fatture
+
+def _expected(fatture):
+    return [{'cedente_id_fiscale': f.cedente_id_fiscale, 'cedente_denominazione': f.cedente_denominazione,
+             'cedente_regime_fiscale': f.cedente_regime_fiscale, 'divisa': f.divisa,
+             'data': f.data.isoformat(), 'numero': f.numero,
+             'data_scadenza_pagamento': f.data_scadenza_pagamento.isoformat(),
+             'importo_pagamento': to_decimal(f.importo_pagamento)} for f in fatture]
+
+def _read(path):
+    """Rows of a sink output as dicts of str, with amounts as Decimal."""
+    if '.csv' in path or '.jsonl' in path:
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', newline='', encoding='utf-8') as f:
+            if '.csv' in path:
+                rows = list(csv.DictReader(f))
+            else:
+                rows = [json.loads(line, parse_float=Decimal, parse_int=Decimal) for line in f]
+    else:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pq.read_table(path) if path.endswith('.parquet') else pa.ipc.open_file(path).read_all()
+        rows = table.to_pylist()
+    return [{name: Decimal(value) if kind == 'amount' else str(value) for (name, kind), value
+             in zip(FATTURA_COLUMNS, (row[name] for name, _ in FATTURA_COLUMNS))} for row in rows]
+
+@pytest.mark.parametrize('name', ['out.csv', 'out.csv.gz', 'out.jsonl', 'out.jsonl.gz', 'out.parquet', 'out.arrow'])
+def test_rows_round_trip(fatture, tmp_path, name):
+    if not name.startswith(('out.csv', 'out.jsonl')):
+        pytest.importorskip('pyarrow')
+    path = str(tmp_path / name)
+    count, totali = export_fatture(iter(fatture), path)
+    assert count == len(fatture)
+    assert totali == aggregate_by_cedente(fatture)
+    assert _read(path) == _expected(fatture)
+
+@pytest.mark.parametrize('name', ['out.csv', 'out.parquet'])
+def test_batch_writes_the_same(fatture, tmp_path, name):
+    pytest.importorskip('numpy')
+    if name.endswith('.parquet'):
+        pytest.importorskip('pyarrow')
+    from xml_invoice_batch import FatturaBatch
+    rows, columns = str(tmp_path / ('rows-' + name)), str(tmp_path / ('columns-' + name))
+    export_fatture(iter(fatture), rows)
+    count, totali = export_batch(FatturaBatch.from_fatture(fatture), columns)
+    assert count == len(fatture)
+    assert _read(columns) == _read(rows)
+    assert totali == aggregate_by_cedente(fatture)
+
+def test_summary_path():
+    assert summary_path('out.csv.gz') == 'out-totali.csv.gz'
+    assert summary_path('dir.v2/out.jsonl') == 'dir.v2/out-totali.jsonl'
+    assert summary_path('out.parquet', 'rate') == 'out-rate.parquet'
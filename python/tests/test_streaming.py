@@ -0,0 +1,49 @@
+import contextlib
+import os
+
+import pytest
+
+import xml_invoice_processor
+from xml_invoice_generator import GeneratorOptions, generate_corpus
+from xml_invoice_processor import iter_xml_files, process_xml_file, process_xml_file_tree
+
+class _CountingReader:
+    """Counts the bytes the parser pulls from the wrapped stream."""
+
+    def __init__(self, f):
+        self._f = f
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self.bytes_read += len(data)
+        return data
+
+def test_matches_the_tree_parser(corpus):
+    for path in iter_xml_files(corpus):
+        assert process_xml_file(path) == process_xml_file_tree(path)
+
+@pytest.mark.parametrize('backend', ['etree', 'lxml'])
+def test_attachment_is_not_read(tmp_path, monkeypatch, backend):
+    if backend == 'lxml':
+        pytest.importorskip('lxml')
+    generate_corpus(str(tmp_path), 1, GeneratorOptions(suppliers=1, lotto_ratio=0, attachment_ratio=1,
+                                                       attachment_kb=4096))
+    [path] = iter_xml_files(str(tmp_path))
+    readers = []
+    open_source = xml_invoice_processor.open_source
+
+    @contextlib.contextmanager
+    def counting_source(file_path):
+        with open_source(file_path) as f:
+            readers.append(_CountingReader(f))
+            yield readers[-1]
+
+    monkeypatch.setattr(xml_invoice_processor, 'open_source', counting_source)
+    xml_invoice_processor.set_default_backend(backend)
+    try:
+        fattura = process_xml_file(path)
+    finally:
+        xml_invoice_processor.set_default_backend('auto')
+    assert fattura.riepilogo_iva and fattura.rate
+    assert readers[0].bytes_read < os.path.getsize(path) / 10
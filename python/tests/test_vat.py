@@ -0,0 +1,39 @@
+import datetime
+
+import pytest
+
+from xml_invoice_processor import Fattura, RiepilogoIva, process_folder
+from xml_invoice_vat import VatSummary
+
+def _fattura(data, riepilogo, tipo_documento='TD01'):
+    return Fattura('01234567890', 'ALPHA SRL', 'RF01', 'EUR', data, '1', data, 0,
+                   tipo_documento=tipo_documento, riepilogo_iva=riepilogo)
+
+def test_credit_notes_subtract():
+    summary = VatSummary('quarter')
+    summary.add(_fattura(datetime.date(2024, 1, 10), [RiepilogoIva(2200, None, 10000, 2200)]))
+    summary.add(_fattura(datetime.date(2024, 2, 10), [RiepilogoIva(2200, None, 4000, 880)], 'TD04'))
+    summary.add(_fattura(datetime.date(2024, 4, 1), [RiepilogoIva(0, 'N2.2', 500, 0)]))
+    assert summary.rows() == [
+        ('2024-Q1', 2200, None, 'I', 2, 6000, 1320),
+        ('2024-Q2', 0, 'N2.2', 'I', 1, 500, 0),
+    ]
+    assert summary.totals_by_periodo() == {'2024-Q1': (6000, 1320), '2024-Q2': (500, 0)}
+
+def test_invoice_counts_once_per_key():
+    summary = VatSummary('month')
+    summary.add(_fattura(datetime.date(2024, 1, 10), [RiepilogoIva(2200, None, 100, 22),
+                                                      RiepilogoIva(2200, None, 200, 44)]))
+    assert summary.rows() == [('2024-01', 2200, None, 'I', 1, 300, 66)]
+
+def test_matches_the_invoices(corpus):
+    fatture = process_folder(corpus, datetime.date(2023, 1, 1), datetime.date(2024, 12, 31))
+    summary = VatSummary()
+    assert list(summary.collect(fatture)) == fatture
+    imponibile = sum(r.imponibile for f in fatture for r in f.riepilogo_iva)
+    assert sum(row[5] for row in summary.rows()) == imponibile
+    assert summary.fatture == len(fatture)
+
+def test_unknown_period():
+    with pytest.raises(ValueError):
+        VatSummary('year')
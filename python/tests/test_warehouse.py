@@ -0,0 +1,55 @@
+import datetime
+import os
+import shutil
+
+from xml_invoice_processor import aggregate_by_cedente, process_folder
+from xml_invoice_warehouse import InvoiceWarehouse
+
+START, END = datetime.date(2023, 1, 1), datetime.date(2024, 12, 31)
+
+def test_report_matches_process_folder(corpus, tmp_path):
+    with InvoiceWarehouse(str(tmp_path / 'w.sqlite')) as warehouse:
+        summary = warehouse.load(corpus)
+        assert (summary.added, summary.errors) == (40, 0)
+        fatture = process_folder(corpus, START, END)
+        assert list(warehouse.query(START, END)) == [
+            fattura.__class__(**{**vars(fattura), 'rate': [], 'riepilogo_iva': [], 'extra': {}})
+            for fattura in fatture]
+        assert warehouse.totals(START, END) == aggregate_by_cedente(fatture)
+        assert warehouse.count(START, END) == len(fatture)
+
+def test_reload_is_incremental(corpus, tmp_path):
+    folder = tmp_path / 'in'
+    shutil.copytree(corpus, folder)
+    subfolder = folder / '0000'
+    removed, touched = sorted(os.listdir(subfolder))[:2]
+    with InvoiceWarehouse(str(tmp_path / 'w.sqlite')) as warehouse:
+        warehouse.load(str(folder))
+        os.remove(subfolder / removed)
+        st = os.stat(subfolder / touched)
+        os.utime(subfolder / touched, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+        summary = warehouse.load(str(folder))
+        assert (summary.added, summary.changed, summary.removed) == (0, 1, 1)
+        assert warehouse.count(START, END) == len(process_folder(str(folder), START, END))
+
+def test_same_folder_named_differently(corpus, tmp_path, monkeypatch):
+    folder = tmp_path / 'in'
+    shutil.copytree(corpus, folder)
+    monkeypatch.chdir(tmp_path)
+    with InvoiceWarehouse(str(tmp_path / 'w.sqlite')) as warehouse:
+        warehouse.load('in')
+        count = warehouse.count(START, END)
+        summary = warehouse.load(str(folder))
+        assert summary.added == 0
+        assert warehouse.count(START, END) == count
+
+def test_folders_keep_their_load_order(corpus, tmp_path):
+    for name in ('b', 'a'):
+        shutil.copytree(corpus, tmp_path / name)
+    with InvoiceWarehouse(str(tmp_path / 'w.sqlite')) as warehouse:
+        warehouse.load(str(tmp_path / 'b'))
+        warehouse.load(str(tmp_path / 'a'))
+        fatture = list(warehouse.query(START, END))
+    single = process_folder(corpus, START, END)
+    # All of b, then all of a, each in its own walk order
+    assert [f.numero for f in fatture] == [f.numero for f in single] * 2
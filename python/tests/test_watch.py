@@ -0,0 +1,61 @@
+import datetime
+import os
+import shutil
+
+from xml_invoice_processor import aggregate_by_cedente, iter_xml_files, process_folder
+from xml_invoice_watch import InvoiceWatcher, PollingBackend
+
+START, END = datetime.date(2023, 1, 1), datetime.date(2024, 12, 31)
+
+def _totals(watcher):
+    return sorted((key, cents) for key, (cents, _) in watcher.totals.items())
+
+def _expected(folder):
+    return sorted(((t.cedente_id_fiscale, t.cedente_denominazione), t.totale_pagamenti)
+                  for t in aggregate_by_cedente(process_folder(str(folder), START, END)))
+
+def test_polling_notices_every_change(corpus, tmp_path):
+    folder = tmp_path / 'in'
+    shutil.copytree(corpus, folder)
+    first, second = sorted(iter_xml_files(str(folder)))[:2]
+    backend = PollingBackend(str(folder))
+    assert backend.poll(0) == []
+    # Rewritten in place: the directory itself does not change
+    st = os.stat(first)
+    os.utime(first, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    os.remove(second)
+    os.makedirs(folder / 'new')
+    shutil.copy(first, folder / 'new' / 'copy.xml')
+    assert sorted(backend.poll(0)) == sorted([('changed', first), ('removed', second),
+                                              ('changed', str(folder / 'new' / 'copy.xml'))])
+    assert backend.poll(0) == []
+
+def test_watcher_follows_the_folder(corpus, tmp_path):
+    folder = tmp_path / 'in'
+    shutil.copytree(corpus, folder)
+    watcher = InvoiceWatcher(str(folder), START, END, output_file=str(tmp_path / 'out.csv'), settle=0)
+    backend = PollingBackend(str(folder))
+    watcher.scan()
+    assert _totals(watcher) == _expected(folder)
+    removed, copied = sorted(iter_xml_files(str(folder)))[:2]
+    os.remove(removed)
+    shutil.copy(copied, folder / 'copy.xml')
+    watcher.run(backend, poll_interval=0, export_interval=0, max_iterations=2)
+    assert _totals(watcher) == _expected(folder)
+    assert os.path.exists(tmp_path / 'out.csv')
+
+def test_exports_wait_for_a_pause(tmp_path):
+    watcher = InvoiceWatcher(str(tmp_path), START, END, settle=0)
+    assert not watcher.export_due(100.0, 5, 60, 0.0)
+    watcher._changed()
+    now = watcher._changed_at
+    # Files still arriving: wait for a pause, or for max_delay at the latest
+    assert not watcher.export_due(now + 1, 5, 60, 0.0)
+    assert watcher.export_due(now + 5, 5, 60, 0.0)
+    watcher._changed_at = now + 59
+    assert not watcher.export_due(now + 59, 5, 60, 0.0)
+    assert watcher.export_due(now + 60, 5, 60, 0.0)
+    # A slow export spaces out the next ones
+    watcher.export_seconds = 10.0
+    assert not watcher.export_due(now + 60, 5, 60, now + 10)
+    assert watcher.export_due(now + 110, 5, 60, now + 10)
@@ -0,0 +1,45 @@
+import datetime
+
+import pytest
+from openpyxl import load_workbook
+
+from xml_invoice_processor import aggregate_by_cedente, main, process_folder
+from xml_invoice_xlsx import write_excel_streaming
+
+START, END = datetime.date(2023, 1, 1), datetime.date(2024, 12, 31)
+
+def _sheets(path):
+    workbook = load_workbook(path, read_only=True)
+    return {ws.title: [tuple(row) for row in ws.iter_rows(values_only=True)] for ws in workbook.worksheets}
+
+@pytest.mark.parametrize('options', [{}, {'cashflow': 'month', 'vat': 'quarter', 'as_of_str': '2024-01-01'}])
+def test_streaming_workbook_matches(corpus, tmp_path, monkeypatch, options):
+    monkeypatch.chdir(tmp_path)
+    outputs = []
+    for streaming_excel in (False, True):
+        outputs.append(str(tmp_path / f'{streaming_excel}.xlsx'))
+        main(corpus, START.isoformat(), END.isoformat(), use_cache=False, use_index=False,
+             streaming_excel=streaming_excel, output_file=outputs[-1], **options)
+    expected, streamed = (_sheets(output) for output in outputs)
+    assert list(streamed) == list(expected)
+    assert streamed == expected
+
+def test_details_spill_into_further_sheets(corpus, tmp_path):
+    fatture = process_folder(corpus, START, END)
+    rows = [(fattura.numero,) for fattura in fatture]
+    tables = [('numeri', "Numeri", [('numero', 'str')], rows)]
+    write_excel_streaming(aggregate_by_cedente(fatture), fatture, str(tmp_path / 'out.xlsx'),
+                          max_rows=11, tables=tables,
+                          fattura_tables=[('rate', "Rate", [('numero', 'str')], lambda f: [(f.numero,)] * 2)])
+    sheets = _sheets(tmp_path / 'out.xlsx')
+
+    def titles(title, rows):
+        # Ten rows under the header of each sheet
+        return [title] + [f"{title} ({n})" for n in range(2, -(-rows // 10) + 1)]
+
+    assert list(sheets) == (["Riepilogo per Fornitore"] + titles("Dettaglio Fatture", len(fatture))
+                            + titles("Rate", 2 * len(fatture)) + titles("Numeri", len(fatture)))
+    details = [row for title, sheet in sheets.items() if title.startswith("Dettaglio") for row in sheet[1:]]
+    assert [row[5] for row in details] == [fattura.numero for fattura in fatture]
+    assert all(len(sheet) <= 11 and sheet[0] == ('numero',) for title, sheet in sheets.items()
+               if title.startswith(("Rate", "Numeri")))
@@ -0,0 +1,53 @@
+import datetime
+import io
+import os
+import zipfile
+
+from xml_invoice_p7m import verify_signature
+from xml_invoice_processor import iter_fatture_from_file, iter_xml_files, process_folder
+from xml_invoice_zip import ZIP_SEPARATOR, source_stat
+
+START, END = datetime.date.min, datetime.date.max
+
+def _zip(path, members):
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, content in members:
+            archive.writestr(name, content)
+
+def _contents(corpus):
+    for path in iter_xml_files(corpus):
+        with open(path, 'rb') as f:
+            yield os.path.relpath(path, corpus), f.read()
+
+def test_archive_reads_like_the_folder(corpus, tmp_path):
+    _zip(tmp_path / 'fatture.zip', list(_contents(corpus)) + [('__MACOSX/0000/._x.xml', b'junk'),
+                                                               ('leggimi.txt', b'')])
+    expected = process_folder(corpus, START, END)
+    assert process_folder(str(tmp_path / 'fatture.zip'), START, END) == expected
+    # Found inside a folder as well
+    assert process_folder(str(tmp_path), START, END) == expected
+
+def test_nested_archives(corpus, tmp_path):
+    contents = list(_contents(corpus))
+    inner = io.BytesIO()
+    _zip(inner, contents[10:])
+    _zip(tmp_path / 'outer.zip', contents[:10] + [('mese/inner.zip', inner.getvalue())])
+    paths = list(iter_xml_files(str(tmp_path)))
+    assert len(paths) == len(contents)
+    assert sum(path.count(ZIP_SEPARATOR) == 2 for path in paths) == len(contents) - 10
+    assert process_folder(str(tmp_path), START, END) == process_folder(corpus, START, END)
+
+def test_members_have_their_own_size(corpus, tmp_path):
+    contents = list(_contents(corpus))[:2]
+    _zip(tmp_path / 'a.zip', contents)
+    first, second = iter_xml_files(str(tmp_path / 'a.zip'))
+    assert source_stat(first).st_size == len(contents[0][1])
+    assert source_stat(second).st_mtime_ns == os.stat(tmp_path / 'a.zip').st_mtime_ns
+
+def test_signed_members(corpus, tmp_path, sign):
+    name, content = next(_contents(corpus))
+    _zip(tmp_path / 'firmate.zip', [(name + '.p7m', sign(content))])
+    [member] = iter_xml_files(str(tmp_path / 'firmate.zip'))
+    assert member.endswith('.xml.p7m')
+    assert verify_signature(member).valid
+    assert list(iter_fatture_from_file(member)) == list(iter_fatture_from_file(os.path.join(corpus, name)))
@@ -0,0 +1,262 @@
+import datetime
+import os
+import sqlite3
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from xml_invoice_amounts import to_decimal
+from xml_invoice_metrics import LOG_LEVELS, configure_logging, log
+from xml_invoice_processor import (DEFAULT_OUTPUT_FILE, TotaleFattureCedente, iter_xml_files,
+                                   parse_date, parse_files, write_excel)
+from xml_invoice_zip import ZIP_SEPARATOR, source_stat
+
+DEFAULT_STORE_FILE = "fattura-pa-aggregates.sqlite"
+
+@dataclass
+class DeltaCedente:
+    cedente_id_fiscale: str
+    cedente_denominazione: str
+    delta_pagamenti: int
+    delta_fatture: int
+
+@dataclass
+class RefreshSummary:
+    run_id: int
+    added: int
+    changed: int
+    removed: int
+    errors: int
+
+class AggregateStore:
+    """Persistent per-cedente, per-day partial sums of ImportoPagamento.
+
+    Every folded file leaves its own contributions (cedente x day -> cents, count)
+    next to the merged day buckets, so a changed or deleted file can be retracted
+    exactly. Each refresh only parses files that are new or whose size or mtime
+    changed, and records its net changes so they can be reported as a delta.
+    """
+
+    def __init__(self, db_path: str = DEFAULT_STORE_FILE):
+        self.db_path = db_path
+        self._conn = sqlite3.connect(db_path, timeout=30)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (
+                run_id INTEGER PRIMARY KEY,
+                folder TEXT NOT NULL,
+                started_at TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                run_id INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS contributions (
+                path TEXT NOT NULL,
+                cedente_id_fiscale TEXT,
+                cedente_denominazione TEXT,
+                day INTEGER NOT NULL,
+                cents INTEGER NOT NULL,
+                fatture INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS contributions_path ON contributions (path);
+            CREATE TABLE IF NOT EXISTS buckets (
+                cedente_id_fiscale TEXT,
+                cedente_denominazione TEXT,
+                day INTEGER NOT NULL,
+                cents INTEGER NOT NULL,
+                fatture INTEGER NOT NULL,
+                PRIMARY KEY (cedente_id_fiscale, cedente_denominazione, day)
+            );
+            CREATE INDEX IF NOT EXISTS buckets_day ON buckets (day);
+            CREATE TABLE IF NOT EXISTS deltas (
+                run_id INTEGER NOT NULL,
+                cedente_id_fiscale TEXT,
+                cedente_denominazione TEXT,
+                cents INTEGER NOT NULL,
+                fatture INTEGER NOT NULL,
+                PRIMARY KEY (run_id, cedente_id_fiscale, cedente_denominazione)
+            );
+        """)
+
+    def refresh(self, folder_path: str, workers: int = 1) -> RefreshSummary:
+        """Fold new and changed files of the folder into the store and retract removed ones.
+
+        Paths are stored absolute, so a folder is the same however it is named.
+        """
+        folder_path = os.path.abspath(folder_path)
+        cursor = self._conn.execute("INSERT INTO runs (folder, started_at) VALUES (?, ?)",
+                                    (folder_path, datetime.datetime.now().isoformat(timespec='seconds')))
+        run_id = cursor.lastrowid
+
+        on_disk = {}
+        for file_path in iter_xml_files(folder_path):
+            st = source_stat(file_path)
+            on_disk[file_path] = (st.st_size, st.st_mtime_ns)
+
+        # Files of a folder, or members of an archive given in its place
+        prefix = folder_path + ZIP_SEPARATOR if os.path.isfile(folder_path) else os.path.join(folder_path, '')
+        known = {
+            path: (size, mtime_ns)
+            for path, size, mtime_ns in self._conn.execute(
+                "SELECT path, size, mtime_ns FROM files WHERE substr(path, 1, ?) = ?",
+                (len(prefix), prefix))
+        }
+        pending = [path for path, stat in on_disk.items() if known.get(path) != stat]
+        removed = [path for path in known if path not in on_disk]
+
+        for file_path in removed:
+            self._retract(file_path, run_id)
+            self._conn.execute("DELETE FROM files WHERE path = ?", (file_path,))
+
+        errors = 0
+        for file_path, values, error in parse_files(pending, workers):
+            if file_path in known:
+                self._retract(file_path, run_id)
+            if error is not None:
+                # Remember the file anyway, so it is retried only once it changes
+                log.warning(f"Error processing file {file_path}: {error}")
+                errors += 1
+            else:
+                self._fold(file_path, values, run_id)
+            size, mtime_ns = on_disk[file_path]
+            self._conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                               (file_path, size, mtime_ns, run_id))
+
+        self._conn.execute("DELETE FROM buckets WHERE fatture = 0")
+        self._conn.execute("DELETE FROM deltas WHERE run_id = ? AND cents = 0 AND fatture = 0", (run_id,))
+        self._conn.commit()
+        changed = sum(1 for path in pending if path in known)
+        return RefreshSummary(run_id=run_id, added=len(pending) - changed, changed=changed,
+                              removed=len(removed), errors=errors)
+
+    def totals(self, start_date: datetime.date, end_date: datetime.date) -> List[TotaleFattureCedente]:
+        """Per-cedente totals for a date range, summed from the pre-aggregated day buckets."""
+        rows = self._conn.execute("""
+            SELECT cedente_id_fiscale, cedente_denominazione, SUM(cents)
+            FROM buckets WHERE day BETWEEN ? AND ?
+            GROUP BY cedente_id_fiscale, cedente_denominazione
+            ORDER BY cedente_id_fiscale, cedente_denominazione
+        """, (start_date.toordinal(), end_date.toordinal()))
+        return [
+            TotaleFattureCedente(
+                cedente_id_fiscale=id_fiscale,
+                cedente_denominazione=denominazione,
+                totale_pagamenti=cents
+            )
+            for id_fiscale, denominazione, cents in rows
+        ]
+
+    def delta(self, run_id: Optional[int] = None) -> List[DeltaCedente]:
+        """Net per-cedente changes made by a run (default: the latest one)."""
+        if run_id is None:
+            row = self._conn.execute("SELECT MAX(run_id) FROM runs").fetchone()
+            run_id = row[0]
+        rows = self._conn.execute("""
+            SELECT cedente_id_fiscale, cedente_denominazione, cents, fatture
+            FROM deltas WHERE run_id = ?
+            ORDER BY cedente_id_fiscale, cedente_denominazione
+        """, (run_id,))
+        return [
+            DeltaCedente(
+                cedente_id_fiscale=id_fiscale,
+                cedente_denominazione=denominazione,
+                delta_pagamenti=cents,
+                delta_fatture=fatture
+            )
+            for id_fiscale, denominazione, cents, fatture in rows
+        ]
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _fold(self, file_path: str, values: List[tuple], run_id: int):
+        # Partial sums of this file: (id fiscale, denominazione, day) -> [cents, fatture]
+        partials: Dict[Tuple[str, str, int], List[int]] = {}
+        for v in values:
+            # v[0], v[1]: cedente; v[4]: invoice date ordinal; v[7]: ImportoPagamento
+            partial = partials.setdefault((v[0], v[1], v[4]), [0, 0])
+            partial[0] += v[7]
+            partial[1] += 1
+        rows = [key + tuple(partial) for key, partial in partials.items()]
+        self._conn.executemany("INSERT INTO contributions VALUES (?, ?, ?, ?, ?, ?)",
+                               ((file_path,) + row for row in rows))
+        self._merge(rows, run_id, sign=1)
+
+    def _retract(self, file_path: str, run_id: int):
+        rows = self._conn.execute("""
+            SELECT cedente_id_fiscale, cedente_denominazione, day, cents, fatture
+            FROM contributions WHERE path = ?
+        """, (file_path,)).fetchall()
+        self._conn.execute("DELETE FROM contributions WHERE path = ?", (file_path,))
+        self._merge(rows, run_id, sign=-1)
+
+    def _merge(self, rows: List[tuple], run_id: int, sign: int):
+        """Add (or subtract) partial sums into the day buckets and the run's delta."""
+        self._conn.executemany("""
+            INSERT INTO buckets VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (cedente_id_fiscale, cedente_denominazione, day) DO UPDATE SET
+                cents = cents + excluded.cents, fatture = fatture + excluded.fatture
+        """, ((id_fiscale, denominazione, day, sign * cents, sign * fatture)
+              for id_fiscale, denominazione, day, cents, fatture in rows))
+        self._conn.executemany("""
+            INSERT INTO deltas VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (run_id, cedente_id_fiscale, cedente_denominazione) DO UPDATE SET
+                cents = cents + excluded.cents, fatture = fatture + excluded.fatture
+        """, ((run_id, id_fiscale, denominazione, sign * cents, sign * fatture)
+              for id_fiscale, denominazione, _, cents, fatture in rows))
+
+def main(folder_path: str, start_date_str: str, end_date_str: str, workers: int = 1,
+         store_file: str = DEFAULT_STORE_FILE, output_file: str = DEFAULT_OUTPUT_FILE):
+    """Refresh the aggregate store from the folder and write the totals for the range."""
+    start_date = parse_date(start_date_str)
+    end_date = parse_date(end_date_str)
+
+    with AggregateStore(store_file) as store:
+        summary = store.refresh(folder_path, workers=workers)
+        print(f"Run {summary.run_id}: {summary.added} new, {summary.changed} changed, "
+              f"{summary.removed} removed files, {summary.errors} errors")
+
+        print("\nDelta since last run:")
+        for delta in store.delta(summary.run_id):
+            print(f"  {delta.cedente_id_fiscale} {delta.cedente_denominazione}: "
+                  f"{to_decimal(delta.delta_pagamenti):+,.2f} ({delta.delta_fatture:+d} fatture)")
+
+        totali = store.totals(start_date, end_date)
+
+    if output_file.endswith('.xlsx'):
+        write_excel(totali, [], output_file)
+    else:
+        from xml_invoice_sinks import TOTALE_COLUMNS, open_sink, totale_row
+        with open_sink(output_file, TOTALE_COLUMNS) as sink:
+            sink.write_rows(totale_row(totale) for totale in totali)
+    print(f"\nGenerated summary for {len(totali)} suppliers in {output_file}")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Incrementally maintain per-cedente totals and report a date range.",
+        epilog="Dates should be in YYYY-MM-DD format")
+    parser.add_argument("folder_path")
+    parser.add_argument("start_date")
+    parser.add_argument("end_date")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of parser processes (0 = one per CPU, default 1)")
+    parser.add_argument("--store-file", default=DEFAULT_STORE_FILE,
+                        help=f"aggregate store location (default {DEFAULT_STORE_FILE})")
+    parser.add_argument("-o", "--output", default=DEFAULT_OUTPUT_FILE,
+                        help="summary file: .xlsx, .csv[.gz], .jsonl[.gz], .parquet or .arrow")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default='off',
+                        help="per-file log on stderr (default off)")
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+
+    main(args.folder_path, args.start_date, args.end_date, workers=args.workers,
+         store_file=args.store_file, output_file=args.output)
@@ -0,0 +1,44 @@
+import re
+from decimal import Decimal
+from typing import Optional
+
+# Amounts are integers in units of 10**-scale: ImportoPagamento and the totals are cents.
+# FatturaPA prices and quantities go up to 8 decimals, so extra fields may use a larger scale.
+AMOUNT_SCALE = 2
+MAX_SCALE = 18
+
+_AMOUNT_RE = re.compile(r'\s*([+-]?)(\d*)(?:\.(\d*))?\s*')
+
+def parse_amount(text: str, scale: int = AMOUNT_SCALE) -> int:
+    """Parse a decimal amount straight into integer units, without going through float.
+
+    Digits beyond `scale` are rounded half away from zero.
+    """
+    match = _AMOUNT_RE.fullmatch(text)
+    if match is None or not (match.group(2) or match.group(3)):
+        raise ValueError(f"Invalid amount: {text!r}")
+    sign, whole, fraction = match.group(1), match.group(2), match.group(3) or ''
+    units = int(whole or '0') * 10 ** scale + int(fraction[:scale].ljust(scale, '0') or '0')
+    if len(fraction) > scale and fraction[scale] >= '5':
+        units += 1
+    return -units if sign == '-' else units
+
+def to_decimal(units: int, scale: int = AMOUNT_SCALE) -> Decimal:
+    """Exact Decimal value of an amount, e.g. 610 -> Decimal('6.10')."""
+    return Decimal(units).scaleb(-scale)
+
+def format_amount(units: int, scale: int = AMOUNT_SCALE) -> str:
+    """Plain text of an amount with exactly `scale` decimals, e.g. -5 -> '-0.05'."""
+    return format(to_decimal(units, scale), 'f')
+
+def amount_kind(scale: int = AMOUNT_SCALE) -> str:
+    """Sink column kind of amounts at `scale`: 'amount' for cents, 'amount:<scale>' otherwise."""
+    return 'amount' if scale == AMOUNT_SCALE else f'amount:{scale}'
+
+def amount_scale(kind: str) -> Optional[int]:
+    """The scale of an amount column kind, or None for other kinds."""
+    if kind == 'amount':
+        return AMOUNT_SCALE
+    if kind.startswith('amount:'):
+        return int(kind[7:])
+    return None
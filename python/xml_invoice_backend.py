@@ -0,0 +1,83 @@
+import xml.etree.ElementTree as ET
+from typing import Dict, Optional
+
+# 'auto' picks lxml when it is installed and falls back to the standard library
+BACKENDS = ['auto', 'lxml', 'etree']
+
+_EVENTS = ('start', 'end')
+
+class EtreeBackend:
+    """The standard library parser."""
+    name = 'etree'
+
+    def iterparse(self, source):
+        return ET.iterparse(source, events=_EVENTS)
+
+    def parse(self, source):
+        return ET.parse(source).getroot()
+
+class LxmlBackend:
+    """lxml (libxml2): same events and elements as ElementTree, parsed faster.
+
+    huge_tree lifts libxml2's limits on text nodes, which large base64
+    Allegati exceed. Entities and network access stay disabled. Syntax errors
+    are raised as ET.ParseError, so callers handle both backends alike.
+    """
+    name = 'lxml'
+
+    def __init__(self):
+        try:
+            from lxml import etree
+        except ImportError:
+            raise ImportError("The lxml parser backend needs lxml: pip install lxml") from None
+        self._etree = etree
+        self._options = dict(huge_tree=True, resolve_entities=False, no_network=True,
+                             remove_comments=True, remove_pis=True)
+        # Reused for every whole-document parse; XMLParser objects are not thread-safe,
+        # but each worker process has its own
+        self._parser = etree.XMLParser(**self._options)
+
+    def iterparse(self, source):
+        try:
+            yield from self._etree.iterparse(source, events=_EVENTS, **self._options)
+        except self._etree.XMLSyntaxError as e:
+            raise _parse_error(e) from None
+
+    def parse(self, source):
+        try:
+            return self._etree.parse(source, self._parser).getroot()
+        except self._etree.XMLSyntaxError as e:
+            raise _parse_error(e) from None
+
+def _parse_error(e) -> ET.ParseError:
+    error = ET.ParseError(str(e))
+    error.position = getattr(e, 'position', (0, 0))
+    return error
+
+_instances: Dict[str, object] = {}
+_default = 'auto'
+
+def set_default_backend(name: str):
+    """Select the backend used when none is given ('auto', 'lxml' or 'etree')."""
+    global _default
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown parser backend {name}: use one of {', '.join(BACKENDS)}")
+    get_backend(name)
+    _default = name
+
+def get_backend(name: Optional[str] = None):
+    """Return the backend for `name`, or the default one; 'lxml' fails when it is missing."""
+    name = name or _default
+    if name == 'auto':
+        try:
+            return get_backend('lxml')
+        except ImportError:
+            return get_backend('etree')
+    if name not in _instances:
+        if name == 'lxml':
+            _instances[name] = LxmlBackend()
+        elif name == 'etree':
+            _instances[name] = EtreeBackend()
+        else:
+            raise ValueError(f"Unknown parser backend {name}: use one of {', '.join(BACKENDS)}")
+    return _instances[name]
@@ -0,0 +1,177 @@
+import datetime
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from xml_invoice_cache import ParseCache
+from xml_invoice_index import DateIndex
+from xml_invoice_metrics import RunMetrics
+from xml_invoice_processor import (Fattura, ProgressCallback, TotaleFattureCedente, fattura_to_tuple,
+                                   iter_folder_records)
+
+_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+class _Dictionary:
+    """Dictionary encoder assigning int ids to values in first-seen order."""
+
+    def __init__(self):
+        self.values = []
+        self._ids = {}
+
+    def encode(self, value) -> int:
+        code = self._ids.get(value)
+        if code is None:
+            code = self._ids[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+class FatturaBatch:
+    """Columnar, array-backed collection of invoices.
+
+    Dates are int32 days since 1970-01-01, amounts are int64 cents and the
+    cedente, regime fiscale and divisa columns are dictionary-encoded int32 ids
+    into the `cedenti`, `regimi` and `divise` lists. Only `numero` stays a list
+    of Python strings. Only the first installment of each invoice is kept, not
+    the full payment schedule.
+    """
+
+    def __init__(self, cedenti: List[Tuple[str, str]], regimi: List[str], divise: List[str],
+                 cedente: np.ndarray, regime: np.ndarray, divisa: np.ndarray, data: np.ndarray,
+                 numero: List[str], data_scadenza: np.ndarray, importo_cents: np.ndarray):
+        self.cedenti = cedenti
+        self.regimi = regimi
+        self.divise = divise
+        self.cedente = cedente
+        self.regime = regime
+        self.divisa = divisa
+        self.data = data
+        self.numero = numero
+        self.data_scadenza = data_scadenza
+        self.importo_cents = importo_cents
+
+    def __len__(self) -> int:
+        return len(self.numero)
+
+    @classmethod
+    def from_tuples(cls, records: Iterable[tuple]) -> 'FatturaBatch':
+        """Build a batch from fattura_to_tuple records without creating Fattura objects."""
+        cedenti, regimi, divise = _Dictionary(), _Dictionary(), _Dictionary()
+        # Typed arrays keep the columns compact while the batch is being filled
+        cedente, regime, divisa = array('i'), array('i'), array('i')
+        data, data_scadenza, importo = array('i'), array('i'), array('q')
+        numero = []
+        for values in records:
+            (id_fiscale, denominazione, regime_fiscale, valuta,
+             data_ordinal, numero_fattura, scadenza_ordinal, importo_pagamento) = values[:8]
+            cedente.append(cedenti.encode((id_fiscale, denominazione)))
+            regime.append(regimi.encode(regime_fiscale))
+            divisa.append(divise.encode(valuta))
+            data.append(data_ordinal - _EPOCH_ORDINAL)
+            numero.append(numero_fattura)
+            data_scadenza.append(scadenza_ordinal - _EPOCH_ORDINAL)
+            importo.append(importo_pagamento)
+        return cls(
+            cedenti=cedenti.values,
+            regimi=regimi.values,
+            divise=divise.values,
+            cedente=np.frombuffer(cedente, dtype=np.int32),
+            regime=np.frombuffer(regime, dtype=np.int32),
+            divisa=np.frombuffer(divisa, dtype=np.int32),
+            data=np.frombuffer(data, dtype=np.int32),
+            numero=numero,
+            data_scadenza=np.frombuffer(data_scadenza, dtype=np.int32),
+            importo_cents=np.frombuffer(importo, dtype=np.int64)
+        )
+
+    @classmethod
+    def from_fatture(cls, fatture: Iterable[Fattura]) -> 'FatturaBatch':
+        """Build a batch from the list form."""
+        return cls.from_tuples(fattura_to_tuple(fattura) for fattura in fatture)
+
+    def iter_fatture(self) -> Iterator[Fattura]:
+        """Yield the rows as Fattura objects one at a time."""
+        for cedente, regime, divisa, data, numero, data_scadenza, importo in zip(
+                self.cedente.tolist(), self.regime.tolist(), self.divisa.tolist(), self.data.tolist(),
+                self.numero, self.data_scadenza.tolist(), self.importo_cents.tolist()):
+            yield Fattura(
+                cedente_id_fiscale=self.cedenti[cedente][0],
+                cedente_denominazione=self.cedenti[cedente][1],
+                cedente_regime_fiscale=self.regimi[regime],
+                divisa=self.divise[divisa],
+                data=datetime.date.fromordinal(data + _EPOCH_ORDINAL),
+                numero=numero,
+                data_scadenza_pagamento=datetime.date.fromordinal(data_scadenza + _EPOCH_ORDINAL),
+                importo_pagamento=importo
+            )
+
+    def to_fatture(self) -> List[Fattura]:
+        """Convert back to the list form used by write_excel."""
+        return list(self.iter_fatture())
+
+    def to_columns(self) -> Dict[str, np.ndarray]:
+        """Decode the batch into one array per Fattura field (dates as datetime64[D])."""
+        return {
+            'cedente_id_fiscale': np.array([c[0] for c in self.cedenti], dtype=object)[self.cedente],
+            'cedente_denominazione': np.array([c[1] for c in self.cedenti], dtype=object)[self.cedente],
+            'cedente_regime_fiscale': np.array(self.regimi, dtype=object)[self.regime],
+            'divisa': np.array(self.divise, dtype=object)[self.divisa],
+            'data': self.data.astype('datetime64[D]'),
+            'numero': np.array(self.numero, dtype=object),
+            'data_scadenza_pagamento': self.data_scadenza.astype('datetime64[D]'),
+            'importo_pagamento': self.importo_cents,
+        }
+
+    def filter_dates(self, start_date: datetime.date, end_date: datetime.date) -> 'FatturaBatch':
+        """Return the rows whose invoice date is within the range, sharing the dictionaries."""
+        start = start_date.toordinal() - _EPOCH_ORDINAL
+        end = end_date.toordinal() - _EPOCH_ORDINAL
+        mask = (self.data >= start) & (self.data <= end)
+        return self.take(np.flatnonzero(mask))
+
+    def take(self, rows: np.ndarray) -> 'FatturaBatch':
+        """Return the given rows as a new batch sharing the dictionaries."""
+        return FatturaBatch(
+            cedenti=self.cedenti,
+            regimi=self.regimi,
+            divise=self.divise,
+            cedente=self.cedente[rows],
+            regime=self.regime[rows],
+            divisa=self.divisa[rows],
+            data=self.data[rows],
+            numero=[self.numero[i] for i in rows.tolist()],
+            data_scadenza=self.data_scadenza[rows],
+            importo_cents=self.importo_cents[rows]
+        )
+
+    def totals_by_cedente(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Vectorized group-by-sum: return (cedente ids, total cents) in first-seen order."""
+        totals = np.zeros(len(self.cedenti), dtype=np.int64)
+        np.add.at(totals, self.cedente, self.importo_cents)
+        present = np.bincount(self.cedente, minlength=len(self.cedenti)) > 0
+        ids = np.flatnonzero(present)
+        return ids, totals[ids]
+
+    def aggregate_by_cedente(self) -> List[TotaleFattureCedente]:
+        """Same result as xml_invoice_processor.aggregate_by_cedente, summed in exact cents."""
+        ids, totals = self.totals_by_cedente()
+        return [
+            TotaleFattureCedente(
+                cedente_id_fiscale=self.cedenti[cedente][0],
+                cedente_denominazione=self.cedenti[cedente][1],
+                totale_pagamenti=total
+            )
+            for cedente, total in zip(ids.tolist(), totals.tolist())
+        ]
+
+def process_folder_batch(folder_path: str, start_date: datetime.date, end_date: datetime.date,
+                         workers: int = 1, cache: Optional[ParseCache] = None,
+                         index: Optional[DateIndex] = None,
+                         metrics: Optional[RunMetrics] = None,
+                         progress: Optional[ProgressCallback] = None, cancel=None,
+                         dedup=None) -> FatturaBatch:
+    """Like process_folder, but collect the records straight into a FatturaBatch."""
+    records = iter_folder_records(folder_path, start_date, end_date, workers=workers,
+                                  cache=cache, index=index, metrics=metrics,
+                                  progress=progress, cancel=cancel, dedup=dedup)
+    return FatturaBatch.from_tuples(v for _, file_records in records for v in file_records)
@@ -0,0 +1,190 @@
+import datetime
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional
+
+from xml_invoice_generator import GeneratorOptions, generate_corpus
+from xml_invoice_metrics import peak_rss_mb
+from xml_invoice_processor import (aggregate_by_cedente, iter_xml_files, process_folder,
+                                   process_xml_file, write_excel)
+from xml_invoice_zip import source_stat
+
+DEFAULT_BASELINE_FILE = "fattura-pa-benchmark-baseline.json"
+STAGES = ['process_xml_file', 'process_folder', 'aggregate_by_cedente', 'write_excel']
+
+@dataclass
+class StageResult:
+    stage: str
+    seconds: float
+    files: int
+    bytes: int
+    fatture: int
+    peak_rss_mb: Optional[float]
+
+    @property
+    def files_per_s(self) -> float:
+        return self.files / self.seconds if self.seconds else 0.0
+
+    @property
+    def mb_per_s(self) -> float:
+        return self.bytes / 1e6 / self.seconds if self.seconds else 0.0
+
+    def to_dict(self) -> dict:
+        return dict(asdict(self), files_per_s=self.files_per_s, mb_per_s=self.mb_per_s)
+
+def _run_stage(stage: str, corpus: str, workers: int) -> StageResult:
+    """Time one stage; runs in a freshly spawned process so peak RSS is the stage's own."""
+    files = list(iter_xml_files(corpus))
+    nbytes = sum(source_stat(f).st_size for f in files)
+    first, last = datetime.date.min, datetime.date.max
+    if stage == 'process_xml_file':
+        start = time.perf_counter()
+        fatture = [process_xml_file(f) for f in files]
+        seconds = time.perf_counter() - start
+    elif stage == 'process_folder':
+        start = time.perf_counter()
+        fatture = process_folder(corpus, first, last, workers=workers)
+        seconds = time.perf_counter() - start
+    elif stage == 'aggregate_by_cedente':
+        fatture = process_folder(corpus, first, last, workers=workers)
+        start = time.perf_counter()
+        aggregate_by_cedente(fatture)
+        seconds = time.perf_counter() - start
+    elif stage == 'write_excel':
+        fatture = process_folder(corpus, first, last, workers=workers)
+        totali = aggregate_by_cedente(fatture)
+        with tempfile.TemporaryDirectory() as tmp:
+            start = time.perf_counter()
+            write_excel(totali, fatture, os.path.join(tmp, 'benchmark.xlsx'))
+            seconds = time.perf_counter() - start
+    else:
+        raise ValueError(f"Unknown stage {stage}: use one of {', '.join(STAGES)}")
+    return StageResult(stage=stage, seconds=seconds, files=len(files), bytes=nbytes,
+                       fatture=len(fatture), peak_rss_mb=peak_rss_mb())
+
+def run_benchmark(corpus: str, stages: List[str] = STAGES, repeat: int = 3,
+                  workers: int = 1) -> Dict[str, StageResult]:
+    """Run each stage `repeat` times in a clean process and keep the fastest run."""
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for stage in stages:
+        runs = []
+        for _ in range(repeat):
+            with context.Pool(1) as pool:
+                runs.append(pool.apply(_run_stage, (stage, corpus, workers)))
+        results[stage] = min(runs, key=lambda r: r.seconds)
+    return results
+
+def compare(results: Dict[str, StageResult], baseline: dict, tolerance: float) -> List[str]:
+    """Return a message for every stage slower, or using more memory, than baseline + tolerance."""
+    regressions = []
+    for stage, result in results.items():
+        base = baseline.get('stages', {}).get(stage)
+        if base is None:
+            continue
+        if result.files_per_s < base['files_per_s'] * (1 - tolerance):
+            regressions.append(f"{stage}: {result.files_per_s:,.0f} files/s, "
+                               f"baseline {base['files_per_s']:,.0f}")
+        # Peak RSS is unknown on Windows
+        if (result.peak_rss_mb is not None and base.get('peak_rss_mb') is not None
+                and result.peak_rss_mb > base['peak_rss_mb'] * (1 + tolerance)):
+            regressions.append(f"{stage}: peak RSS {result.peak_rss_mb:,.1f} MB, "
+                               f"baseline {base['peak_rss_mb']:,.1f}")
+    return regressions
+
+def print_results(results: Dict[str, StageResult], baseline: Optional[dict] = None):
+    print(f"{'stage':<22}{'seconds':>10}{'files/s':>12}{'MB/s':>10}{'peak RSS MB':>13}{'vs baseline':>13}")
+    for stage, r in results.items():
+        change = ''
+        base = (baseline or {}).get('stages', {}).get(stage)
+        if base and base['files_per_s']:
+            change = f"{(r.files_per_s / base['files_per_s'] - 1) * 100:+.1f}%"
+        rss = f"{r.peak_rss_mb:.1f}" if r.peak_rss_mb is not None else '-'
+        print(f"{stage:<22}{r.seconds:>10.3f}{r.files_per_s:>12,.0f}{r.mb_per_s:>10.1f}"
+              f"{rss:>13}{change:>13}")
+
+def main(corpus: Optional[str] = None, files: int = 10000, options: GeneratorOptions = GeneratorOptions(),
+         stages: List[str] = STAGES, repeat: int = 3, workers: int = 1,
+         baseline_file: str = DEFAULT_BASELINE_FILE, save_baseline: bool = False,
+         tolerance: float = 0.1) -> int:
+    """Benchmark the pipeline stages and compare with the stored baseline; return the exit code."""
+    generated = None
+    if corpus is None:
+        generated = corpus = tempfile.mkdtemp(prefix='fattura-pa-benchmark-')
+        start = time.perf_counter()
+        nbytes = generate_corpus(corpus, files, options, workers=workers)
+        print(f"Generated {files} files ({nbytes / 1e6:.1f} MB) in {time.perf_counter() - start:.1f}s")
+    try:
+        results = run_benchmark(corpus, stages, repeat=repeat, workers=workers)
+    finally:
+        if generated is not None:
+            shutil.rmtree(generated)
+
+    corpus_info = corpus if generated is None else dict(asdict(options), files=files,
+                                                        start_date=options.start_date.isoformat())
+    baseline = None
+    if os.path.exists(baseline_file):
+        with open(baseline_file, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('corpus') != corpus_info or baseline.get('workers') != workers:
+            print("Warning: the baseline was recorded on a different corpus or worker count")
+    print_results(results, baseline)
+
+    if save_baseline:
+        with open(baseline_file, 'w', encoding='utf-8') as f:
+            json.dump({
+                'created': datetime.datetime.now().isoformat(timespec='seconds'),
+                'corpus': corpus_info,
+                'workers': workers,
+                'stages': {stage: r.to_dict() for stage, r in results.items()},
+            }, f, indent=2)
+        print(f"\nSaved baseline to {baseline_file}")
+        return 0
+    if baseline is None:
+        print(f"\nNo baseline in {baseline_file}: run with --save-baseline to store one")
+        return 0
+
+    regressions = compare(results, baseline, tolerance)
+    if regressions:
+        print(f"\nRegressions beyond {tolerance:.0%}:")
+        for message in regressions:
+            print(f"  {message}")
+        return 1
+    print(f"\nNo regressions beyond {tolerance:.0%}")
+    return 0
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Benchmark process_xml_file, process_folder, aggregate_by_cedente and write_excel.")
+    parser.add_argument("--corpus", help="existing folder to benchmark (default: generate a synthetic one)")
+    parser.add_argument("--files", type=int, default=10000, help="synthetic files to generate (default 10000)")
+    parser.add_argument("--suppliers", type=int, default=200, help="distinct cedenti (default 200)")
+    parser.add_argument("--max-lines", type=int, default=10, help="maximum DettaglioLinee per body (default 10)")
+    parser.add_argument("--lotto-ratio", type=float, default=0.1,
+                        help="fraction of files that are multi-body lotti (default 0.1)")
+    parser.add_argument("--attachment-ratio", type=float, default=0.0,
+                        help="fraction of bodies with an attachment (default 0)")
+    parser.add_argument("--attachment-kb", type=int, default=64, help="attachment size in KiB (default 64)")
+    parser.add_argument("--stages", nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage, fastest kept (default 3)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="parser processes for process_folder (0 = one per CPU, default 1)")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_FILE,
+                        help=f"baseline file (default {DEFAULT_BASELINE_FILE})")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="allowed slowdown or memory growth before failing (default 0.1 = 10%%)")
+    args = parser.parse_args()
+
+    options = GeneratorOptions(suppliers=args.suppliers, max_lines=args.max_lines, lotto_ratio=args.lotto_ratio,
+                               attachment_ratio=args.attachment_ratio, attachment_kb=args.attachment_kb)
+    sys.exit(main(args.corpus, args.files, options, stages=args.stages, repeat=args.repeat,
+                  workers=args.workers, baseline_file=args.baseline, save_baseline=args.save_baseline,
+                  tolerance=args.tolerance))
@@ -0,0 +1,149 @@
+import hashlib
+import json
+import sqlite3
+from typing import Optional, Tuple
+
+from xml_invoice_zip import open_raw, source_stat
+
+DEFAULT_CACHE_FILE = "fattura-pa-cache.sqlite"
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# (size, mtime_ns, digest) of a file; digest is None until it was needed
+CacheKey = Tuple[int, int, Optional[str]]
+
+def file_digest(file_path: str) -> str:
+    """Return the SHA-256 hex digest of a file's (or archive member's) content."""
+    digest = hashlib.sha256()
+    with open_raw(file_path) as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class ParseCache:
+    """Persistent SQLite cache of parsed invoice records.
+
+    Entries are keyed by path, size and mtime. When the stat data no longer matches
+    (touched, copied or moved files) the content hash is used as a fallback, so only
+    files whose bytes really changed are parsed again. Entries are also keyed by
+    extractor version, so switching between versions (or --fields configs) keeps the
+    entries of each; the least recently used entries of any version are evicted
+    once the stored payloads exceed max_bytes.
+    """
+
+    def __init__(self, db_path: str = DEFAULT_CACHE_FILE, extractor_version: str = "",
+                 max_bytes: int = DEFAULT_MAX_BYTES):
+        self.db_path = db_path
+        self.version = extractor_version
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._conn = sqlite3.connect(db_path, timeout=30)
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(entries)")]
+        if columns and 'version' not in columns:
+            # Cache files written before entries were keyed by version
+            self._conn.execute("DROP TABLE entries")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            CREATE TABLE IF NOT EXISTS entries (
+                path TEXT NOT NULL,
+                version TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                digest TEXT,
+                payload TEXT NOT NULL,
+                nbytes INTEGER NOT NULL,
+                last_used INTEGER NOT NULL,
+                PRIMARY KEY (path, version)
+            );
+            CREATE INDEX IF NOT EXISTS entries_version_size_digest ON entries (version, size, digest);
+            CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+        """)
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'clock'").fetchone()
+        # Logical clock for LRU ordering, advanced once per run
+        self._clock = (int(row[0]) if row else 0) + 1
+        self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('clock', ?)", (str(self._clock),))
+        self._used = []
+
+    def lookup(self, file_path: str) -> Tuple[Optional[tuple], CacheKey]:
+        """Return (cached payload or None, key to pass to store on a miss)."""
+        st = source_stat(file_path)
+        size, mtime_ns = st.st_size, st.st_mtime_ns
+        row = self._conn.execute(
+            "SELECT size, mtime_ns, digest, payload FROM entries WHERE path = ? AND version = ?",
+            (file_path, self.version)).fetchone()
+        if row is not None and row[0] == size and row[1] == mtime_ns:
+            return self._hit(file_path, row[3]), (size, mtime_ns, row[2])
+
+        # Fall back to the content hash, but only when an entry of the same size exists
+        if row is None or row[0] != size:
+            same_size = self._conn.execute(
+                "SELECT 1 FROM entries WHERE version = ? AND size = ? LIMIT 1",
+                (self.version, size)).fetchone()
+            if same_size is None:
+                self.misses += 1
+                return None, (size, mtime_ns, None)
+
+        digest = file_digest(file_path)
+        match = self._conn.execute(
+            "SELECT payload FROM entries WHERE version = ? AND size = ? AND digest = ? LIMIT 1",
+            (self.version, size, digest)).fetchone()
+        if match is None:
+            self.misses += 1
+            return None, (size, mtime_ns, digest)
+        self._write(file_path, (size, mtime_ns, digest), match[0])
+        return self._hit(file_path, match[0]), (size, mtime_ns, digest)
+
+    def store(self, file_path: str, key: CacheKey, payload: tuple, digest: Optional[str] = None):
+        """Store the payload (any JSON-serializable tuple) for a file that missed.
+
+        digest is the file_digest of the file when the caller already has it (parse_files
+        computes it in the workers); otherwise the file is read again to hash it.
+        """
+        size, mtime_ns, known = key
+        digest = known or digest or file_digest(file_path)
+        self._write(file_path, (size, mtime_ns, digest), json.dumps(payload, separators=(',', ':')))
+
+    def commit(self):
+        """Record LRU usage, evict old entries above the size cap and commit."""
+        self._conn.executemany("UPDATE entries SET last_used = ? WHERE path = ? AND version = ?",
+                               ((self._clock, path, self.version) for path in self._used))
+        self._used = []
+        self._evict()
+        self._conn.commit()
+
+    def close(self):
+        self.commit()
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _hit(self, file_path: str, payload: str) -> tuple:
+        self.hits += 1
+        self._used.append(file_path)
+        return tuple(json.loads(payload))
+
+    def _write(self, file_path: str, key: CacheKey, payload: str):
+        size, mtime_ns, digest = key
+        self._conn.execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (file_path, self.version, size, mtime_ns, digest, payload, len(payload), self._clock))
+
+    def _evict(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        victims = []
+        for rowid, nbytes in self._conn.execute("SELECT rowid, nbytes FROM entries ORDER BY last_used"):
+            victims.append((rowid,))
+            excess -= nbytes
+            if excess <= 0:
+                break
+        self._conn.executemany("DELETE FROM entries WHERE rowid = ?", victims)
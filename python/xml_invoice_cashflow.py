@@ -0,0 +1,202 @@
+import datetime
+from array import array
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from xml_invoice_processor import Fattura
+
+PERIODS = ['week', 'month']
+# Upper bounds, in days past due, of the ageing buckets; older installments fall in the last one
+AGEING_DAYS = (30, 60, 90)
+
+# Key span per cedente in the (cedente, due date) index: larger than any date ordinal
+_KEY_SPAN = datetime.date.max.toordinal() + 1
+
+# Sink column schemas, see xml_invoice_sinks
+RATA_COLUMNS = [
+    ('cedente_id_fiscale', 'str'),
+    ('cedente_denominazione', 'str'),
+    ('data', 'date'),
+    ('numero', 'str'),
+    ('numero_rata', 'int'),
+    ('condizioni_pagamento', 'str'),
+    ('modalita_pagamento', 'str'),
+    ('data_scadenza', 'date'),
+    ('importo', 'amount'),
+]
+
+CASHFLOW_COLUMNS = [
+    ('periodo_inizio', 'date'),
+    ('periodo_fine', 'date'),
+    ('rate', 'int'),
+    ('importo', 'amount'),
+    ('cumulato', 'amount'),
+]
+
+def ageing_columns(days: Sequence[int] = AGEING_DAYS) -> List[Tuple[str, str]]:
+    bounds = [1] + [d + 1 for d in days]
+    return ([('cedente_id_fiscale', 'str'), ('cedente_denominazione', 'str'), ('non_scaduto', 'amount')]
+            + [(f'scaduto_{low}_{high}', 'amount') for low, high in zip(bounds, days)]
+            + [(f'scaduto_oltre_{days[-1]}', 'amount'), ('totale_scaduto', 'amount')])
+
+def rata_rows(fattura: Fattura) -> Iterator[tuple]:
+    """Schedule rows of an invoice, in RATA_COLUMNS order."""
+    for numero_rata, rata in enumerate(fattura.rate, 1):
+        yield (fattura.cedente_id_fiscale, fattura.cedente_denominazione, fattura.data, fattura.numero,
+               numero_rata, rata.condizioni, rata.modalita, rata.data_scadenza, rata.importo)
+
+@dataclass
+class CashFlowPeriod:
+    inizio: datetime.date
+    fine: datetime.date
+    rate: int
+    importo: int
+    cumulato: int
+
+@dataclass
+class AgeingCedente:
+    cedente_id_fiscale: str
+    cedente_denominazione: str
+    non_scaduto: int
+    # One amount per AGEING_DAYS bucket, then the one past the last bound
+    scaduto: List[int]
+
+    @property
+    def totale_scaduto(self) -> int:
+        return sum(self.scaduto)
+
+class ScheduleIndex:
+    """Installments sorted once by due date, answering range queries by binary search.
+
+    Two orders are kept over int32 due dates and int64 amounts in cents: by due
+    date alone, with a running total for cash-flow buckets, and by (cedente, due
+    date) for per-supplier ageing. A query costs O(buckets x log n), whatever
+    the number of installments.
+    """
+
+    def __init__(self, cedenti: List[Tuple[str, str]], cedente: np.ndarray, scadenza: np.ndarray,
+                 importo: np.ndarray):
+        self.cedenti = cedenti
+        order = np.argsort(scadenza, kind='stable')
+        self.scadenza = scadenza[order]
+        self._cumulato = np.concatenate(([0], np.cumsum(importo[order], dtype=np.int64)))
+        keys = cedente.astype(np.int64) * _KEY_SPAN + scadenza
+        order = np.argsort(keys, kind='stable')
+        self._keys = keys[order]
+        self._cumulato_cedente = np.concatenate(([0], np.cumsum(importo[order], dtype=np.int64)))
+
+    def __len__(self) -> int:
+        return len(self.scadenza)
+
+    def _sums(self, edges: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(count, amount) of the installments due in [edges[i], edges[i + 1])."""
+        positions = np.searchsorted(self.scadenza, edges, side='left')
+        return np.diff(positions), np.diff(self._cumulato[positions])
+
+    def due_between(self, start: datetime.date, end: datetime.date) -> Tuple[int, int]:
+        """(count, amount) of the installments due from start to end, both included."""
+        counts, amounts = self._sums(np.array([start.toordinal(), end.toordinal() + 1]))
+        return int(counts[0]), int(amounts[0])
+
+    def cash_flow(self, period: str = 'month', start: Optional[datetime.date] = None,
+                  end: Optional[datetime.date] = None) -> List[CashFlowPeriod]:
+        """Amounts due per week (Monday to Sunday) or calendar month, empty periods left out.
+
+        The range defaults to the first and last due dates; `cumulato` is the running
+        total from the start of the range.
+        """
+        if period not in PERIODS:
+            raise ValueError(f"Unknown period {period}: use one of {', '.join(PERIODS)}")
+        if not len(self):
+            return []
+        first = start.toordinal() if start else int(self.scadenza[0])
+        last = end.toordinal() if end else int(self.scadenza[-1])
+        if first > last:
+            return []
+        if period == 'week':
+            # Ordinal 1 (0001-01-01) is a Monday
+            monday = first - (first - 1) % 7
+            edges = np.arange(monday, last + 8, 7, dtype=np.int64)
+        else:
+            months = np.arange(np.datetime64(datetime.date.fromordinal(first), 'M'),
+                               np.datetime64(datetime.date.fromordinal(last), 'M') + 2)
+            epoch = datetime.date(1970, 1, 1).toordinal()
+            edges = months.astype('datetime64[D]').astype(np.int64) + epoch
+        counts, amounts = self._sums(edges)
+        running = np.cumsum(amounts)
+        return [CashFlowPeriod(datetime.date.fromordinal(int(edges[i])),
+                               datetime.date.fromordinal(int(edges[i + 1]) - 1),
+                               int(counts[i]), int(amounts[i]), int(running[i]))
+                for i in np.flatnonzero(counts)]
+
+    def ageing(self, as_of: datetime.date, days: Sequence[int] = AGEING_DAYS) -> List[AgeingCedente]:
+        """Per-cedente amounts not yet due and overdue by 1-30, 31-60, 61-90 and 90+ days on as_of.
+
+        Nothing in FatturaPA records a payment, so every installment due before
+        as_of counts as overdue.
+        """
+        # Due-date bounds of the buckets, oldest first: due < as_of - 90 is overdue by 90+ days
+        bounds = [as_of.toordinal() - d for d in sorted(days, reverse=True)] + [as_of.toordinal()]
+        codes = np.arange(len(self.cedenti), dtype=np.int64)[:, None] * _KEY_SPAN
+        edges = np.hstack([codes, codes + np.array(bounds, dtype=np.int64), codes + _KEY_SPAN])
+        totals = np.diff(self._cumulato_cedente[np.searchsorted(self._keys, edges, side='left')], axis=1)
+        return [AgeingCedente(id_fiscale, denominazione, int(row[-1]), [int(v) for v in row[-2::-1]])
+                for (id_fiscale, denominazione), row in zip(self.cedenti, totals)]
+
+class ScheduleBuilder:
+    """Collects the installments of fatture as they stream by, then builds a ScheduleIndex."""
+
+    def __init__(self):
+        self.cedenti: List[Tuple[str, str]] = []
+        self._codes: Dict[Tuple[str, str], int] = {}
+        self._cedente, self._scadenza, self._importo = array('i'), array('i'), array('q')
+
+    def __len__(self) -> int:
+        return len(self._importo)
+
+    def add(self, fattura: Fattura):
+        key = (fattura.cedente_id_fiscale, fattura.cedente_denominazione)
+        code = self._codes.get(key)
+        if code is None:
+            code = self._codes[key] = len(self.cedenti)
+            self.cedenti.append(key)
+        for rata in fattura.rate:
+            self._cedente.append(code)
+            self._scadenza.append(rata.data_scadenza.toordinal())
+            self._importo.append(rata.importo)
+
+    def collect(self, fatture: Iterable[Fattura], sink=None) -> Iterator[Fattura]:
+        """Pass fatture through, adding their installments (and writing them to `sink`)."""
+        for fattura in fatture:
+            self.add(fattura)
+            if sink is not None:
+                sink.write_rows(rata_rows(fattura))
+            yield fattura
+
+    def build(self) -> ScheduleIndex:
+        return ScheduleIndex(self.cedenti, np.frombuffer(self._cedente, dtype=np.int32),
+                             np.frombuffer(self._scadenza, dtype=np.int32).astype(np.int64),
+                             np.frombuffer(self._importo, dtype=np.int64))
+
+# Report tables are (name, sheet title, columns, rows): the name suffixes the companion
+# files of sink outputs (see xml_invoice_sinks.export_tables), the title names the sheet
+Table = Tuple[str, str, List[Tuple[str, str]], Iterable[tuple]]
+
+def schedule_table(fatture: Iterable[Fattura]) -> Table:
+    """Every installment of the fatture, one row each."""
+    name, title, columns, _ = schedule_rows_table()
+    return name, title, columns, (row for fattura in fatture for row in rata_rows(fattura))
+
+def schedule_rows_table() -> tuple:
+    """schedule_table with rata_rows in place of the rows, for write_excel_streaming's fattura_tables."""
+    return ('rate', "Scadenzario Rate", RATA_COLUMNS, rata_rows)
+
+def cashflow_tables(index: ScheduleIndex, period: str, as_of: datetime.date) -> List[Table]:
+    """The cash flow per period and the per-cedente ageing on as_of."""
+    cash_flow = [(p.inizio, p.fine, p.rate, p.importo, p.cumulato) for p in index.cash_flow(period)]
+    ageing = [(a.cedente_id_fiscale, a.cedente_denominazione, a.non_scaduto, *a.scaduto, a.totale_scaduto)
+              for a in index.ageing(as_of)]
+    return [('flussi', "Flussi di Cassa", CASHFLOW_COLUMNS, cash_flow),
+            ('scaduto', "Scaduto per Fornitore", ageing_columns(), ageing)]
@@ -0,0 +1,344 @@
+import datetime
+import hashlib
+import json
+import math
+import sqlite3
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from xml_invoice_metrics import LOG_LEVELS, configure_logging, log
+from xml_invoice_zip import source_stat
+
+DEFAULT_DEDUP_FILE = "fattura-pa-dedup.sqlite"
+DEFAULT_REPORT_FILE = "fattura-pa-duplicates.csv"
+POLICIES = ['first-wins', 'newest-wins', 'report-only']
+# Smallest Bloom filter built, in keys; it is rebuilt twice as large once overfilled
+DEFAULT_CAPACITY = 1_000_000
+DEFAULT_ERROR_RATE = 0.01
+
+# Sink column schema of the duplicate report, see xml_invoice_sinks
+REPORT_COLUMNS = [
+    ('cedente_id_fiscale', 'str'),
+    ('numero', 'str'),
+    ('data', 'date'),
+    ('tipo_documento', 'str'),
+    ('file', 'str'),
+    ('originale', 'str'),
+    ('azione', 'str'),
+]
+
+def invoice_key(values: tuple) -> Tuple[str, str, int, str]:
+    """(IdPaese + IdCodice, Numero, Data ordinal, TipoDocumento) of a fattura_to_tuple record."""
+    return ((values[11] or '') + values[0], values[5], values[4], values[9] or '')
+
+def key_digest(key: Tuple[str, str, int, str]) -> bytes:
+    """16-byte digest of an invoice key, as stored in the index."""
+    return hashlib.blake2b('\x1f'.join(map(str, key)).encode(), digest_size=16).digest()
+
+class BloomFilter:
+    """Bit array answering "definitely not seen" for key digests, at ~10 bits per key for 1%."""
+
+    def __init__(self, capacity: int, error_rate: float = DEFAULT_ERROR_RATE,
+                 bits: Optional[bytes] = None, count: int = 0):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray(bits) if bits is not None else bytearray((self.size + 7) // 8)
+        self.count = count
+
+    def add(self, digest: bytes):
+        # Double hashing over the two halves of the digest
+        h = int.from_bytes(digest, 'little')
+        h1, h2 = h & 0xFFFFFFFFFFFFFFFF, (h >> 64) | 1
+        bits, size = self.bits, self.size
+        for i in range(self.hashes):
+            pos = (h1 + i * h2) % size
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, digest: bytes) -> bool:
+        h = int.from_bytes(digest, 'little')
+        h1, h2 = h & 0xFFFFFFFFFFFFFFFF, (h >> 64) | 1
+        bits, size = self.bits, self.size
+        for i in range(self.hashes):
+            pos = (h1 + i * h2) % size
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+class DuplicateIndex:
+    """Persistent SQLite index of the invoices seen, keyed on invoice_key, dropping duplicates.
+
+    Each key is owned by one file. A record whose key is owned by another file
+    that still exists unchanged is a duplicate, and the policy decides which copy is kept:
+    first-wins keeps the copy indexed first (in this run or an earlier one),
+    newest-wins the one with the most recent mtime, and report-only keeps both.
+    Records of the file owning their key pass, so runs can be repeated.
+    With bloom, an in-memory Bloom filter (saved with the index) answers for
+    keys never seen without a lookup, so only likely duplicates hit SQLite.
+    """
+
+    def __init__(self, db_path: str = DEFAULT_DEDUP_FILE, policy: str = 'first-wins',
+                 bloom: bool = True, error_rate: float = DEFAULT_ERROR_RATE):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown duplicate policy {policy}: use one of {', '.join(POLICIES)}")
+        self.db_path = db_path
+        self.policy = policy
+        self.checked = 0
+        self.duplicates = 0
+        self.lookups = 0
+        self._inserted = 0
+        # When a set, filter adds the (file path, cedente_id_fiscale, data, numero) of
+        # every invoice it yields, so a later pass (the line items) can skip the others
+        self.kept: Optional[Set[tuple]] = None
+        # (size, mtime_ns) of the files whose claims were checked in this run
+        self._stats: Dict[str, Tuple[int, int]] = {}
+        self._conn = sqlite3.connect(db_path, timeout=30)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            CREATE TABLE IF NOT EXISTS invoices (
+                key BLOB PRIMARY KEY,
+                path TEXT NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                run INTEGER NOT NULL
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS invoices_path ON invoices (path);
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS bloom (
+                capacity INTEGER NOT NULL,
+                error_rate REAL NOT NULL,
+                count INTEGER NOT NULL,
+                bits BLOB NOT NULL
+            );
+            CREATE TEMP TABLE duplicates (
+                key BLOB NOT NULL,
+                cedente TEXT, numero TEXT, data INTEGER, tipo_documento TEXT,
+                path TEXT NOT NULL,
+                kept INTEGER NOT NULL
+            );
+            CREATE TEMP TABLE pending (
+                key BLOB PRIMARY KEY,
+                seq INTEGER NOT NULL,
+                path TEXT NOT NULL,
+                record_index INTEGER NOT NULL
+            );
+        """)
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'run'").fetchone()
+        self._run = (int(row[0]) if row else 0) + 1
+        self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('run', ?)", (str(self._run),))
+        self.bloom = self._load_bloom(error_rate) if bloom else None
+
+    def _load_bloom(self, error_rate: float) -> BloomFilter:
+        row = self._conn.execute("SELECT capacity, error_rate, count, bits FROM bloom").fetchone()
+        if row is not None:
+            return BloomFilter(row[0], row[1], row[3], row[2])
+        # Missing or invalidated: rebuild it from the index keys
+        count = self._conn.execute("SELECT COUNT(*) FROM invoices").fetchone()[0]
+        bloom = BloomFilter(max(DEFAULT_CAPACITY, 2 * count), error_rate)
+        for (digest,) in self._conn.execute("SELECT key FROM invoices"):
+            bloom.add(digest)
+        return bloom
+
+    def _refresh(self, file_path: str) -> bool:
+        """Drop the keys a file owns if it changed (or is gone) since it claimed them.
+
+        Returns False when the file no longer exists. Each file is checked once per run.
+        """
+        if file_path in self._stats:
+            return True
+        try:
+            st = source_stat(file_path)
+            stat = (st.st_size, st.st_mtime_ns)
+        except OSError:
+            stat = None
+        row = self._conn.execute("SELECT size, mtime_ns FROM files WHERE path = ?", (file_path,)).fetchone()
+        if row is not None and tuple(row) != stat:
+            # Its records are checked again as they come, from the current content
+            self._conn.execute("DELETE FROM invoices WHERE path = ?", (file_path,))
+        if stat is None:
+            self._conn.execute("DELETE FROM files WHERE path = ?", (file_path,))
+            return False
+        if tuple(row or ()) != stat:
+            self._conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)", (file_path,) + stat)
+        self._stats[file_path] = stat
+        return True
+
+    def _mtime(self, file_path: str) -> int:
+        self._refresh(file_path)
+        return self._stats[file_path][1]
+
+    def _owner(self, digest: bytes) -> Optional[Tuple[str, int, int]]:
+        """(path, mtime_ns, run) owning a key, or None when it was never indexed."""
+        if self.bloom is not None and digest not in self.bloom:
+            return None
+        self.lookups += 1
+        return self._conn.execute(
+            "SELECT path, mtime_ns, run FROM invoices WHERE key = ?", (digest,)).fetchone()
+
+    def _own(self, digest: bytes, file_path: str, new: bool):
+        self._conn.execute("INSERT OR REPLACE INTO invoices VALUES (?, ?, ?, ?)",
+                           (digest, file_path, self._mtime(file_path), self._run))
+        if new:
+            self._inserted += 1
+            if self.bloom is not None:
+                self.bloom.add(digest)
+
+    def _duplicate(self, digest: bytes, key: tuple, file_path: str, kept: bool):
+        self.duplicates += 1
+        self._conn.execute("INSERT INTO duplicates VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           (digest,) + key + (file_path, int(kept)))
+
+    def check(self, file_path: str, values: tuple) -> Optional[bool]:
+        """Index one record and tell whether it is kept: True, False, or None when the
+        policy defers the decision to the end of the run (newest-wins)."""
+        self.checked += 1
+        self._refresh(file_path)
+        key = invoice_key(values)
+        digest = key_digest(key)
+        owner = self._owner(digest)
+        if owner is not None and owner[2] != self._run and owner[0] != file_path:
+            # A claim from an earlier run holds only while its file is unchanged
+            if not self._refresh(owner[0]):
+                log.info(f"{owner[0]} is gone: {file_path} now owns its invoice {key[1]}")
+            owner = self._owner(digest)
+        if owner is None:
+            self._own(digest, file_path, True)
+            return None if self.policy == 'newest-wins' else True
+        path, mtime_ns, run = owner
+        if run != self._run and path == file_path:
+            # Owned by this very file in an earlier run
+            self._own(digest, file_path, False)
+            return None if self.policy == 'newest-wins' else True
+        if self.policy == 'report-only':
+            self._duplicate(digest, key, file_path, True)
+            return True
+        if self.policy == 'newest-wins' and self._mtime(file_path) > mtime_ns:
+            # The copy held so far in this run loses; it is reported under the key's final owner
+            self.duplicates += self._conn.execute(
+                "INSERT INTO duplicates SELECT key, ?, ?, ?, ?, path, 0 FROM pending WHERE key = ?",
+                key + (digest,)).rowcount
+            self._own(digest, file_path, False)
+            return None
+        self._duplicate(digest, key, file_path, False)
+        return False
+
+    def filter(self, records: Iterable[Tuple[str, List[tuple]]]) -> Iterator[Tuple[str, List[tuple]]]:
+        """Drop the duplicates from (file path, fattura tuples) results, as iter_folder_records yields them.
+
+        first-wins and report-only stream; newest-wins can only tell the winners once
+        every file was seen, so it keeps them on disk and yields them at the end.
+        """
+        if self.policy != 'newest-wins':
+            for file_path, values in records:
+                kept = [v for v in values if self.check(file_path, v)]
+                if kept:
+                    self._keep(file_path, kept)
+                    yield file_path, kept
+            return
+
+        # The pending winners are (key, seq, path, index of the record in the file), and
+        # the records of the files holding any are spilled to a temporary table
+        self._conn.execute("CREATE TEMP TABLE IF NOT EXISTS spill (path TEXT PRIMARY KEY, seq INTEGER, "
+                           "payload TEXT NOT NULL)")
+        seq = 0
+        for file_path, values in records:
+            held = False
+            for i, v in enumerate(values):
+                if self.check(file_path, v) is None:
+                    self._conn.execute("INSERT OR REPLACE INTO pending VALUES (?, ?, ?, ?)",
+                                       (key_digest(invoice_key(v)), seq, file_path, i))
+                    held = True
+            if held:
+                self._conn.execute("INSERT INTO spill VALUES (?, ?, ?)",
+                                   (file_path, seq, json.dumps(values, separators=(',', ':'))))
+                seq += 1
+        rows = self._conn.execute(
+            "SELECT s.path, s.payload, group_concat(p.record_index) FROM spill s "
+            "JOIN pending p ON p.path = s.path GROUP BY s.path ORDER BY s.seq").fetchall()
+        self._conn.execute("DELETE FROM spill")
+        self._conn.execute("DELETE FROM pending")
+        for file_path, payload, indexes in rows:
+            # Lists where tuples were, as with the records of the parse cache
+            values = json.loads(payload)
+            kept = [values[i] for i in sorted(map(int, indexes.split(',')))]
+            self._keep(file_path, kept)
+            yield file_path, kept
+
+    def _keep(self, file_path: str, values: List[tuple]):
+        if self.kept is not None:
+            self.kept.update((file_path, v[0], datetime.date.fromordinal(v[4]), v[5]) for v in values)
+
+    def report_rows(self) -> Iterator[tuple]:
+        """REPORT_COLUMNS rows of the duplicates found in this run, with the copy kept."""
+        rows = self._conn.execute(
+            "SELECT d.cedente, d.numero, d.data, d.tipo_documento, d.path, i.path, d.kept "
+            "FROM duplicates d JOIN invoices i ON i.key = d.key ORDER BY d.rowid")
+        for cedente, numero, data, tipo_documento, file_path, originale, kept in rows:
+            yield (cedente, numero, datetime.date.fromordinal(data), tipo_documento or None, file_path,
+                   originale, 'segnalata' if kept else 'scartata')
+
+    def write_report(self, report_file: str) -> int:
+        """Write the duplicate report (.csv, .jsonl, .parquet or .arrow); return its rows."""
+        from xml_invoice_sinks import open_sink
+        with open_sink(report_file, REPORT_COLUMNS) as sink:
+            sink.write_rows(self.report_rows())
+        return self.duplicates
+
+    def close(self):
+        if self.bloom is not None and self.bloom.count <= self.bloom.capacity:
+            self._conn.execute("DELETE FROM bloom")
+            self._conn.execute("INSERT INTO bloom VALUES (?, ?, ?, ?)",
+                               (self.bloom.capacity, self.bloom.error_rate, self.bloom.count,
+                                bytes(self.bloom.bits)))
+        elif self._inserted:
+            # Overfilled, or keys added without it: rebuild on next open
+            self._conn.execute("DELETE FROM bloom")
+        self._conn.commit()
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+def main(folder_path: str, policy: str = 'report-only', index_file: str = DEFAULT_DEDUP_FILE,
+         report_file: str = DEFAULT_REPORT_FILE, workers: int = 1, bloom: bool = True):
+    """Index every invoice of the folder and report its duplicates."""
+    from xml_invoice_processor import iter_folder_records
+    with DuplicateIndex(index_file, policy, bloom) as index:
+        kept = sum(len(values) for _, values in
+                   iter_folder_records(folder_path, datetime.date.min, datetime.date.max,
+                                       workers=workers, dedup=index))
+        index.write_report(report_file)
+        print(f"Checked {index.checked} invoices ({index.lookups} index lookups): "
+              f"{index.duplicates} duplicates, {kept} kept ({policy})")
+        print(f"Duplicate report written to {report_file}")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Find the invoices found more than once in a folder, or since earlier runs.")
+    parser.add_argument("folder_path", help="folder of invoices, or a .zip archive of them")
+    parser.add_argument("--policy", choices=POLICIES, default='report-only',
+                        help="copy kept among duplicates (default report-only: keep all)")
+    parser.add_argument("--index", default=DEFAULT_DEDUP_FILE,
+                        help=f"persistent invoice index (default {DEFAULT_DEDUP_FILE})")
+    parser.add_argument("--report", default=DEFAULT_REPORT_FILE,
+                        help=f"duplicate report; .csv, .jsonl, .parquet or .arrow (default {DEFAULT_REPORT_FILE})")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of parser processes (0 = one per CPU, default 1)")
+    parser.add_argument("--no-bloom", action="store_true",
+                        help="look every invoice up in the index, without the Bloom filter")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default='off',
+                        help="per-file log on stderr (default off)")
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+    main(args.folder_path, args.policy, args.index, args.report, args.workers, not args.no_bloom)
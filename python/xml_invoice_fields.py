@@ -0,0 +1,328 @@
+import datetime
+import functools
+import hashlib
+import json
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from xml_invoice_amounts import AMOUNT_SCALE, MAX_SCALE, amount_kind, parse_amount
+from xml_invoice_backend import get_backend
+
+BODY_TAG = 'FatturaElettronicaBody'
+_HEADER_TAG = 'FatturaElettronicaHeader'
+_DOCUMENTO = (BODY_TAG, 'DatiGenerali', 'DatiGeneraliDocumento')
+# The last child of a body in the schema: nothing read from the body can follow it
+_LAST_BODY_CHILD = 'Allegati'
+
+# Field types, named like the sink column kinds they map to
+FIELD_TYPES = ['str', 'int', 'date', 'amount']
+CARDINALITIES = ['one', 'many']
+
+@dataclass(frozen=True)
+class FieldSpec:
+    """One value read from each invoice body.
+
+    `path` is relative to the document root; fields under FatturaElettronicaBody are
+    read per body, the others once per file. A 'one' field follows the first element
+    of each step (like Element.find), a 'many' field every repeated element: its
+    amounts are summed and other values joined with '; '. Amounts are integer units
+    of 10**-scale.
+
+    `group` (a prefix of `path` naming a repeated element) reads the field once per
+    occurrence of that element instead: stream_bodies collects one record dict per
+    occurrence, under the element's tag (see stream_bodies).
+    """
+    name: str
+    path: Tuple[str, ...]
+    type: str = 'str'
+    required: bool = False
+    cardinality: str = 'one'
+    scale: int = AMOUNT_SCALE
+    group: Tuple[str, ...] = ()
+
+    @property
+    def column_kind(self) -> str:
+        """Sink column kind of the extracted value."""
+        if self.type == 'amount':
+            return amount_kind(self.scale)
+        if self.cardinality == 'many':
+            return 'str'
+        return self.type
+
+# Columns that can be requested by name in a fields config
+KNOWN_FIELDS = {spec.name: spec for spec in [
+    FieldSpec('tipo_documento', _DOCUMENTO + ('TipoDocumento',)),
+    FieldSpec('importo_totale_documento', _DOCUMENTO + ('ImportoTotaleDocumento',), 'amount'),
+    FieldSpec('arrotondamento', _DOCUMENTO + ('Arrotondamento',), 'amount'),
+    FieldSpec('causale', _DOCUMENTO + ('Causale',), cardinality='many'),
+    FieldSpec('codice_destinatario', (_HEADER_TAG, 'DatiTrasmissione', 'CodiceDestinatario')),
+    FieldSpec('pec_destinatario', (_HEADER_TAG, 'DatiTrasmissione', 'PECDestinatario')),
+    FieldSpec('progressivo_invio', (_HEADER_TAG, 'DatiTrasmissione', 'ProgressivoInvio')),
+    FieldSpec('cessionario_id_fiscale',
+              (_HEADER_TAG, 'CessionarioCommittente', 'DatiAnagrafici', 'IdFiscaleIVA', 'IdCodice')),
+    FieldSpec('cessionario_codice_fiscale',
+              (_HEADER_TAG, 'CessionarioCommittente', 'DatiAnagrafici', 'CodiceFiscale')),
+    FieldSpec('cessionario_denominazione',
+              (_HEADER_TAG, 'CessionarioCommittente', 'DatiAnagrafici', 'Anagrafica', 'Denominazione')),
+    FieldSpec('imponibile', (BODY_TAG, 'DatiBeniServizi', 'DatiRiepilogo', 'ImponibileImporto'),
+              'amount', cardinality='many'),
+    FieldSpec('imposta', (BODY_TAG, 'DatiBeniServizi', 'DatiRiepilogo', 'Imposta'),
+              'amount', cardinality='many'),
+]}
+
+def field_from_config(entry) -> FieldSpec:
+    """Build a FieldSpec from a config entry: a KNOWN_FIELDS name or a dict.
+
+    Dicts take name, path ("A/B/C"), and optionally type, required, cardinality
+    and scale (decimals kept by an amount, default 2).
+    """
+    if isinstance(entry, str):
+        if entry not in KNOWN_FIELDS:
+            raise ValueError(f"Unknown field {entry}: use one of {', '.join(KNOWN_FIELDS)} or give its path")
+        return KNOWN_FIELDS[entry]
+    unknown = set(entry) - {'name', 'path', 'type', 'required', 'cardinality', 'scale'}
+    if unknown:
+        raise ValueError(f"Unknown field settings: {', '.join(sorted(unknown))}")
+    if 'name' not in entry or 'path' not in entry:
+        raise ValueError("Every field needs a name and a path")
+    spec = FieldSpec(name=entry['name'], path=tuple(p for p in entry['path'].split('/') if p),
+                     type=entry.get('type', 'str'), required=bool(entry.get('required', False)),
+                     cardinality=entry.get('cardinality', 'one'), scale=entry.get('scale', AMOUNT_SCALE))
+    if spec.type not in FIELD_TYPES:
+        raise ValueError(f"Field {spec.name}: type must be one of {', '.join(FIELD_TYPES)}")
+    if spec.cardinality not in CARDINALITIES:
+        raise ValueError(f"Field {spec.name}: cardinality must be one of {', '.join(CARDINALITIES)}")
+    if not isinstance(spec.scale, int) or not 0 <= spec.scale <= MAX_SCALE:
+        raise ValueError(f"Field {spec.name}: scale must be an integer from 0 to {MAX_SCALE}")
+    if not spec.path:
+        raise ValueError(f"Field {spec.name}: empty path")
+    return spec
+
+def load_fields(config_file: str) -> List[FieldSpec]:
+    """Read the extra output columns from a JSON config: {"fields": [entry, ...]}."""
+    with open(config_file, encoding='utf-8') as f:
+        config = json.load(f)
+    entries = config.get('fields', []) if isinstance(config, dict) else config
+    fields = [field_from_config(entry) for entry in entries]
+    names = [spec.name for spec in fields]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate field names in {config_file}: {', '.join(duplicates)}")
+    return fields
+
+def fields_version(fields: Sequence[FieldSpec]) -> str:
+    """Short fingerprint of a field list, to key cached extraction results."""
+    return hashlib.sha1(repr(tuple(fields)).encode('utf-8')).hexdigest()[:12]
+
+# --- Compiled plan and the single-pass extractor ------------------------------------------
+
+class PlanNode:
+    """Node of the path trie walked by stream_bodies."""
+    __slots__ = ('path', 'children', 'fields', 'many', 'group', 'stream')
+
+    def __init__(self, path: tuple):
+        self.path = path
+        self.children: Dict[str, 'PlanNode'] = {}
+        # (name, many, grouped) of the fields ending here
+        self.fields: List[Tuple[str, bool, bool]] = []
+        # Repeated elements are followed only when a 'many' or grouped field runs through them
+        self.many = False
+        # Every occurrence of a group element gets its own record of the grouped fields
+        self.group = False
+        # Records of a streamed group are handed out as they end instead of being kept
+        self.stream = False
+
+@functools.lru_cache(maxsize=32)
+def compile_plan(fields: Tuple[FieldSpec, ...], streamed: Tuple[Tuple[str, ...], ...] = ()) -> PlanNode:
+    """Merge the field paths into one trie; the result is cached per field tuple.
+
+    `streamed` lists the group paths whose records stream_records yields one by one.
+    """
+    root = PlanNode(())
+    for spec in fields:
+        many = spec.cardinality == 'many'
+        if spec.group and (spec.path[:len(spec.group)] != spec.group or len(spec.group) == len(spec.path)
+                           or spec.group == (BODY_TAG,)):
+            raise ValueError(f"Field {spec.name}: group must be a parent element of its path")
+        node = root
+        for depth, tag in enumerate(spec.path, 1):
+            node = node.children.setdefault(tag, PlanNode(spec.path[:depth]))
+            node.many = node.many or many or depth <= len(spec.group)
+            if depth == len(spec.group):
+                node.group = True
+        node.fields.append((spec.name, many, bool(spec.group)))
+    for spec in fields:
+        # A grouped field lands in the record of the innermost group above it
+        depth, node = 0, root
+        for i, tag in enumerate(spec.path[:-1], 1):
+            node = node.children[tag]
+            if node.group:
+                depth = i
+        if spec.group and depth != len(spec.group):
+            raise ValueError(f"Field {spec.name}: {'/'.join(spec.path[:depth])} is a nearer group")
+    for path in streamed:
+        node = root
+        for tag in path:
+            node = node.children.get(tag)
+            if node is None:
+                break
+        if node is None or not node.group:
+            raise ValueError(f"{'/'.join(path)} is not the group of any field")
+        node.stream = True
+    return root
+
+def stream_bodies(source, plan: PlanNode, header_values: dict, header_seen: set,
+                  backend: Optional[str] = None) -> Iterator[Tuple[dict, set]]:
+    """Run one iterparse pass over source, yielding (values, seen) for every body.
+
+    See _stream for how values are collected.
+    """
+    for event, values, seen in _stream(source, plan, header_values, header_seen, backend):
+        if event == 'body':
+            yield values, seen
+
+def stream_records(source, plan: PlanNode, header_values: dict,
+                   backend: Optional[str] = None) -> Iterator[Tuple[str, dict, dict]]:
+    """Yield ('record', record, body values) for every record of a streamed group as
+    it ends, and ('body', body values, seen) for every body.
+
+    The body values hold the fields read so far, which include everything before
+    the record in document order. Nothing is accumulated across records, so an
+    invoice with any number of them is read in constant memory.
+    """
+    return _stream(source, plan, header_values, set(), backend)
+
+def _stream(source, plan: PlanNode, header_values: dict, header_seen: set,
+            backend: Optional[str] = None) -> Iterator[Tuple[str, dict, object]]:
+    """The iterparse pass shared by stream_bodies and stream_records.
+
+    Fields outside FatturaElettronicaBody are collected once into header_values.
+    Like Element.find, only the first element with a given tag under its parent is
+    followed for 'one' fields, except that every body starts a fresh scope; 'many'
+    fields collect a list of every match. Each occurrence of a group element also
+    starts a fresh scope: its grouped fields go into a record dict, appended to the
+    list under the element's tag in the enclosing record (or in the body values);
+    records of streamed groups are yielded as they end instead. `seen` collects the plan paths that were opened, so callers can tell which
+    container was missing. Finished elements are detached to keep memory flat.
+    `backend` names the parser (default: lxml if installed).
+
+    The children of a body come in schema order, so a body is yielded as soon as a
+    child outside the plan starts after every planned child was opened, and at the
+    latest when Allegati starts: a consumer that stops there never reads the lines
+    or attachments that follow.
+    """
+    # One frame per open element: (plan node or None, tags seen among its children,
+    # values, seen, whether it is the first of its tag all the way up, the innermost
+    # group record, and the same first flag counted from that group)
+    frames = []
+    elements = []
+    for event, elem in get_backend(backend).iterparse(source):
+        if event == 'start':
+            if not frames:
+                frames.append((plan, set(), header_values, header_seen, True, None, True))
+                elements.append(elem)
+                continue
+            parent_node, siblings, values, seen, first, record, record_first = frames[-1]
+            node = None
+            tag = elem.tag
+            if parent_node is plan and tag == BODY_TAG:
+                node = plan.children.get(tag)
+                values, seen, first, record = {}, set(), True, None
+            elif parent_node is not None:
+                node = parent_node.children.get(tag)
+                if node is not None and tag in siblings:
+                    first = record_first = False
+                    if not node.many:
+                        node = None
+                if (node is None and parent_node.path == (BODY_TAG,)
+                        and (tag == _LAST_BODY_CHILD
+                             or all(child.path in seen for child in parent_node.children.values()))):
+                    # Nothing more to read from this body: hand it out now, not at its end
+                    frames[-1] = (None,) + frames[-1][1:]
+                    yield 'body', values, seen
+            if node is not None:
+                seen.add(node.path)
+                if node.group:
+                    record, record_first = {}, True
+            siblings.add(tag)
+            frames.append((node, set(), values, seen, first, record, record_first))
+            elements.append(elem)
+        else:
+            node, _, values, seen, first, record, record_first = frames.pop()
+            elements.pop()
+            if node is not None:
+                for name, many, grouped in node.fields:
+                    target = record if grouped else values
+                    if many:
+                        target.setdefault(name, []).append(elem.text)
+                    elif record_first if grouped else first:
+                        target[name] = elem.text
+                if node.stream:
+                    yield 'record', record, values
+                elif node.group:
+                    parent = frames[-1]
+                    outer = parent[5] if parent[5] is not None else parent[2]
+                    outer.setdefault(elem.tag, []).append(record)
+                if node.path == (BODY_TAG,):
+                    yield 'body', values, seen
+            elem.clear()
+            if elements:
+                elements[-1].remove(elem)
+
+# --- Typed values ----------------------------------------------------------------------------
+
+@functools.lru_cache(maxsize=4096)
+def _parse_date(text: str) -> datetime.date:
+    # strptime is slow and the same few dates repeat across lines and invoices
+    return datetime.datetime.strptime(text.strip(), '%Y-%m-%d').date()
+
+def _convert(spec: FieldSpec, text: str):
+    if spec.type == 'date':
+        return _parse_date(text)
+    if spec.type == 'amount':
+        return parse_amount(text, spec.scale)
+    if spec.type == 'int':
+        return int(text)
+    return text
+
+def field_value(spec: FieldSpec, values: dict, header_values: dict):
+    """Typed value of a field from the dicts filled by stream_bodies (None when absent)."""
+    raw = values.get(spec.name, header_values.get(spec.name))
+    if raw is None or raw == []:
+        if spec.required:
+            raise ValueError(f"{'/'.join(spec.path)} not found")
+        return None
+    if spec.cardinality == 'one':
+        return _convert(spec, raw)
+    items = [_convert(spec, text) for text in raw if text is not None]
+    if spec.type == 'amount':
+        return sum(items)
+    return '; '.join(str(item) for item in items)
+
+def encode_value(spec: FieldSpec, value):
+    """JSON-friendly form of a value for records and the parse cache (dates as ordinals)."""
+    if value is not None and spec.column_kind == 'date':
+        return value.toordinal()
+    return value
+
+def decode_value(spec: FieldSpec, value):
+    if value is not None and spec.column_kind == 'date':
+        return datetime.date.fromordinal(value)
+    return value
+
+def extract_records(source, fields: Sequence[FieldSpec],
+                    backend: Optional[str] = None) -> Iterator[Dict[str, object]]:
+    """Yield {field name: typed value} for every body of an invoice, in one parse."""
+    fields = tuple(fields)
+    header_values, header_seen = {}, set()
+    for values, _ in stream_bodies(source, compile_plan(fields), header_values, header_seen, backend):
+        yield {spec.name: field_value(spec, values, header_values) for spec in fields}
+
+def extract_record(source, fields: Sequence[FieldSpec],
+                   backend: Optional[str] = None) -> Optional[Dict[str, object]]:
+    """The record of the first body, or None for an invoice without bodies."""
+    records = extract_records(source, fields, backend)
+    try:
+        return next(records, None)
+    finally:
+        records.close()
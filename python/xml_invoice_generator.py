@@ -0,0 +1,261 @@
+import base64
+import datetime
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import List, Tuple
+from xml.sax.saxutils import escape
+
+# Files per subfolder, so a million-file corpus does not end up in a single directory
+FILES_PER_FOLDER = 1000
+
+_NAMES = ['ALPHA', 'BETA', 'GAMMA', 'DELTA', 'EPSILON', 'ZETA', 'ETA', 'THETA', 'IOTA', 'KAPPA',
+          'LAMBDA', 'SIGMA', 'OMEGA', 'ROSSI', 'BIANCHI', 'VERDI', 'FERRARI', 'COLOMBO', 'RICCI', 'GALLI']
+_FORMS = ['SRL', 'SPA', 'SNC', 'SAS', "SOCIETA' COOPERATIVA"]
+_CITIES = [('SASSARI', 'SS', '07100'), ('ROMA', 'RM', '00145'), ('MILANO', 'MI', '20121'),
+           ('TORINO', 'TO', '10121'), ('NAPOLI', 'NA', '80121'), ('BOLOGNA', 'BO', '40121')]
+_REGIMI = ['RF01', 'RF01', 'RF01', 'RF02', 'RF04', 'RF19']
+_ALIQUOTE = [22, 22, 22, 10, 5, 4]
+_DESCRIZIONI = ['FORNITURE VARIE PER UFFICIO', 'SERVIZIO DI MANUTENZIONE ORDINARIA',
+                'CANONE MENSILE DI ASSISTENZA', 'MATERIALE DI CONSUMO', 'CONSULENZA TECNICA',
+                "LA DESCRIZIONE DELLA FORNITURA PUO' SUPERARE I CENTO CARATTERI CHE RAPPRESENTAVANO "
+                "IL PRECEDENTE LIMITE DIMENSIONALE. TALE LIMITE NELLA NUOVA VERSIONE E' STATO PORTATO "
+                "A MILLE CARATTERI"]
+
+@dataclass
+class GeneratorOptions:
+    """Shape of the synthetic corpus; every file is derived from seed + its index."""
+    suppliers: int = 200
+    min_lines: int = 1
+    max_lines: int = 10
+    lotto_ratio: float = 0.1
+    max_bodies: int = 5
+    attachment_ratio: float = 0.0
+    attachment_kb: int = 64
+    installment_ratio: float = 0.0
+    max_installments: int = 6
+    start_date: datetime.date = datetime.date(2023, 1, 1)
+    days: int = 730
+    seed: int = 0
+
+def _supplier(options: GeneratorOptions, index: int) -> Tuple[str, str, str, Tuple[str, str, str]]:
+    """Return (IdCodice, Denominazione, RegimeFiscale, sede) of the index-th supplier."""
+    rnd = random.Random(f"{options.seed}-supplier-{index}")
+    name = f"{rnd.choice(_NAMES)} {rnd.choice(_NAMES)} {rnd.choice(_FORMS)}"
+    return f"{10000000000 + index * 7919:011d}", name, rnd.choice(_REGIMI), rnd.choice(_CITIES)
+
+def _amount(cents: int) -> str:
+    return f"{cents // 100}.{cents % 100:02d}"
+
+def _pagamento(rnd: random.Random, options: GeneratorOptions, scadenza: datetime.date, totale: int) -> str:
+    """DatiPagamento: one payment in full, or monthly installments after an optional deposit."""
+    def dettaglio(data: datetime.date, cents: int) -> str:
+        return (
+            "      <DettaglioPagamento>\n"
+            "        <ModalitaPagamento>MP05</ModalitaPagamento>\n"
+            f"        <DataScadenzaPagamento>{data.isoformat()}</DataScadenzaPagamento>\n"
+            f"        <ImportoPagamento>{_amount(cents)}</ImportoPagamento>\n"
+            "      </DettaglioPagamento>\n")
+
+    if not options.installment_ratio or rnd.random() >= options.installment_ratio:
+        return ("    <DatiPagamento>\n"
+                "      <CondizioniPagamento>TP02</CondizioniPagamento>\n"
+                f"{dettaglio(scadenza, totale)}"
+                "    </DatiPagamento>\n")
+    blocks = ''
+    if rnd.random() < 0.3:
+        anticipo = totale // 5
+        totale -= anticipo
+        blocks += ("    <DatiPagamento>\n"
+                   "      <CondizioniPagamento>TP03</CondizioniPagamento>\n"
+                   f"{dettaglio(scadenza, anticipo)}"
+                   "    </DatiPagamento>\n")
+    rate = rnd.randint(2, max(2, options.max_installments))
+    details = ''
+    for numero_rata in range(rate):
+        # The last installment takes the remainder of the division
+        cents = totale // rate if numero_rata < rate - 1 else totale - totale // rate * (rate - 1)
+        details += dettaglio(scadenza + datetime.timedelta(days=30 * (numero_rata + 1)), cents)
+    return (f"{blocks}"
+            "    <DatiPagamento>\n"
+            "      <CondizioniPagamento>TP01</CondizioniPagamento>\n"
+            f"{details}"
+            "    </DatiPagamento>\n")
+
+def _body(rnd: random.Random, options: GeneratorOptions, numero: str) -> str:
+    data = options.start_date + datetime.timedelta(days=rnd.randrange(options.days))
+    scadenza = data + datetime.timedelta(days=rnd.choice([0, 30, 60, 90]))
+    aliquota = rnd.choice(_ALIQUOTE)
+    lines = []
+    imponibile = 0
+    for numero_linea in range(1, rnd.randint(options.min_lines, options.max_lines) + 1):
+        quantita = rnd.randint(1, 50)
+        prezzo = rnd.randint(50, 50000)
+        totale = quantita * prezzo
+        imponibile += totale
+        lines.append(
+            "      <DettaglioLinee>\n"
+            f"        <NumeroLinea>{numero_linea}</NumeroLinea>\n"
+            f"        <Descrizione>{escape(rnd.choice(_DESCRIZIONI))}</Descrizione>\n"
+            f"        <Quantita>{quantita}.00</Quantita>\n"
+            f"        <PrezzoUnitario>{_amount(prezzo)}</PrezzoUnitario>\n"
+            f"        <PrezzoTotale>{_amount(totale)}</PrezzoTotale>\n"
+            f"        <AliquotaIVA>{aliquota}.00</AliquotaIVA>\n"
+            "      </DettaglioLinee>\n")
+    imposta = round(imponibile * aliquota / 100)
+    allegati = ''
+    if rnd.random() < options.attachment_ratio:
+        nome = 'allegato-' + numero.replace('/', '-') + '.pdf'
+        payload = rnd.getrandbits(options.attachment_kb * 8192).to_bytes(options.attachment_kb * 1024, 'little')
+        allegati = (
+            "    <Allegati>\n"
+            f"      <NomeAttachment>{nome}</NomeAttachment>\n"
+            "      <FormatoAttachment>PDF</FormatoAttachment>\n"
+            f"      <Attachment>{base64.b64encode(payload).decode('ascii')}</Attachment>\n"
+            "    </Allegati>\n")
+    pagamento = _pagamento(rnd, options, scadenza, imponibile + imposta)
+    return (
+        "  <FatturaElettronicaBody>\n"
+        "    <DatiGenerali>\n"
+        "      <DatiGeneraliDocumento>\n"
+        "        <TipoDocumento>TD01</TipoDocumento>\n"
+        "        <Divisa>EUR</Divisa>\n"
+        f"        <Data>{data.isoformat()}</Data>\n"
+        f"        <Numero>{numero}</Numero>\n"
+        "      </DatiGeneraliDocumento>\n"
+        "    </DatiGenerali>\n"
+        "    <DatiBeniServizi>\n"
+        f"{''.join(lines)}"
+        "      <DatiRiepilogo>\n"
+        f"        <AliquotaIVA>{aliquota}.00</AliquotaIVA>\n"
+        f"        <ImponibileImporto>{_amount(imponibile)}</ImponibileImporto>\n"
+        f"        <Imposta>{_amount(imposta)}</Imposta>\n"
+        "        <EsigibilitaIVA>I</EsigibilitaIVA>\n"
+        "      </DatiRiepilogo>\n"
+        "    </DatiBeniServizi>\n"
+        f"{pagamento}"
+        f"{allegati}"
+        "  </FatturaElettronicaBody>\n")
+
+def generate_fattura(options: GeneratorOptions, index: int) -> Tuple[str, str]:
+    """Build the index-th document: return (file name, XML text)."""
+    rnd = random.Random(f"{options.seed}-{index}")
+    id_codice, denominazione, regime, (comune, provincia, cap) = _supplier(
+        options, rnd.randrange(options.suppliers))
+    bodies = 1
+    if rnd.random() < options.lotto_ratio:
+        bodies = rnd.randint(2, max(2, options.max_bodies))
+    progressivo = f"{index + 1:05d}"[-5:]
+    header = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<p:FatturaElettronica versione="FPA12" xmlns:ds="http://www.w3.org/2000/09/xmldsig#" '
+        'xmlns:p="http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2" '
+        'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">\n'
+        "  <FatturaElettronicaHeader>\n"
+        "    <DatiTrasmissione>\n"
+        "      <IdTrasmittente>\n"
+        "        <IdPaese>IT</IdPaese>\n"
+        f"        <IdCodice>{id_codice}</IdCodice>\n"
+        "      </IdTrasmittente>\n"
+        f"      <ProgressivoInvio>{progressivo}</ProgressivoInvio>\n"
+        "      <FormatoTrasmissione>FPA12</FormatoTrasmissione>\n"
+        "      <CodiceDestinatario>AAAAAA</CodiceDestinatario>\n"
+        "    </DatiTrasmissione>\n"
+        "    <CedentePrestatore>\n"
+        "      <DatiAnagrafici>\n"
+        "        <IdFiscaleIVA>\n"
+        "          <IdPaese>IT</IdPaese>\n"
+        f"          <IdCodice>{id_codice}</IdCodice>\n"
+        "        </IdFiscaleIVA>\n"
+        "        <Anagrafica>\n"
+        f"          <Denominazione>{escape(denominazione)}</Denominazione>\n"
+        "        </Anagrafica>\n"
+        f"        <RegimeFiscale>{regime}</RegimeFiscale>\n"
+        "      </DatiAnagrafici>\n"
+        "      <Sede>\n"
+        "        <Indirizzo>VIALE ROMA 543</Indirizzo>\n"
+        f"        <CAP>{cap}</CAP>\n"
+        f"        <Comune>{comune}</Comune>\n"
+        f"        <Provincia>{provincia}</Provincia>\n"
+        "        <Nazione>IT</Nazione>\n"
+        "      </Sede>\n"
+        "    </CedentePrestatore>\n"
+        "    <CessionarioCommittente>\n"
+        "      <DatiAnagrafici>\n"
+        "        <CodiceFiscale>09876543210</CodiceFiscale>\n"
+        "        <Anagrafica>\n"
+        "          <Denominazione>AMMINISTRAZIONE BETA</Denominazione>\n"
+        "        </Anagrafica>\n"
+        "      </DatiAnagrafici>\n"
+        "      <Sede>\n"
+        "        <Indirizzo>VIA TORINO 38-B</Indirizzo>\n"
+        "        <CAP>00145</CAP>\n"
+        "        <Comune>ROMA</Comune>\n"
+        "        <Provincia>RM</Provincia>\n"
+        "        <Nazione>IT</Nazione>\n"
+        "      </Sede>\n"
+        "    </CessionarioCommittente>\n"
+        "  </FatturaElettronicaHeader>\n")
+    # Invoice numbers are unique across the corpus: <file number>/<body number>
+    body_xml = ''.join(_body(rnd, options, f"{index + 1}/{i + 1}") for i in range(bodies))
+    name = f"IT{id_codice}_{index:07d}.xml"
+    return name, header + body_xml + "</p:FatturaElettronica>\n"
+
+def _write_range(args: Tuple[str, GeneratorOptions, int, int]) -> int:
+    output_dir, options, start, stop = args
+    written = 0
+    for index in range(start, stop):
+        name, xml = generate_fattura(options, index)
+        folder = os.path.join(output_dir, f"{index // FILES_PER_FOLDER:04d}")
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, name), 'w', encoding='utf-8') as f:
+            f.write(xml)
+        written += len(xml.encode('utf-8'))
+    return written
+
+def generate_corpus(output_dir: str, files: int, options: GeneratorOptions = GeneratorOptions(),
+                    workers: int = 1) -> int:
+    """Write `files` synthetic invoices under output_dir; return the number of bytes written.
+
+    The same options and seed always produce the same corpus, whatever the worker count.
+    """
+    chunks: List[Tuple[str, GeneratorOptions, int, int]] = [
+        (output_dir, options, start, min(start + FILES_PER_FOLDER, files))
+        for start in range(0, files, FILES_PER_FOLDER)
+    ]
+    if workers == 1:
+        return sum(_write_range(chunk) for chunk in chunks)
+    with ProcessPoolExecutor(max_workers=workers or None) as executor:
+        return sum(executor.map(_write_range, chunks))
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Generate a synthetic FatturaPA 1.2 corpus.")
+    parser.add_argument("output_dir")
+    parser.add_argument("files", type=int, help="number of files to generate (e.g. 10000 to 1000000)")
+    parser.add_argument("--suppliers", type=int, default=200, help="distinct cedenti (default 200)")
+    parser.add_argument("--min-lines", type=int, default=1, help="minimum DettaglioLinee per body (default 1)")
+    parser.add_argument("--max-lines", type=int, default=10, help="maximum DettaglioLinee per body (default 10)")
+    parser.add_argument("--lotto-ratio", type=float, default=0.1,
+                        help="fraction of files that are lotti with several bodies (default 0.1)")
+    parser.add_argument("--max-bodies", type=int, default=5, help="maximum bodies per lotto (default 5)")
+    parser.add_argument("--attachment-ratio", type=float, default=0.0,
+                        help="fraction of bodies carrying an Allegati attachment (default 0)")
+    parser.add_argument("--attachment-kb", type=int, default=64, help="attachment size in KiB (default 64)")
+    parser.add_argument("--installment-ratio", type=float, default=0.0,
+                        help="fraction of bodies paid in monthly installments, some after a deposit (default 0)")
+    parser.add_argument("--max-installments", type=int, default=6,
+                        help="maximum installments per body (default 6)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of writer processes (0 = one per CPU, default 1)")
+    args = parser.parse_args()
+
+    options = GeneratorOptions(suppliers=args.suppliers, min_lines=args.min_lines, max_lines=args.max_lines,
+                               lotto_ratio=args.lotto_ratio, max_bodies=args.max_bodies,
+                               attachment_ratio=args.attachment_ratio, attachment_kb=args.attachment_kb,
+                               installment_ratio=args.installment_ratio,
+                               max_installments=args.max_installments, seed=args.seed)
+    total = generate_corpus(args.output_dir, args.files, options, workers=args.workers)
+    print(f"Generated {args.files} files ({total / 1e6:.1f} MB) in {args.output_dir}")
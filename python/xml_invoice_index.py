@@ -0,0 +1,151 @@
+import datetime
+import mmap
+import os
+import re
+import sqlite3
+from typing import Iterable, List, Optional
+
+from xml_invoice_p7m import is_p7m, open_invoice
+from xml_invoice_zip import is_member, source_stat
+
+# Kept in the working directory, next to the parse cache: the scanned folders are never
+# written to, and entries are keyed by file path, so one index serves every folder
+DEFAULT_INDEX_FILE = "fattura-pa-index.sqlite"
+
+# Nothing in FatturaElettronicaHeader is called <Data>, so the first one after each body
+# start is that body's FatturaElettronicaBody/DatiGenerali/DatiGeneraliDocumento/Data
+_DATA_RE = re.compile(rb'<(?:[\w.-]+:)?Data>\s*(\d{4}-\d{2}-\d{2})\s*</')
+_BODY_RE = re.compile(rb'<(?:[\w.-]+:)?FatturaElettronicaBody[\s>]')
+_PREFILTER_CHUNK = 16 * 1024
+_PREFILTER_LIMIT = 1024 * 1024
+
+def prefilter_dates(file_path: str) -> Optional[List[datetime.date]]:
+    """Return the invoice dates of a file without parsing it.
+
+    The file is read only up to its first <Data>; the rest is scanned through a
+    memory map for further FatturaElettronicaBody elements (lotti), whose own first
+    <Data> is added. Returns None when no date is found within the first megabyte,
+    in which case the file has to be parsed to know whether it is in range.
+    Archive members cannot be mapped and always return None.
+    """
+    if is_member(file_path):
+        return None
+    if is_p7m(file_path):
+        return _prefilter_p7m(file_path)
+    head = b''
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(_PREFILTER_CHUNK)
+            if not chunk:
+                return None
+            head += chunk
+            # Re-scan a short tail of the previous read so a tag split across reads still matches
+            match = _DATA_RE.search(head, max(0, len(head) - len(chunk) - 64))
+            if match:
+                break
+            if len(head) >= _PREFILTER_LIMIT:
+                return None
+
+        try:
+            dates = [datetime.date.fromisoformat(match.group(1).decode('ascii'))]
+            if os.fstat(f.fileno()).st_size > match.end():
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                    return _scan_bodies(view, match.end(), dates)
+        except ValueError:
+            return None
+    return dates
+
+def _scan_bodies(buf, pos: int, dates: List[datetime.date]) -> Optional[List[datetime.date]]:
+    """Add the first <Data> after each further body start found from pos on."""
+    for body in _BODY_RE.finditer(buf, pos):
+        data = _DATA_RE.search(buf, body.end())
+        if data is None:
+            return None
+        dates.append(datetime.date.fromisoformat(data.group(1).decode('ascii')))
+    return dates
+
+def _prefilter_p7m(file_path: str) -> Optional[List[datetime.date]]:
+    """prefilter_dates for signed files, scanning the payload in place when it is contiguous."""
+    try:
+        with open_invoice(file_path) as payload:
+            view = payload.contiguous()
+            if view is None:
+                # Chunked (BER) payloads may split a tag across chunks: leave them to the parser
+                return None
+            match = _DATA_RE.search(view, 0, _PREFILTER_LIMIT)
+            if match is None:
+                return None
+            dates = [datetime.date.fromisoformat(match.group(1).decode('ascii'))]
+            return _scan_bodies(view, match.end(), dates)
+    except ValueError:
+        return None
+
+class DateIndex:
+    """Persistent SQLite index mapping each file to its invoice dates.
+
+    Entries are valid while the file keeps the same size and mtime, which lets
+    process_folder prune out-of-range files with a stat call instead of a parse.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.pruned = 0
+        self._conn = sqlite3.connect(db_path, timeout=30)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                dates TEXT NOT NULL
+            );
+        """)
+        # Load the whole index once: it is small and each lookup then costs a stat only
+        self._entries = {
+            path: (size, mtime_ns, dates)
+            for path, size, mtime_ns, dates in self._conn.execute("SELECT * FROM files")
+        }
+
+    def lookup(self, file_path: str) -> Optional[List[datetime.date]]:
+        """Return the indexed dates of a file, or None if it is unknown or changed."""
+        entry = self._entries.get(file_path)
+        if entry is None:
+            return None
+        st = source_stat(file_path)
+        if entry[0] != st.st_size or entry[1] != st.st_mtime_ns:
+            return None
+        return [datetime.date.fromordinal(int(d)) for d in entry[2].split(',') if d]
+
+    def update(self, file_path: str, dates: Iterable[datetime.date]):
+        """Record the dates found in a file at its current size and mtime."""
+        st = source_stat(file_path)
+        encoded = ','.join(str(d.toordinal()) for d in dates)
+        entry = (st.st_size, st.st_mtime_ns, encoded)
+        if self._entries.get(file_path) != entry:
+            self._entries[file_path] = entry
+            self._conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (file_path,) + entry)
+
+    def may_match(self, file_path: str, start_date: datetime.date, end_date: datetime.date) -> bool:
+        """Tell whether a file can hold invoices in range, using the index or the prefilter.
+
+        Files that are neither indexed nor dated by the prefilter always match.
+        """
+        dates = self.lookup(file_path)
+        if dates is None:
+            dates = prefilter_dates(file_path)
+            if dates is None:
+                return True
+            self.update(file_path, dates)
+        if any(start_date <= d <= end_date for d in dates):
+            return True
+        self.pruned += 1
+        return False
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,131 @@
+import datetime
+import xml.etree.ElementTree as ET
+import zipfile
+import zlib
+from typing import Container, Iterable, Iterator, Optional, Tuple
+
+from xml_invoice_amounts import AMOUNT_SCALE
+from xml_invoice_fields import BODY_TAG, FieldSpec, compile_plan, field_value, stream_records
+from xml_invoice_metrics import LOG_LEVELS, configure_logging, log
+from xml_invoice_zip import open_source
+
+# Rows handed to the sink at a time; the Arrow sinks buffer them further into record batches
+DEFAULT_BATCH_SIZE = 4096
+
+_CEDENTE_PATH = ('FatturaElettronicaHeader', 'CedentePrestatore', 'DatiAnagrafici')
+_DOCUMENTO_PATH = (BODY_TAG, 'DatiGenerali', 'DatiGeneraliDocumento')
+_LINEE_PATH = (BODY_TAG, 'DatiBeniServizi', 'DettaglioLinee')
+
+# The key of the invoice each line belongs to; Data and Numero precede DatiBeniServizi
+KEY_FIELDS = (
+    FieldSpec('cedente_id_fiscale', _CEDENTE_PATH + ('IdFiscaleIVA', 'IdCodice'), required=True),
+    FieldSpec('data', _DOCUMENTO_PATH + ('Data',), 'date', required=True),
+    FieldSpec('numero', _DOCUMENTO_PATH + ('Numero',), required=True),
+)
+
+def _line(name: str, path: Tuple[str, ...], type: str = 'str', scale: int = AMOUNT_SCALE) -> FieldSpec:
+    return FieldSpec(name, _LINEE_PATH + path, type, scale=scale, group=_LINEE_PATH)
+
+# Quantities and prices keep the 8 decimals FatturaPA allows
+LINE_FIELDS = (
+    _line('numero_linea', ('NumeroLinea',), 'int'),
+    _line('tipo_cessione_prestazione', ('TipoCessionePrestazione',)),
+    _line('codice_articolo', ('CodiceArticolo', 'CodiceValore')),
+    _line('descrizione', ('Descrizione',)),
+    _line('quantita', ('Quantita',), 'amount', 8),
+    _line('unita_misura', ('UnitaMisura',)),
+    _line('data_inizio_periodo', ('DataInizioPeriodo',), 'date'),
+    _line('data_fine_periodo', ('DataFinePeriodo',), 'date'),
+    _line('prezzo_unitario', ('PrezzoUnitario',), 'amount', 8),
+    _line('prezzo_totale', ('PrezzoTotale',), 'amount', 8),
+    _line('aliquota_iva', ('AliquotaIVA',), 'amount'),
+    _line('natura', ('Natura',)),
+)
+
+LINE_COLUMNS = [(spec.name, spec.column_kind) for spec in KEY_FIELDS + LINE_FIELDS]
+
+def _plan():
+    return compile_plan(KEY_FIELDS + LINE_FIELDS, (_LINEE_PATH,))
+
+def iter_lines(source, start_date: Optional[datetime.date] = None, end_date: Optional[datetime.date] = None,
+               backend: Optional[str] = None) -> Iterator[tuple]:
+    """Yield one LINE_COLUMNS row per DettaglioLinee of an open invoice, as it is parsed.
+
+    Only the current line is held in memory, whatever the size of the invoice.
+    Lines of bodies dated outside start_date..end_date are skipped.
+    """
+    header_values = {}
+    body, key, in_range = None, None, False
+    for event, record, values in stream_records(source, _plan(), header_values, backend):
+        if event != 'record':
+            continue
+        if values is not body:
+            # First line of a body: its key is complete by now
+            body = values
+            key = tuple(field_value(spec, values, header_values) for spec in KEY_FIELDS)
+            in_range = ((start_date is None or key[1] >= start_date)
+                        and (end_date is None or key[1] <= end_date))
+        if in_range:
+            yield key + tuple(field_value(spec, record, {}) for spec in LINE_FIELDS)
+
+def export_lines(file_paths: Iterable[str], output_file: str, start_date: Optional[datetime.date] = None,
+                 end_date: Optional[datetime.date] = None, format_name: Optional[str] = None,
+                 batch_size: int = DEFAULT_BATCH_SIZE,
+                 invoices: Optional[Container[tuple]] = None) -> Tuple[int, int, int]:
+    """Stream the lines of every file into a sink, batch_size rows at a time.
+
+    Files are read one after the other in this process. A file that fails midway
+    keeps the lines written before the error. With invoices, only the lines of the
+    (file path, cedente_id_fiscale, data, numero) listed there are written, as
+    collected by xml_invoice_dedup.DuplicateIndex.kept.
+    Returns (lines, files with lines, errors).
+    """
+    from xml_invoice_sinks import open_sink
+    lines = files = errors = 0
+    with open_sink(output_file, LINE_COLUMNS, format_name) as sink:
+        for file_path in file_paths:
+            batch = []
+            found = 0
+            try:
+                with open_source(file_path) as f:
+                    for row in iter_lines(f, start_date, end_date):
+                        if invoices is not None and (file_path,) + row[:3] not in invoices:
+                            continue
+                        batch.append(row)
+                        if len(batch) >= batch_size:
+                            sink.write_rows(batch)
+                            found += len(batch)
+                            batch = []
+            except (ET.ParseError, AttributeError, ValueError, OSError, zipfile.BadZipFile, zlib.error) as e:
+                errors += 1
+                log.warning(f"Error reading the lines of {file_path}: {e}")
+            sink.write_rows(batch)
+            found += len(batch)
+            lines += found
+            files += 1 if found else 0
+    return lines, files, errors
+
+def main(folder_path: str, start_date_str: str, end_date_str: str, output_file: str):
+    """Export the lines of the invoices dated in the range found in the folder."""
+    from xml_invoice_processor import iter_xml_files, parse_date
+    lines, files, errors = export_lines(iter_xml_files(folder_path), output_file,
+                                        parse_date(start_date_str), parse_date(end_date_str))
+    if errors:
+        print(f"Errors: {errors} files could not be read in full")
+    print(f"Exported {lines} lines from {files} files to {output_file}")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Stream the DettaglioLinee of FatturaPA invoices to a data export, in constant memory.",
+        epilog="Dates should be in YYYY-MM-DD format")
+    parser.add_argument("folder_path", help="folder of invoices, or a .zip archive of them")
+    parser.add_argument("start_date")
+    parser.add_argument("end_date")
+    parser.add_argument("-o", "--output", required=True,
+                        help="output file; .csv[.gz], .jsonl[.gz], .parquet or .arrow")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default='off',
+                        help="per-file log on stderr (default off)")
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+    main(args.folder_path, args.start_date, args.end_date, args.output)
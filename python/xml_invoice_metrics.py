@@ -0,0 +1,152 @@
+import contextlib
+import heapq
+import json
+import logging
+import os
+import sys
+import time
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:  # Windows: peak RSS is not reported
+    resource = None
+
+# Per-file messages go to this logger; it stays silent unless configure_logging is called
+log = logging.getLogger("xml_invoice")
+log.addHandler(logging.NullHandler())
+
+LOG_LEVELS = ['off', 'error', 'warning', 'info', 'debug']
+
+def configure_logging(level: str = 'off'):
+    """Send the per-file log to stderr at the given level ('off' keeps it silent)."""
+    if level == 'off':
+        return
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+    log.addHandler(handler)
+    log.setLevel(level.upper())
+
+# Pipeline stages, in order
+STAGES = ['walk', 'read', 'parse', 'filter', 'aggregate', 'write']
+
+def peak_rss_mb() -> Optional[float]:
+    """Peak RSS so far of this process, or of its largest finished child if bigger.
+
+    None where the resource module is missing (Windows).
+    """
+    if resource is None:
+        return None
+    scale = 1 if sys.platform == 'darwin' else 1024  # ru_maxrss is bytes on macOS, KiB elsewhere
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) * scale / 1e6
+
+@dataclass
+class StageMetrics:
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    peak_rss_mb: Optional[float] = None
+    files: int = 0
+    bytes: int = 0
+
+class RunMetrics:
+    """Per-stage timings and counters for one run.
+
+    Stages done in worker processes (read, parse) are reported by the workers per
+    file, so their wall_seconds is summed over files rather than elapsed time.
+    """
+
+    def __init__(self, slowest: int = 10):
+        self.started = time.time()
+        self.finished: Optional[float] = None
+        self.stages: Dict[str, StageMetrics] = {name: StageMetrics() for name in STAGES}
+        self.errors: Dict[str, int] = {}
+        self.slowest = slowest
+        self._slowest: List[Tuple[float, str]] = []
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """Time the block as part of stage `name`; it may be entered several times."""
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield self.stages.setdefault(name, StageMetrics())
+        finally:
+            self.add(name, time.perf_counter() - wall, time.process_time() - cpu,
+                     peak_rss=peak_rss_mb())
+
+    def add(self, name: str, wall_seconds: float, cpu_seconds: float, files: int = 0,
+            nbytes: int = 0, peak_rss: Optional[float] = None):
+        stage = self.stages.setdefault(name, StageMetrics())
+        stage.wall_seconds += wall_seconds
+        stage.cpu_seconds += cpu_seconds
+        stage.files += files
+        stage.bytes += nbytes
+        if peak_rss is not None:
+            stage.peak_rss_mb = max(stage.peak_rss_mb or 0.0, peak_rss)
+
+    def record_file(self, file_path: str, seconds: float):
+        """Keep the `slowest` files seen so far."""
+        if len(self._slowest) < self.slowest:
+            heapq.heappush(self._slowest, (seconds, file_path))
+        elif seconds > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, (seconds, file_path))
+
+    def record_error(self, error_type: str):
+        self.errors[error_type] = self.errors.get(error_type, 0) + 1
+
+    def slowest_files(self) -> List[Tuple[str, float]]:
+        return [(path, seconds) for seconds, path in sorted(self._slowest, reverse=True)]
+
+    def finish(self):
+        self.finished = time.time()
+
+    def to_dict(self) -> dict:
+        finished = self.finished or time.time()
+        return {
+            'started': self.started,
+            'duration_seconds': finished - self.started,
+            'peak_rss_mb': peak_rss_mb(),
+            'stages': {name: asdict(stage) for name, stage in self.stages.items()},
+            'errors': dict(sorted(self.errors.items())),
+            'slowest_files': [{'path': path, 'seconds': seconds} for path, seconds in self.slowest_files()],
+        }
+
+    def write_json(self, path: str):
+        _write_atomic(path, json.dumps(self.to_dict(), indent=2) + '\n')
+
+    def write_prometheus(self, path: str):
+        """Write the metrics in the format read by node_exporter's textfile collector."""
+        report = self.to_dict()
+        lines = []
+
+        def metric(name: str, help_text: str, samples: List[Tuple[str, float]]):
+            lines.append(f"# HELP fattura_pa_{name} {help_text}")
+            lines.append(f"# TYPE fattura_pa_{name} gauge")
+            # Unknown values (peak RSS on Windows) are left out
+            lines.extend(f"fattura_pa_{name}{labels} {value!r}" for labels, value in samples if value is not None)
+
+        stages = report['stages']
+        metric('run_start_timestamp_seconds', "Start time of the last run.", [('', report['started'])])
+        metric('run_duration_seconds', "Duration of the last run.", [('', report['duration_seconds'])])
+        metric('run_peak_rss_bytes', "Peak resident memory of the last run.",
+               [('', report['peak_rss_mb'] and report['peak_rss_mb'] * 1e6)])
+        for key, name, help_text, scale in (
+                ('wall_seconds', 'stage_wall_seconds', "Wall time spent in each stage.", 1),
+                ('cpu_seconds', 'stage_cpu_seconds', "CPU time spent in each stage.", 1),
+                ('peak_rss_mb', 'stage_peak_rss_bytes', "Peak resident memory at the end of each stage.", 1e6),
+                ('files', 'stage_files', "Files handled by each stage.", 1),
+                ('bytes', 'stage_bytes', "Bytes handled by each stage.", 1)):
+            metric(name, help_text, [(f'{{stage="{stage}"}}', values[key] and values[key] * scale)
+                                     for stage, values in stages.items()])
+        metric('errors', "Files that failed, by exception type.",
+               [(f'{{type="{error_type}"}}', count) for error_type, count in report['errors'].items()])
+        _write_atomic(path, '\n'.join(lines) + '\n')
+
+def _write_atomic(path: str, text: str):
+    # Collectors may read at any time: never let them see a half-written file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
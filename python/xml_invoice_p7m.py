@@ -0,0 +1,356 @@
+import base64
+import contextlib
+import mmap
+import os
+import re
+import sqlite3
+from dataclasses import dataclass
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+DEFAULT_SIGNATURE_CACHE_FILE = "fattura-pa-signatures.sqlite"
+
+# Object identifiers of the CMS parts read here
+_OID_SIGNED_DATA = '1.2.840.113549.1.7.2'
+_OID_MESSAGE_DIGEST = '1.2.840.113549.1.9.4'
+_OID_RSASSA_PSS = '1.2.840.113549.1.1.10'
+_HASHES = {
+    '1.3.14.3.2.26': 'SHA1',
+    '2.16.840.1.101.3.4.2.1': 'SHA256',
+    '2.16.840.1.101.3.4.2.2': 'SHA384',
+    '2.16.840.1.101.3.4.2.3': 'SHA512',
+}
+
+_PEM_RE = re.compile(rb'-----(BEGIN|END)[^-]*-----')
+
+def is_p7m(file_path: str) -> bool:
+    return file_path.lower().endswith('.p7m')
+
+# --- Minimal BER/DER reader -------------------------------------------------------------
+
+class _Tlv(NamedTuple):
+    """One BER element of a buffer: tag byte and offsets of its header, content and successor."""
+    tag: int
+    offset: int
+    start: int
+    end: int
+    next: int
+
+def _read_tlv(buf, pos: int) -> _Tlv:
+    """Read the element at pos; indefinite lengths are resolved by walking the children."""
+    offset = pos
+    try:
+        tag = buf[pos]
+        if tag & 0x1f == 0x1f:
+            raise ValueError("Invalid p7m envelope: multi-byte tags are not used by CMS")
+        length = buf[pos + 1]
+        pos += 2
+        if length == 0x80:
+            if not tag & 0x20:
+                raise ValueError("Invalid p7m envelope: indefinite length on a primitive element")
+            child = pos
+            while buf[child] != 0 or buf[child + 1] != 0:
+                child = _read_tlv(buf, child).next
+            return _Tlv(tag, offset, pos, child, child + 2)
+        if length & 0x80:
+            count = length & 0x7f
+            length = int.from_bytes(buf[pos:pos + count], 'big')
+            pos += count
+    except IndexError:
+        raise ValueError("Invalid p7m envelope: truncated element") from None
+    if pos + length > len(buf):
+        raise ValueError("Invalid p7m envelope: truncated element")
+    return _Tlv(tag, offset, pos, pos + length, pos + length)
+
+def _children(buf, tlv: _Tlv) -> Iterator[_Tlv]:
+    pos = tlv.start
+    while pos < tlv.end:
+        child = _read_tlv(buf, pos)
+        yield child
+        pos = child.next
+
+def _expect(tlv: _Tlv, tag: int, what: str) -> _Tlv:
+    if tlv.tag != tag:
+        raise ValueError(f"Invalid p7m envelope: expected {what}")
+    return tlv
+
+def _content(buf, tlv: _Tlv) -> bytes:
+    return bytes(buf[tlv.start:tlv.end])
+
+def _oid(buf, tlv: _Tlv) -> str:
+    data = _content(buf, tlv)
+    parts = [min(data[0] // 40, 2), data[0] - min(data[0] // 40, 2) * 40]
+    value = 0
+    for byte in data[1:]:
+        value = (value << 7) | (byte & 0x7f)
+        if not byte & 0x80:
+            parts.append(value)
+            value = 0
+    return '.'.join(map(str, parts))
+
+def _octet_chunks(buf, tlv: _Tlv) -> List[memoryview]:
+    """Views of an OCTET STRING's content; BER allows it to be split into nested chunks."""
+    if tlv.tag == 0x04:
+        return [buf[tlv.start:tlv.end]]
+    if tlv.tag == 0x24:
+        chunks = []
+        for child in _children(buf, tlv):
+            chunks.extend(_octet_chunks(buf, child))
+        return chunks
+    raise ValueError("Invalid p7m envelope: expected OCTET STRING")
+
+def _signed_data(buf) -> Tuple[_Tlv, List[_Tlv]]:
+    """Return the SignedData element and its children."""
+    content_info = _expect(_read_tlv(buf, 0), 0x30, "ContentInfo")
+    content_type, content = list(_children(buf, content_info))[:2]
+    if _oid(buf, _expect(content_type, 0x06, "content type")) != _OID_SIGNED_DATA:
+        raise ValueError("Invalid p7m envelope: not a CMS SignedData")
+    signed_data = _expect(next(_children(buf, _expect(content, 0xa0, "[0] content"))), 0x30, "SignedData")
+    return signed_data, list(_children(buf, signed_data))
+
+def _decode(view: memoryview):
+    """Return the DER bytes of the envelope: the view itself, or the decoded base64 text."""
+    if len(view) and view[0] == 0x30:
+        return view
+    # Base64 (possibly PEM-armoured) envelopes cannot be read in place
+    text = _PEM_RE.sub(b'', bytes(view))
+    try:
+        return memoryview(base64.b64decode(b''.join(text.split()), validate=True))
+    except ValueError:
+        raise ValueError("Invalid p7m envelope: neither DER nor base64") from None
+
+def extract_payload(view: memoryview) -> List[memoryview]:
+    """Return the signed content of a CAdES/CMS envelope as views into its buffer.
+
+    DER envelopes are not copied: the views point into `view` (e.g. a memory map).
+    Base64 envelopes are decoded first. Detached signatures carry no content and
+    raise ValueError.
+    """
+    der = _decode(view)
+    _, children = _signed_data(der)
+    encap = _expect(children[2], 0x30, "EncapsulatedContentInfo")
+    parts = list(_children(der, encap))
+    if len(parts) < 2:
+        raise ValueError("Invalid p7m envelope: detached signature without content")
+    econtent = _expect(parts[1], 0xa0, "[0] eContent")
+    return _octet_chunks(der, next(_children(der, econtent)))
+
+class PayloadReader:
+    """Read-only binary file over the payload views, as accepted by iterparse."""
+
+    def __init__(self, chunks: List[memoryview]):
+        self._chunks = chunks
+        self._index = 0
+        self._offset = 0
+
+    def read(self, size: int = -1) -> bytes:
+        parts = []
+        while self._index < len(self._chunks) and size != 0:
+            chunk = self._chunks[self._index]
+            end = len(chunk) if size < 0 else min(len(chunk), self._offset + size)
+            parts.append(chunk[self._offset:end])
+            if size > 0:
+                size -= end - self._offset
+            self._offset = end
+            if self._offset == len(chunk):
+                self._index += 1
+                self._offset = 0
+        return b''.join(parts)
+
+    def contiguous(self) -> Optional[memoryview]:
+        """The whole payload as one view, when it is stored in a single chunk."""
+        return self._chunks[0] if len(self._chunks) == 1 else None
+
+    def release(self):
+        for chunk in self._chunks:
+            chunk.release()
+        self._chunks = []
+
+@contextlib.contextmanager
+def open_invoice(file_path: str):
+    """Open an invoice for parsing: .xml files as they are, .p7m files through their payload.
+
+    Envelopes are memory-mapped and their content handed to the parser without a
+    temporary file or a copy of the whole document.
+    """
+    if not is_p7m(file_path):
+        with open(file_path, 'rb') as f:
+            yield f
+        return
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError("Invalid p7m envelope: empty file")
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapped)
+        reader = None
+        try:
+            reader = PayloadReader(extract_payload(view))
+            yield reader
+        finally:
+            # Every view must be released before the map can be closed; views still held
+            # by a traceback keep it open until they are garbage collected
+            if reader is not None:
+                reader.release()
+            view.release()
+            try:
+                mapped.close()
+            except BufferError:
+                pass
+
+# --- Optional signature verification ----------------------------------------------------
+
+@dataclass
+class SignatureResult:
+    valid: bool
+    signer: Optional[str] = None
+    error: Optional[str] = None
+
+def _import_cryptography():
+    try:
+        from cryptography import x509
+        from cryptography.exceptions import InvalidSignature
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
+    except ImportError:
+        raise ImportError("Signature verification needs cryptography: pip install cryptography") from None
+    return x509, InvalidSignature, hashes, ec, padding, rsa
+
+def verify_signature(file_path: str) -> SignatureResult:
+    """Check every SignerInfo of a p7m against the embedded certificates (needs cryptography).
+
+    The content digest and the signature over the signed attributes are verified;
+    the certificate chain is not checked against any trust list. Archive members
+    ("archive.zip!/invoice.xml.p7m") are read from their archive.
+    """
+    # Imported here: xml_invoice_zip itself builds on this module
+    from xml_invoice_zip import open_raw
+    x509, InvalidSignature, hashes, ec, padding, rsa = _import_cryptography()
+    with open_raw(file_path) as f:
+        data = f.read()
+    try:
+        der = _decode(memoryview(data))
+        _, children = _signed_data(der)
+        payload = b''.join(bytes(c) for c in extract_payload(memoryview(data)))
+        certificates = []
+        signer_infos = children[-1]
+        for child in children[3:-1]:
+            if child.tag == 0xa0:
+                for cert in _children(der, child):
+                    certificates.append(x509.load_der_x509_certificate(bytes(der[cert.offset:cert.end])))
+        signer = None
+        for signer_info in _children(der, _expect(signer_infos, 0x31, "SignerInfos")):
+            fields = list(_children(der, signer_info))
+            sid, digest_algorithm = fields[1], fields[2]
+            hash_name = _HASHES.get(_oid(der, next(_children(der, digest_algorithm))))
+            if hash_name is None:
+                return SignatureResult(False, error="unsupported digest algorithm")
+            hash_algorithm = getattr(hashes, hash_name)()
+            cert = _find_certificate(der, sid, certificates, x509)
+            if cert is None:
+                return SignatureResult(False, error="signer certificate not found")
+            signer = cert.subject.rfc4514_string()
+
+            position = 3
+            signed_attrs = None
+            if fields[position].tag == 0xa0:
+                signed_attrs = fields[position]
+                position += 1
+            signature_algorithm = _oid(der, next(_children(der, fields[position])))
+            signature = _content(der, fields[position + 1])
+
+            if signed_attrs is not None:
+                digest = hashes.Hash(hash_algorithm)
+                digest.update(payload)
+                if _message_digest(der, signed_attrs) != digest.finalize():
+                    return SignatureResult(False, signer, "content does not match the signed digest")
+                # The signature covers the attributes re-tagged as a DER SET
+                signed = b'\x31' + bytes(der[signed_attrs.offset + 1:signed_attrs.end])
+            else:
+                signed = payload
+
+            key = cert.public_key()
+            try:
+                if isinstance(key, rsa.RSAPublicKey):
+                    if signature_algorithm == _OID_RSASSA_PSS:
+                        scheme = padding.PSS(mgf=padding.MGF1(hash_algorithm), salt_length=padding.PSS.AUTO)
+                    else:
+                        scheme = padding.PKCS1v15()
+                    key.verify(signature, signed, scheme, hash_algorithm)
+                elif isinstance(key, ec.EllipticCurvePublicKey):
+                    key.verify(signature, signed, ec.ECDSA(hash_algorithm))
+                else:
+                    return SignatureResult(False, signer, "unsupported public key type")
+            except InvalidSignature:
+                return SignatureResult(False, signer, "signature does not match")
+        if signer is None:
+            return SignatureResult(False, error="no SignerInfo")
+        return SignatureResult(True, signer)
+    except (ValueError, IndexError, StopIteration) as e:
+        return SignatureResult(False, error=str(e) or "Invalid p7m envelope")
+
+def _find_certificate(der, sid: _Tlv, certificates: list, x509):
+    if sid.tag == 0x30:
+        # IssuerAndSerialNumber
+        _, serial = list(_children(der, sid))[:2]
+        number = int.from_bytes(_content(der, serial), 'big', signed=True)
+        for cert in certificates:
+            if cert.serial_number == number:
+                return cert
+    elif sid.tag == 0x80:
+        # [0] SubjectKeyIdentifier
+        key_id = _content(der, sid)
+        for cert in certificates:
+            try:
+                ski = cert.extensions.get_extension_for_class(x509.SubjectKeyIdentifier)
+            except x509.ExtensionNotFound:
+                continue
+            if ski.value.digest == key_id:
+                return cert
+    return None
+
+def _message_digest(der, signed_attrs: _Tlv) -> Optional[bytes]:
+    for attribute in _children(der, signed_attrs):
+        oid, values = list(_children(der, attribute))[:2]
+        if _oid(der, oid) == _OID_MESSAGE_DIGEST:
+            return _content(der, next(_children(der, values)))
+    return None
+
+class SignatureCache:
+    """SQLite cache of verification results, valid while a file keeps its size and mtime."""
+
+    def __init__(self, db_path: str = DEFAULT_SIGNATURE_CACHE_FILE):
+        self.db_path = db_path
+        self.hits = 0
+        self._conn = sqlite3.connect(db_path, timeout=30)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS signatures (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                valid INTEGER NOT NULL,
+                signer TEXT,
+                error TEXT
+            );
+        """)
+
+    def verify(self, file_path: str) -> SignatureResult:
+        from xml_invoice_zip import source_stat
+        st = source_stat(file_path)
+        row = self._conn.execute("SELECT size, mtime_ns, valid, signer, error FROM signatures WHERE path = ?",
+                                 (file_path,)).fetchone()
+        if row is not None and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+            self.hits += 1
+            return SignatureResult(bool(row[2]), row[3], row[4])
+        result = verify_signature(file_path)
+        self._conn.execute("INSERT OR REPLACE INTO signatures VALUES (?, ?, ?, ?, ?, ?)",
+                           (file_path, st.st_size, st.st_mtime_ns, int(result.valid), result.signer, result.error))
+        return result
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
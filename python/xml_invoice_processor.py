@@ -1,11 +1,85 @@
 import os
+import sqlite3
+import time
 import xml.etree.ElementTree as ET
 import datetime
-from dataclasses import dataclass
-from typing import List
+import functools
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 from openpyxl import Workbook
 from openpyxl.styles import Font, PatternFill, Alignment
 from pathlib import Path
+from xml_invoice_amounts import parse_amount, to_decimal
+from xml_invoice_backend import BACKENDS, get_backend, set_default_backend
+from xml_invoice_cache import DEFAULT_CACHE_FILE, ParseCache, file_digest
+from xml_invoice_fields import (BODY_TAG, KNOWN_FIELDS, FieldSpec, compile_plan, decode_value, encode_value,
+                                field_value, fields_version, load_fields, stream_bodies)
+from xml_invoice_index import DEFAULT_INDEX_FILE, DateIndex
+from xml_invoice_metrics import LOG_LEVELS, RunMetrics, configure_logging, log, peak_rss_mb
+from xml_invoice_xlsx import table_cell, write_excel_streaming
+from xml_invoice_zip import is_zip, iter_zip_members, open_source
+
+# Bump whenever extraction output changes, so cached records are discarded
+EXTRACTOR_VERSION = "7"
+
+def extractor_version(fields: Sequence[FieldSpec] = ()) -> str:
+    """Cache version of the records extracted with these extra fields."""
+    return f"{EXTRACTOR_VERSION}+{fields_version(fields)}" if fields else EXTRACTOR_VERSION
+
+DEFAULT_OUTPUT_FILE = "fattura-pa-summary.xlsx"
+
+# progress(files done, total files), called from the thread running the pipeline
+ProgressCallback = Callable[[int, int], None]
+
+class ProcessingCancelled(Exception):
+    """Raised when a run is stopped through its cancel event."""
+
+def _cancellable(items: Iterable, cancel=None) -> Iterator:
+    """Pass items through, raising ProcessingCancelled before the next one once `cancel` is set."""
+    if cancel is None:
+        yield from items
+        return
+    try:
+        for item in items:
+            if cancel.is_set():
+                raise ProcessingCancelled()
+            yield item
+    finally:
+        # Stop a generator source now, e.g. to shut its process pool down
+        close = getattr(items, 'close', None)
+        if close is not None:
+            close()
+
+def _remove_outputs(paths: Iterable[str]):
+    """Delete the outputs of a cancelled write, so no truncated file is left behind."""
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+@dataclass
+class Rata:
+    """One installment of the payment schedule (a DettaglioPagamento)."""
+    # DataScadenzaPagamento, else DataRiferimentoTerminiPagamento (or the invoice
+    # date) plus GiorniTerminiPagamento
+    data_scadenza: datetime.date
+    importo: int
+    # CondizioniPagamento of the enclosing DatiPagamento (TP01 rate, TP02 completo, TP03 anticipo)
+    condizioni: str
+    modalita: Optional[str] = None
+
+@dataclass
+class RiepilogoIva:
+    """One DatiRiepilogo: taxable amount and VAT of a rate (or Natura) of the document."""
+    # AliquotaIVA in hundredths of a percent, e.g. 2200 for 22%
+    aliquota: int
+    natura: Optional[str]
+    imponibile: int
+    imposta: int
+    # EsigibilitaIVA: I immediata (the default), D differita, S scissione dei pagamenti
+    esigibilita: str = 'I'
 
 @dataclass
 class Fattura:
@@ -16,21 +90,88 @@ class Fattura:
     data: datetime.date
     numero: str
     data_scadenza_pagamento: datetime.date
-    importo_pagamento: float
+    # Amounts are exact integer cents (see xml_invoice_amounts)
+    importo_pagamento: int
+    # Every DettaglioPagamento of every DatiPagamento block, in document order; the
+    # first one is also data_scadenza_pagamento and importo_pagamento
+    rate: List[Rata] = field(default_factory=list)
+    tipo_documento: Optional[str] = None
+    # Every DatiRiepilogo, in document order, with the signs found in the XML
+    riepilogo_iva: List[RiepilogoIva] = field(default_factory=list)
+    # IdFiscaleIVA/IdPaese, e.g. "IT": with cedente_id_fiscale it identifies the supplier
+    cedente_id_paese: Optional[str] = None
+    # Values of the extra fields requested from config, by field name
+    extra: Dict[str, object] = field(default_factory=dict)
 
 @dataclass
 class TotaleFattureCedente:
     cedente_id_fiscale: str
     cedente_denominazione: str
-    totale_pagamenti: float
+    totale_pagamenti: int
 
 def parse_date(date_str: str) -> datetime.date:
     return datetime.datetime.strptime(date_str, '%Y-%m-%d').date()
 
+# Index of the first extra field value in the tuples of fattura_to_tuple
+EXTRA_OFFSET = 12
+
+def fattura_to_tuple(fattura: Fattura, fields: Sequence[FieldSpec] = ()) -> tuple:
+    """Pack a Fattura into a compact tuple (dates as ordinals) for IPC and storage.
+
+    The eight base values are followed by the payment schedule, a tuple of
+    (due date ordinal, amount, condizioni, modalita), the TipoDocumento, the VAT
+    summary, a tuple of (aliquota, natura, imponibile, imposta, esigibilita), the
+    cedente IdPaese, and from EXTRA_OFFSET on the values of `fields` in order.
+    """
+    return (
+        fattura.cedente_id_fiscale,
+        fattura.cedente_denominazione,
+        fattura.cedente_regime_fiscale,
+        fattura.divisa,
+        fattura.data.toordinal(),
+        fattura.numero,
+        fattura.data_scadenza_pagamento.toordinal(),
+        fattura.importo_pagamento,
+        tuple((rata.data_scadenza.toordinal(), rata.importo, rata.condizioni, rata.modalita)
+              for rata in fattura.rate),
+        fattura.tipo_documento,
+        tuple((r.aliquota, r.natura, r.imponibile, r.imposta, r.esigibilita) for r in fattura.riepilogo_iva),
+        fattura.cedente_id_paese
+    ) + tuple(encode_value(spec, fattura.extra.get(spec.name)) for spec in fields)
+
+def fattura_from_tuple(values: tuple, fields: Sequence[FieldSpec] = ()) -> Fattura:
+    """Rebuild a Fattura from the tuple produced by fattura_to_tuple with the same fields."""
+    (id_fiscale, denominazione, regime_fiscale, divisa,
+     data, numero, data_scadenza, importo) = values[:8]
+    return Fattura(
+        cedente_id_fiscale=id_fiscale,
+        cedente_denominazione=denominazione,
+        cedente_regime_fiscale=regime_fiscale,
+        divisa=divisa,
+        data=datetime.date.fromordinal(data),
+        numero=numero,
+        data_scadenza_pagamento=datetime.date.fromordinal(data_scadenza),
+        importo_pagamento=importo,
+        rate=[Rata(datetime.date.fromordinal(scadenza), importo_rata, condizioni, modalita)
+              for scadenza, importo_rata, condizioni, modalita in values[8]],
+        tipo_documento=values[9],
+        riepilogo_iva=[RiepilogoIva(*riepilogo) for riepilogo in values[10]],
+        cedente_id_paese=values[11],
+        extra={spec.name: decode_value(spec, value) for spec, value in zip(fields, values[EXTRA_OFFSET:])}
+    )
+
 def process_xml_file(file_path: str) -> Fattura:
-    """Process a single XML file and return a Fattura object."""
-    tree = ET.parse(file_path)
-    root = tree.getroot()
+    """Process a single XML file and return a Fattura object for its first body."""
+    # Closing the generator after the first body stops reading the file there
+    fatture = iter_fatture_from_file(file_path)
+    try:
+        return next(fatture)
+    finally:
+        fatture.close()
+
+def process_xml_file_tree(file_path: str) -> Fattura:
+    """Process the first body of a single XML file by building the full ElementTree."""
+    root = get_backend().parse(file_path)
     
     try:
         # Find header
@@ -53,6 +194,7 @@ def process_xml_file(file_path: str) -> Fattura:
         if id_fiscale_iva is None:
             raise ValueError("IdFiscaleIVA/IdCodice not found")
         id_fiscale = id_fiscale_iva.text
+        id_paese = dati_anagrafici.findtext('IdFiscaleIVA/IdPaese')
         
         # Find Denominazione
         denominazione = dati_anagrafici.find('Anagrafica/Denominazione')
@@ -86,7 +228,14 @@ def process_xml_file(file_path: str) -> Fattura:
             raise ValueError("DatiPagamento/DettaglioPagamento not found")
         
         data_scadenza = parse_date(dati_pagamento.find('DataScadenzaPagamento').text)
-        importo = float(dati_pagamento.find('ImportoPagamento').text)
+        importo = parse_amount(dati_pagamento.find('ImportoPagamento').text)
+
+        # Every installment of every DatiPagamento block
+        blocks = [{'condizioni': blocco.findtext('CondizioniPagamento'),
+                   'DettaglioPagamento': [{spec.name: dettaglio.findtext(spec.path[-1])
+                                           for spec in _SCHEDULE_FIELDS[1:]}
+                                          for dettaglio in blocco.findall('DettaglioPagamento')]}
+                  for blocco in body.findall('DatiPagamento')]
         
         return Fattura(
             cedente_id_fiscale=id_fiscale,
@@ -96,57 +245,446 @@ def process_xml_file(file_path: str) -> Fattura:
             data=data,
             numero=numero,
             data_scadenza_pagamento=data_scadenza,
-            importo_pagamento=importo
+            importo_pagamento=importo,
+            rate=_schedule(blocks, data),
+            tipo_documento=dati_generali.findtext('TipoDocumento'),
+            riepilogo_iva=[_riepilogo({spec.name: riepilogo.findtext(spec.path[-1]) for spec in _RIEPILOGO_FIELDS})
+                           for riepilogo in body.findall('DatiBeniServizi/DatiRiepilogo')],
+            cedente_id_paese=id_paese
         )
         
     except Exception as e:
-        print(f"Detailed error in {file_path}: {str(e)}")
+        log.debug(f"Detailed error in {file_path}: {str(e)}")
         raise
 
-def process_folder(folder_path: str, start_date: datetime.date, end_date: datetime.date) -> List[Fattura]:
-    """Process all XML files in the folder and subfolders."""
-    fatture = []
-    
-    for root, _, files in os.walk(folder_path):
-        for file in files:
-            if file.endswith('.xml'):
-                file_path = os.path.join(root, file)
+# Paths (relative to the document root) of the fields read from each invoice.
+_BODY_TAG = BODY_TAG
+_CEDENTE_PATH = ('FatturaElettronicaHeader', 'CedentePrestatore', 'DatiAnagrafici')
+_DOCUMENTO_PATH = (_BODY_TAG, 'DatiGenerali', 'DatiGeneraliDocumento')
+_DATI_PAGAMENTO_PATH = (_BODY_TAG, 'DatiPagamento')
+_PAGAMENTO_PATH = _DATI_PAGAMENTO_PATH + ('DettaglioPagamento',)
+_RIEPILOGO_PATH = (_BODY_TAG, 'DatiBeniServizi', 'DatiRiepilogo')
+# Their presence is checked by _iter_fatture, with the messages of process_xml_file_tree
+_BASE_FIELDS = (
+    FieldSpec('id_fiscale', _CEDENTE_PATH + ('IdFiscaleIVA', 'IdCodice')),
+    FieldSpec('id_paese', _CEDENTE_PATH + ('IdFiscaleIVA', 'IdPaese')),
+    FieldSpec('denominazione', _CEDENTE_PATH + ('Anagrafica', 'Denominazione')),
+    FieldSpec('regime_fiscale', _CEDENTE_PATH + ('RegimeFiscale',)),
+    FieldSpec('divisa', _DOCUMENTO_PATH + ('Divisa',)),
+    FieldSpec('data', _DOCUMENTO_PATH + ('Data',), 'date'),
+    FieldSpec('numero', _DOCUMENTO_PATH + ('Numero',)),
+    FieldSpec('data_scadenza', _PAGAMENTO_PATH + ('DataScadenzaPagamento',), 'date'),
+    FieldSpec('importo', _PAGAMENTO_PATH + ('ImportoPagamento',), 'amount'),
+    # Optional, and the same spec as the extra field of that name
+    KNOWN_FIELDS['tipo_documento'],
+)
+# The payment schedule: one record per DatiPagamento, holding one per DettaglioPagamento
+_SCHEDULE_FIELDS = (
+    FieldSpec('condizioni', _DATI_PAGAMENTO_PATH + ('CondizioniPagamento',), group=_DATI_PAGAMENTO_PATH),
+    FieldSpec('modalita', _PAGAMENTO_PATH + ('ModalitaPagamento',), group=_PAGAMENTO_PATH),
+    FieldSpec('data_riferimento', _PAGAMENTO_PATH + ('DataRiferimentoTerminiPagamento',),
+              group=_PAGAMENTO_PATH),
+    FieldSpec('giorni', _PAGAMENTO_PATH + ('GiorniTerminiPagamento',), group=_PAGAMENTO_PATH),
+    FieldSpec('scadenza', _PAGAMENTO_PATH + ('DataScadenzaPagamento',), group=_PAGAMENTO_PATH),
+    FieldSpec('importo', _PAGAMENTO_PATH + ('ImportoPagamento',), group=_PAGAMENTO_PATH),
+)
+# The VAT summary: one record per DatiRiepilogo
+_RIEPILOGO_FIELDS = (
+    FieldSpec('aliquota', _RIEPILOGO_PATH + ('AliquotaIVA',), group=_RIEPILOGO_PATH),
+    FieldSpec('natura', _RIEPILOGO_PATH + ('Natura',), group=_RIEPILOGO_PATH),
+    FieldSpec('imponibile', _RIEPILOGO_PATH + ('ImponibileImporto',), group=_RIEPILOGO_PATH),
+    FieldSpec('imposta', _RIEPILOGO_PATH + ('Imposta',), group=_RIEPILOGO_PATH),
+    FieldSpec('esigibilita', _RIEPILOGO_PATH + ('EsigibilitaIVA',), group=_RIEPILOGO_PATH),
+)
+# Grouped fields live in their own records, so only the base names and the detail
+# columns (the first eight Fattura fields) can clash with extra fields
+_RESERVED_NAMES = ({spec.name for spec in _BASE_FIELDS}
+                   | set(list(Fattura.__dataclass_fields__)[:8]))
+
+def check_fields(fields: Sequence[FieldSpec]):
+    """Reject extra fields whose names clash with the base fields or output columns."""
+    clashes = sorted(spec.name for spec in fields
+                     if spec.name in _RESERVED_NAMES and spec not in _BASE_FIELDS)
+    if clashes:
+        raise ValueError(f"Field names already used by the base columns: {', '.join(clashes)}")
+
+def _plan(fields: Sequence[FieldSpec]):
+    """The compiled plan for the base fields plus `fields`: one trie, one pass."""
+    return compile_plan(_BASE_FIELDS + _SCHEDULE_FIELDS + _RIEPILOGO_FIELDS + tuple(fields))
+
+def _find_text(values: dict, name: str):
+    """Mirror `element.find(...).text`, including the error raised for a missing element."""
+    if name not in values:
+        raise AttributeError("'NoneType' object has no attribute 'text'")
+    return values[name]
+
+def _check_header(values: dict, seen: set):
+    if _CEDENTE_PATH[:1] not in seen:
+        raise ValueError("FatturaElettronicaHeader not found")
+    if _CEDENTE_PATH[:2] not in seen:
+        raise ValueError("CedentePrestatore not found")
+    if _CEDENTE_PATH not in seen:
+        raise ValueError("DatiAnagrafici not found")
+    if 'id_fiscale' not in values:
+        raise ValueError("IdFiscaleIVA/IdCodice not found")
+    if 'denominazione' not in values:
+        raise ValueError("Anagrafica/Denominazione not found")
+    if 'regime_fiscale' not in values:
+        raise ValueError("RegimeFiscale not found")
+
+def _rata(dettaglio: dict, condizioni: str, data: datetime.date) -> Rata:
+    """Build a Rata from the texts of one DettaglioPagamento."""
+    if dettaglio.get('importo') is None:
+        raise ValueError("DettaglioPagamento/ImportoPagamento not found")
+    if dettaglio.get('scadenza') is not None:
+        scadenza = parse_date(dettaglio['scadenza'])
+    else:
+        # Terms relative to a reference date (the invoice date when not given)
+        riferimento = dettaglio.get('data_riferimento')
+        scadenza = parse_date(riferimento) if riferimento is not None else data
+        if dettaglio.get('giorni') is not None:
+            scadenza += datetime.timedelta(days=int(dettaglio['giorni']))
+    return Rata(data_scadenza=scadenza, importo=parse_amount(dettaglio['importo']),
+                condizioni=condizioni, modalita=dettaglio.get('modalita'))
+
+def _schedule(blocks: list, data: datetime.date) -> List[Rata]:
+    """Expand the DatiPagamento records of a body into its installments."""
+    return [_rata(dettaglio, block.get('condizioni'), data)
+            for block in blocks for dettaglio in block.get('DettaglioPagamento', ())]
+
+def _riepilogo(record: dict) -> RiepilogoIva:
+    """Build a RiepilogoIva from the texts of one DatiRiepilogo."""
+    for name, tag in [('aliquota', 'AliquotaIVA'), ('imponibile', 'ImponibileImporto'), ('imposta', 'Imposta')]:
+        if record.get(name) is None:
+            raise ValueError(f"DatiRiepilogo/{tag} not found")
+    return RiepilogoIva(aliquota=parse_amount(record['aliquota']), natura=record.get('natura'),
+                        imponibile=parse_amount(record['imponibile']),
+                        imposta=parse_amount(record['imposta']),
+                        esigibilita=record.get('esigibilita') or 'I')
+
+def iter_fatture_from_file(file_path: str, fields: Sequence[FieldSpec] = ()) -> Iterator[Fattura]:
+    """Yield one Fattura per FatturaElettronicaBody, reading the file in a single iterparse pass.
+
+    Batch files (lotti) share one header, so the cedente is extracted once for all
+    bodies. Nothing is read past the body the consumer stops at, and errors match
+    those of process_xml_file_tree. Signed .xml.p7m files are read through their
+    embedded XML payload, and "archive.zip!/member.xml" paths straight from the archive.
+    The extra `fields` are read in the same pass into each Fattura's `extra`.
+    """
+    with open_source(file_path) as f:
+        yield from _iter_fatture(f, file_path, fields)
+
+def _iter_fatture(source, file_path: str, fields: Sequence[FieldSpec] = (),
+                  backend: Optional[str] = None) -> Iterator[Fattura]:
+    """iter_fatture_from_file on an open binary stream; file_path is only used in messages."""
+    header_values = {}
+    header_seen = set()
+    plan = _plan(fields)
+    try:
+        cedente = None
+        for values, seen in stream_bodies(source, plan, header_values, header_seen, backend):
+            if cedente is None:
+                _check_header(header_values, header_seen)
+                cedente = (header_values['id_fiscale'], header_values['denominazione'],
+                           header_values['regime_fiscale'], header_values.get('id_paese'))
+
+            if _DOCUMENTO_PATH not in seen:
+                raise ValueError("DatiGeneraliDocumento not found")
+
+            divisa = _find_text(values, 'divisa')
+            data = parse_date(_find_text(values, 'data'))
+            numero = _find_text(values, 'numero')
+
+            if _PAGAMENTO_PATH not in seen:
+                raise ValueError("DatiPagamento/DettaglioPagamento not found")
+
+            data_scadenza = parse_date(_find_text(values, 'data_scadenza'))
+            importo = parse_amount(_find_text(values, 'importo'))
+            rate = _schedule(values.get('DatiPagamento', ()), data)
+            riepilogo_iva = [_riepilogo(record) for record in values.get('DatiRiepilogo', ())]
+
+            yield Fattura(
+                cedente_id_fiscale=cedente[0],
+                cedente_denominazione=cedente[1],
+                cedente_regime_fiscale=cedente[2],
+                divisa=divisa,
+                data=data,
+                numero=numero,
+                data_scadenza_pagamento=data_scadenza,
+                importo_pagamento=importo,
+                rate=rate,
+                tipo_documento=values.get('tipo_documento'),
+                riepilogo_iva=riepilogo_iva,
+                cedente_id_paese=cedente[3],
+                extra={spec.name: field_value(spec, values, header_values) for spec in fields}
+            )
+
+        if cedente is None:
+            _check_header(header_values, header_seen)
+            raise ValueError("FatturaElettronicaBody not found")
+
+    except ET.ParseError:
+        raise
+    except Exception as e:
+        log.debug(f"Detailed error in {file_path}: {str(e)}")
+        raise
+
+def is_invoice_file(name: str) -> bool:
+    """Tell whether a file name is a plain (.xml) or signed (.xml.p7m) invoice."""
+    return name.endswith('.xml') or name.lower().endswith('.xml.p7m')
+
+def iter_xml_files(folder_path: str) -> Iterator[str]:
+    """Yield the XML and .xml.p7m files in the folder and subfolders in a stable, sorted order.
+
+    ZIP archives, given directly or found in the folder, are listed in place: their
+    invoices are yielded as "archive.zip!/member.xml" paths.
+    """
+    if is_zip(folder_path) and os.path.isfile(folder_path):
+        yield from iter_zip_members(folder_path, is_invoice_file)
+        return
+    for root, dirs, files in os.walk(folder_path):
+        dirs.sort()
+        for file in sorted(files):
+            if is_invoice_file(file):
+                yield os.path.join(root, file)
+            elif is_zip(file):
+                archive = os.path.join(root, file)
                 try:
-                    # Parse and process the file
-                    fattura = process_xml_file(file_path)
-                    
-                    # Check if the invoice date is within the specified range
-                    if start_date <= fattura.data <= end_date:
-                        fatture.append(fattura)
-                        print(f"Successfully processed: {file_path}")
-                        
-                except (ET.ParseError, AttributeError, ValueError) as e:
-                    print(f"Error processing file {file_path}: {str(e)}")
+                    yield from iter_zip_members(archive, is_invoice_file)
+                except (zipfile.BadZipFile, OSError) as e:
+                    log.warning(f"Skipping unreadable archive {archive}: {e}")
+
+class _TimedReader:
+    """Binary file wrapper adding up the time and bytes of its read() calls."""
+
+    def __init__(self, f):
+        self._f = f
+        self.seconds = 0.0
+        self.bytes = 0
+
+    def read(self, size: int = -1) -> bytes:
+        start = time.perf_counter()
+        data = self._f.read(size)
+        self.seconds += time.perf_counter() - start
+        self.bytes += len(data)
+        return data
+
+def _process_file_worker(file_path: str, fields: Tuple[FieldSpec, ...] = (),
+                         backend: Optional[str] = None,
+                         digest: bool = False) -> Tuple[str, Optional[List[tuple]], Optional[str], tuple]:
+    """Parse one file and return (path, one fattura tuple per body, error message, stats).
+
+    stats is (read seconds, parse seconds, cpu seconds, bytes read, peak RSS MB, error type,
+    file_digest of the file when `digest` is set, else None).
+    """
+    start, cpu = time.perf_counter(), time.process_time()
+    values, error, error_type = None, None, None
+    reader = None
+    try:
+        with open_source(file_path) as f:
+            reader = _TimedReader(f)
+            values = [fattura_to_tuple(fattura, fields)
+                      for fattura in _iter_fatture(reader, file_path, fields, backend)]
+    except (ET.ParseError, AttributeError, ValueError, zipfile.BadZipFile, zlib.error) as e:
+        error, error_type = str(e), type(e).__name__
+    read_seconds = reader.seconds if reader is not None else 0.0
+    read_bytes = reader.bytes if reader is not None else 0
+    elapsed = time.perf_counter() - start
+    # Hashed here, in parallel, for the parse cache: the file was just read and is still in memory
+    sha256 = file_digest(file_path) if digest else None
+    stats = (read_seconds, elapsed - read_seconds, time.process_time() - cpu, read_bytes,
+             peak_rss_mb(), error_type, sha256)
+    return file_path, values, error, stats
+
+def parse_files(file_paths: List[str], workers: int = 1, metrics: Optional[RunMetrics] = None,
+                fields: Sequence[FieldSpec] = (), digests: bool = False) -> Iterator[tuple]:
+    """Parse the files serially or on a process pool, yielding results in input order.
+
+    Each result is (path, one fattura tuple per body, error message); workers=0 uses every CPU.
+    The tuples carry the values of the extra `fields` after the base ones.
+    Read and parse times reported by the workers are added to `metrics`.
+    With digests, the workers also hash each file for the parse cache: the results
+    then carry the file_digest and the error type (for cached errors) as well.
+    """
+    if workers == 0:
+        workers = os.cpu_count() or 1
+    # Name the backend explicitly: spawned workers do not inherit this process's default
+    worker = functools.partial(_process_file_worker, fields=tuple(fields), backend=get_backend().name,
+                               digest=digests)
+    if workers == 1 or len(file_paths) < 2:
+        results = map(worker, file_paths)
+        yield from _collect_stats(results, metrics, digests)
+        return
+
+    # Large chunks keep IPC overhead low; executor.map preserves input order
+    chunksize = max(1, min(256, len(file_paths) // (workers * 8)))
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        results = executor.map(worker, file_paths, chunksize=chunksize)
+        yield from _collect_stats(results, metrics, digests)
+    finally:
+        # If the consumer stopped early, drop the files not yet handed to a worker
+        executor.shutdown(cancel_futures=True)
+
+def _collect_stats(results, metrics: Optional[RunMetrics], digests: bool = False):
+    for file_path, values, error, stats in results:
+        if metrics is not None:
+            read_s, parse_s, cpu_s, nbytes, rss, error_type, _ = stats
+            # CPU time is not split between reading and parsing: it is all parser work
+            metrics.add('read', read_s, 0.0, files=1, nbytes=nbytes, peak_rss=rss)
+            metrics.add('parse', parse_s, cpu_s, files=1, nbytes=nbytes, peak_rss=rss)
+            metrics.record_file(file_path, read_s + parse_s)
+            if error_type is not None:
+                metrics.record_error(error_type)
+        if digests:
+            yield file_path, values, error, stats[-1], stats[5]
+        else:
+            yield file_path, values, error
+
+def iter_folder_records(folder_path: str, start_date: datetime.date, end_date: datetime.date,
+                        workers: int = 1, cache: Optional[ParseCache] = None,
+                        index: Optional[DateIndex] = None,
+                        metrics: Optional[RunMetrics] = None,
+                        progress: Optional[ProgressCallback] = None,
+                        cancel=None, fields: Sequence[FieldSpec] = (),
+                        dedup=None) -> Iterator[Tuple[str, List[tuple]]]:
+    """Yield (file path, in-range fattura tuples) for the XML files in the folder and subfolders.
+
+    With workers > 1 the files are parsed on a process pool (workers=0 uses every CPU).
+    Results and errors are reported in the same sorted file order either way, each
+    file as soon as it and the files before it are parsed.
+    Files found unchanged in the cache are not parsed again, and files the date
+    index places outside the range are skipped before being read at all.
+    Stage timings and counters are recorded in `metrics` when given, `progress` is
+    called as files are read or parsed, and setting the `cancel` event (a
+    threading.Event) stops the run with ProcessingCancelled. The tuples carry the
+    extra `fields` (the cache must have been opened with their extractor_version).
+    With dedup (an xml_invoice_dedup.DuplicateIndex), invoices already seen in
+    another file are dropped or reported according to its policy.
+    """
+    if dedup is not None:
+        yield from dedup.filter(iter_folder_records(folder_path, start_date, end_date, workers, cache, index,
+                                                    metrics, progress, cancel, fields))
+        return
+    metrics = metrics or RunMetrics()
+    with metrics.stage('walk') as walk:
+        file_paths = list(_cancellable(iter_xml_files(folder_path), cancel))
+        if index is not None:
+            file_paths = [p for p in _cancellable(file_paths, cancel) if index.may_match(p, start_date, end_date)]
+        walk.files += len(file_paths)
+
+    # Look up the cache first, then parse only what missed
+    hits = {}
+    cache_keys = {}
+    pending = []
+    with metrics.stage('read'):
+        for file_path in _cancellable(file_paths, cancel):
+            if cache is not None:
+                payload, cache_keys[file_path] = cache.lookup(file_path)
+                if payload is not None:
+                    hits[file_path] = payload
                     continue
-    
+            pending.append(file_path)
+
+    # parse_files returns the misses in file order: merge them with the hits as they come
+    total = len(file_paths)
+    done = len(hits)
+    if progress is not None:
+        progress(done, total)
+    parsing = parse_files(pending, workers, metrics, fields, digests=cache is not None)
+    start, end = start_date.toordinal(), end_date.toordinal()
+    try:
+        for file_path in file_paths:
+            payload = hits.pop(file_path, None)
+            if payload is None:
+                if cache is not None:
+                    _, values, error, digest, error_type = next(parsing)
+                    cache.store(file_path, cache_keys[file_path], (values, error, error_type), digest)
+                else:
+                    _, values, error = next(parsing)
+                done += 1
+                if progress is not None:
+                    progress(done, total)
+            else:
+                values, error, error_type = payload
+            if cancel is not None and cancel.is_set():
+                raise ProcessingCancelled()
+
+            with metrics.stage('filter') as stage:
+                stage.files += 1
+                if error is not None:
+                    log.warning(f"Error processing file {file_path}: {error}")
+                    if payload is not None:
+                        # Errors parsed in this run were counted by type in parse_files
+                        metrics.record_error(error_type)
+                    continue
+
+                # Check if each invoice date (v[4], as an ordinal) is within the specified range
+                if index is not None:
+                    index.update(file_path, [datetime.date.fromordinal(v[4]) for v in values])
+                in_range = [v for v in values if start <= v[4] <= end]
+            if in_range:
+                log.info(f"Successfully processed: {file_path}")
+                yield file_path, in_range
+    finally:
+        parsing.close()
+
+def process_folder(folder_path: str, start_date: datetime.date, end_date: datetime.date,
+                   workers: int = 1, cache: Optional[ParseCache] = None,
+                   index: Optional[DateIndex] = None,
+                   metrics: Optional[RunMetrics] = None,
+                   progress: Optional[ProgressCallback] = None, cancel=None,
+                   fields: Sequence[FieldSpec] = (), dedup=None) -> List[Fattura]:
+    """Process all XML files in the folder and subfolders."""
+    fatture = []
+    for _, records in iter_folder_records(folder_path, start_date, end_date, workers=workers,
+                                          cache=cache, index=index, metrics=metrics,
+                                          progress=progress, cancel=cancel, fields=fields,
+                                          dedup=dedup):
+        fatture.extend(fattura_from_tuple(v, fields) for v in records)
     return fatture
 
-def aggregate_by_cedente(fatture: List[Fattura]) -> List[TotaleFattureCedente]:
-    """Aggregate fatture by cedente and calculate totals."""
+def aggregate_by_cedente(fatture: Iterable[Fattura]) -> List[TotaleFattureCedente]:
+    """Aggregate fatture by cedente and calculate totals (exact integer sums of cents)."""
     totals = {}
-    
+    for _ in _collect_totals(fatture, totals):
+        pass
+    return _totali(totals)
+
+def _collect_totals(fatture: Iterable[Fattura], totals: Dict[Tuple[str, str], List[int]]) -> Iterator[Fattura]:
+    """Pass fatture through, adding up [cents, fatture] per (id fiscale, denominazione) in totals."""
     for fattura in fatture:
         key = (fattura.cedente_id_fiscale, fattura.cedente_denominazione)
-        if key not in totals:
-            totals[key] = 0
-        totals[key] += fattura.importo_pagamento
-    
+        total = totals.get(key)
+        if total is None:
+            total = totals[key] = [0, 0]
+        total[0] += fattura.importo_pagamento
+        total[1] += 1
+        yield fattura
+
+def _totali(totals: Dict[Tuple[str, str], List[int]]) -> List[TotaleFattureCedente]:
     return [
         TotaleFattureCedente(
             cedente_id_fiscale=id_fiscale,
             cedente_denominazione=denominazione,
-            totale_pagamenti=total
+            totale_pagamenti=cents
         )
-        for (id_fiscale, denominazione), total in totals.items()
+        for (id_fiscale, denominazione), (cents, _) in totals.items()
     ]
 
-def write_excel(totali: List[TotaleFattureCedente], fatture: List[Fattura], output_file: str):
-    """Write the data to an Excel file with two sheets: summary and details."""
+def write_excel(totali: List[TotaleFattureCedente], fatture: Iterable[Fattura], output_file: str,
+                streaming: bool = False, fields: Sequence[FieldSpec] = (), tables: Sequence = ()):
+    """Write the data to an Excel file with two sheets: summary and details.
+
+    With streaming=True rows go through the constant-memory writer in xml_invoice_xlsx,
+    which also spills details past Excel's row limit into further sheets. The extra
+    `fields` become further detail columns, and each report table (name, title,
+    columns, rows), such as the cash-flow ones, a further sheet.
+    """
+    if streaming:
+        write_excel_streaming(totali, fatture, output_file, fields=fields, tables=tables)
+        return
+
     wb = Workbook()
     
     # Create Summary sheet
@@ -165,7 +703,7 @@ def write_excel(totali: List[TotaleFattureCedente], fatture: List[Fattura], outp
     for row, totale in enumerate(totali, 2):
         ws_summary.cell(row=row, column=1, value=totale.cedente_id_fiscale)
         ws_summary.cell(row=row, column=2, value=totale.cedente_denominazione)
-        cell = ws_summary.cell(row=row, column=3, value=totale.totale_pagamenti)
+        cell = ws_summary.cell(row=row, column=3, value=to_decimal(totale.totale_pagamenti))
         cell.number_format = '#,##0.00 €'
     
     # Create Details sheet
@@ -181,7 +719,7 @@ def write_excel(totali: List[TotaleFattureCedente], fatture: List[Fattura], outp
         'Numero Fattura',
         'Data Scadenza',
         'Importo'
-    ]
+    ] + [spec.name for spec in fields]
     
     for col, header in enumerate(headers_details, 1):
         cell = ws_details.cell(row=1, column=col, value=header)
@@ -198,11 +736,33 @@ def write_excel(totali: List[TotaleFattureCedente], fatture: List[Fattura], outp
         ws_details.cell(row=row, column=5, value=fattura.data)
         ws_details.cell(row=row, column=6, value=fattura.numero)
         ws_details.cell(row=row, column=7, value=fattura.data_scadenza_pagamento)
-        cell = ws_details.cell(row=row, column=8, value=fattura.importo_pagamento)
+        cell = ws_details.cell(row=row, column=8, value=to_decimal(fattura.importo_pagamento))
         cell.number_format = '#,##0.00 €'
+        for col, spec in enumerate(fields, 9):
+            value = fattura.extra.get(spec.name)
+            if spec.type == 'amount' and value is not None:
+                value = to_decimal(value, spec.scale)
+            cell = ws_details.cell(row=row, column=col, value=value)
+            if spec.type == 'amount':
+                cell.number_format = '#,##0.00 €'
     
+    sheets = [ws_summary, ws_details]
+    for _, title, columns, rows in tables:
+        ws = wb.create_sheet(title)
+        sheets.append(ws)
+        for col, (name, _) in enumerate(columns, 1):
+            cell = ws.cell(row=1, column=col, value=name)
+            cell.font = Font(bold=True)
+            cell.fill = PatternFill(start_color="CCCCCC", end_color="CCCCCC", fill_type="solid")
+            cell.alignment = Alignment(horizontal="center")
+        for row, values in enumerate(rows, 2):
+            for col, ((_, kind), value) in enumerate(zip(columns, values), 1):
+                cell = ws.cell(row=row, column=col, value=table_cell(kind, value))
+                if kind.startswith('amount'):
+                    cell.number_format = '#,##0.00 €'
+
     # Adjust column widths
-    for ws in [ws_summary, ws_details]:
+    for ws in sheets:
         for column in ws.columns:
             max_length = 0
             column_letter = column[0].column_letter
@@ -218,32 +778,369 @@ def write_excel(totali: List[TotaleFattureCedente], fatture: List[Fattura], outp
     # Save the workbook
     wb.save(output_file)
 
-def main(folder_path: str, start_date_str: str, end_date_str: str):
-    """Main function to process invoices and generate Excel file."""
+def main(folder_path: str, start_date_str: str, end_date_str: str, workers: int = 1,
+         use_cache: bool = True, cache_file: str = DEFAULT_CACHE_FILE, use_index: bool = True,
+         columnar: bool = False, streaming_excel: bool = False,
+         output_file: str = DEFAULT_OUTPUT_FILE, summary_file: Optional[str] = None,
+         metrics_json: Optional[str] = None, metrics_prom: Optional[str] = None,
+         progress: Optional[ProgressCallback] = None, cancel=None,
+         verify_signatures: bool = False, signature_cache_file: Optional[str] = None,
+         fields_config: Optional[str] = None, parser_backend: str = 'auto',
+         validate: bool = False, validation_report: Optional[str] = None,
+         cashflow: Optional[str] = None, as_of_str: Optional[str] = None,
+         lines_file: Optional[str] = None, vat: Optional[str] = None,
+         dedup: Optional[str] = None, dedup_index_file: Optional[str] = None,
+         dedup_report: Optional[str] = None, bloom: bool = True, index_file: str = DEFAULT_INDEX_FILE):
+    """Main function to process invoices and generate the output file.
+
+    An .xlsx output_file gets the two-sheet workbook; any other extension (.csv,
+    .csv.gz, .jsonl, .parquet, .arrow) streams the details to that file and the
+    per-cedente totals to summary_file (default: "<name>-totali.<ext>").
+    With streaming_excel, the workbook is written in constant memory: without the
+    columnar batch, invoices go into it as they are parsed and only the sums are kept.
+    With use_index, the invoice dates of every file are kept in index_file, so later
+    runs skip the out-of-range files with a stat call.
+    Per-stage run metrics can be saved as JSON (metrics_json) and as a Prometheus
+    textfile-collector file (metrics_prom). `progress` and `cancel` are passed on to
+    iter_folder_records, so callers such as the GUI can follow and stop the run; `cancel`
+    also stops the signature checks, the validation and the Excel write.
+    With verify_signatures, the signatures of .p7m files are checked first (results
+    are cached by file) and invalid ones reported; their invoices are still processed.
+    fields_config names a JSON file of extra columns (see xml_invoice_fields.load_fields).
+    parser_backend selects the XML parser: 'auto' (lxml when installed), 'lxml' or 'etree'.
+    With validate, every file is first checked against the FatturaPA XSD in force on
+    its date and the violations written to validation_report; invalid files are still
+    processed.
+    With cashflow ('week' or 'month'), every installment of the in-range invoices is
+    listed, and the amounts due per period and the per-cedente ageing on as_of_str
+    (default today) are reported: as further sheets of an .xlsx output, else as
+    "<name>-rate", "<name>-flussi" and "<name>-scaduto" files next to the output.
+    With lines_file (.csv, .jsonl, .parquet or .arrow), the DettaglioLinee of the
+    in-range invoices are streamed there too, in a separate constant-memory pass
+    (with dedup, of the invoices kept only).
+    With vat ('quarter' or 'month'), the DatiRiepilogo of the in-range invoices are
+    summed per period, aliquota and natura in the same pass (credit notes subtract):
+    as a further sheet of an .xlsx output, else as a "<name>-iva" file.
+    With dedup ('first-wins', 'newest-wins' or 'report-only'), invoices seen in
+    more than one file are checked against the persistent dedup_index_file before
+    aggregation, and reported in dedup_report (see xml_invoice_dedup).
+    """
     # Convert date strings to date objects
     start_date = parse_date(start_date_str)
     end_date = parse_date(end_date_str)
+    excel = output_file.endswith('.xlsx')
+    if not excel:
+        from xml_invoice_sinks import sink_format
+        if sink_format(output_file) is None:
+            raise ValueError(f"Unsupported output format: {output_file}")
+    if lines_file:
+        from xml_invoice_sinks import sink_format
+        if sink_format(lines_file) is None:
+            raise ValueError(f"Unsupported line items format: {lines_file}")
+    set_default_backend(parser_backend)
+    fields = load_fields(fields_config) if fields_config else []
+    check_fields(fields)
+    if fields and columnar:
+        raise ValueError("Extra fields are not supported with the columnar batch")
+    if cashflow and columnar:
+        raise ValueError("The columnar batch keeps no payment schedule: drop --columnar for --cashflow")
+    as_of = parse_date(as_of_str) if as_of_str else datetime.date.today()
+    if cashflow:
+        from xml_invoice_cashflow import (PERIODS, RATA_COLUMNS, ScheduleBuilder, cashflow_tables,
+                                          schedule_rows_table, schedule_table)
+        if cashflow not in PERIODS:
+            raise ValueError(f"Unknown cash-flow period {cashflow}: use one of {', '.join(PERIODS)}")
+        schedule = ScheduleBuilder()
+    if vat and columnar:
+        raise ValueError("The columnar batch keeps no VAT summary: drop --columnar for --vat")
+    if vat:
+        from xml_invoice_vat import VatSummary
+        vat_summary = VatSummary(vat)
     
     print(f"Processing files from {start_date} to {end_date}")
     print(f"Looking in folder: {folder_path}")
+    print(f"XML parser: {get_backend().name}")
+    if verify_signatures:
+        from xml_invoice_p7m import DEFAULT_SIGNATURE_CACHE_FILE, SignatureCache, is_p7m
+        checked = invalid = 0
+        with SignatureCache(signature_cache_file or DEFAULT_SIGNATURE_CACHE_FILE) as signatures:
+            for file_path in _cancellable(iter_xml_files(folder_path), cancel):
+                if not is_p7m(file_path):
+                    continue
+                checked += 1
+                result = signatures.verify(file_path)
+                if not result.valid:
+                    invalid += 1
+                    log.warning(f"Invalid signature in {file_path}: {result.error}")
+        print(f"Signatures: {checked - invalid} valid, {invalid} invalid")
+    metrics = RunMetrics()
+    if validate:
+        from xml_invoice_validate import DEFAULT_REPORT_FILE, validate_files, write_report
+        report_file = validation_report or DEFAULT_REPORT_FILE
+        with metrics.stage('validate') as stage:
+            file_paths = list(_cancellable(iter_xml_files(folder_path), cancel))
+            stage.files += len(file_paths)
+            try:
+                valid, invalid = write_report(_cancellable(validate_files(file_paths, workers), cancel),
+                                              report_file)
+            except ProcessingCancelled:
+                _remove_outputs([report_file])
+                raise
+        print(f"Validation: {valid} valid, {invalid} invalid (report in {report_file})")
     
-    # Process all files
-    fatture = process_folder(folder_path, start_date, end_date)
-    
-    # Aggregate by cedente
-    totali = aggregate_by_cedente(fatture)
+    # Process all files, reusing records cached by previous runs
+    cache = ParseCache(cache_file, extractor_version=extractor_version(fields)) if use_cache else None
+    duplicates = None
+    if dedup:
+        from xml_invoice_dedup import DEFAULT_DEDUP_FILE, DEFAULT_REPORT_FILE, DuplicateIndex
+        duplicates = DuplicateIndex(dedup_index_file or DEFAULT_DEDUP_FILE, dedup, bloom)
+        dedup_report = dedup_report or DEFAULT_REPORT_FILE
+        if lines_file:
+            # The line items pass exports only the invoices kept here
+            duplicates.kept = set()
+    index = None
+    if use_index:
+        try:
+            index = DateIndex(index_file)
+        except sqlite3.Error as e:
+            print(f"Date index disabled: {str(e)}")
+    try:
+        if columnar:
+            # Keep the records in a FatturaBatch and aggregate with vectorized sums
+            from xml_invoice_batch import process_folder_batch
+            batch = process_folder_batch(folder_path, start_date, end_date, workers=workers,
+                                         cache=cache, index=index, metrics=metrics,
+                                         progress=progress, cancel=cancel, dedup=duplicates)
+        elif excel and streaming_excel:
+            # Invoices go into the workbook as each file is processed, nothing is accumulated
+            # but the sums: the summary and report sheets are filled from them at the end
+            records = iter_folder_records(folder_path, start_date, end_date, workers=workers,
+                                          cache=cache, index=index, metrics=metrics,
+                                          progress=progress, cancel=cancel, fields=fields,
+                                          dedup=duplicates)
+            fatture = (fattura_from_tuple(v, fields) for _, file_records in records for v in file_records)
+            totals = {}
+            fatture = _collect_totals(fatture, totals)
+            if cashflow:
+                fatture = schedule.collect(fatture)
+            if vat:
+                fatture = vat_summary.collect(fatture)
+            report_tables = []
+
+            def fill_report_tables():
+                if cashflow:
+                    report_tables.extend(cashflow_tables(schedule.build(), cashflow, as_of))
+                if vat:
+                    report_tables.append(vat_summary.table())
+                return report_tables
+
+            with metrics.stage('write'):
+                # The writer replaces output_file only once complete, so cancelling leaves it as it was
+                write_excel_streaming(lambda: _totali(totals), _cancellable(fatture, cancel), output_file,
+                                      fields=fields, tables=fill_report_tables,
+                                      fattura_tables=[schedule_rows_table()] if cashflow else [])
+            totali = _totali(totals)
+            count = sum(n for _, n in totals.values())
+            cash_tables = report_tables[:2]
+        elif excel:
+            fatture = process_folder(folder_path, start_date, end_date, workers=workers,
+                                     cache=cache, index=index, metrics=metrics,
+                                     progress=progress, cancel=cancel, fields=fields,
+                                     dedup=duplicates)
+        else:
+            # Rows reach the sink as each file is processed, nothing is accumulated;
+            # the write stage therefore also covers the walk, parse and filter stages
+            from xml_invoice_sinks import export_fatture, open_sink, summary_path
+            records = iter_folder_records(folder_path, start_date, end_date, workers=workers,
+                                          cache=cache, index=index, metrics=metrics,
+                                          progress=progress, cancel=cancel, fields=fields,
+                                          dedup=duplicates)
+            fatture = (fattura_from_tuple(v, fields) for _, file_records in records for v in file_records)
+            if vat:
+                fatture = vat_summary.collect(fatture)
+            rate_file = summary_path(output_file, 'rate')
+            try:
+                with metrics.stage('write'):
+                    if cashflow:
+                        # The installments are written as they stream by, and indexed
+                        with open_sink(rate_file, RATA_COLUMNS) as rate_sink:
+                            count, totali = export_fatture(schedule.collect(fatture, rate_sink),
+                                                           output_file, summary_file, fields=fields)
+                    else:
+                        count, totali = export_fatture(fatture, output_file, summary_file, fields=fields)
+            except ProcessingCancelled:
+                _remove_outputs([output_file, rate_file] if cashflow else [output_file])
+                raise
+        if duplicates is not None:
+            duplicates.write_report(dedup_report)
+    finally:
+        if duplicates is not None:
+            duplicates.close()
+        if cache is not None:
+            cache.close()
+        if index is not None:
+            index.close()
+    if index is not None:
+        print(f"Index: {index.pruned} files outside the date range skipped")
+    if cache is not None:
+        print(f"Cache: {cache.hits} files reused, {cache.misses} parsed")
+    if duplicates is not None:
+        print(f"Duplicates: {duplicates.duplicates} of {duplicates.checked} invoices ({dedup}), "
+              f"report in {dedup_report}")
     
-    # Write output Excel
-    output_file = "fattura-pa-summary.xlsx"
-    write_excel(totali, fatture, output_file)
-    print(f"\nProcessed {len(fatture)} invoices")
+    if cancel is not None and cancel.is_set():
+        raise ProcessingCancelled()
+
+    # Aggregate by cedente and write the output
+    if columnar and not excel:
+        from xml_invoice_sinks import export_batch
+        with metrics.stage('write'):
+            count, totali = export_batch(batch, output_file, summary_file)
+    elif columnar:
+        with metrics.stage('aggregate'):
+            totali = batch.aggregate_by_cedente()
+        count = len(batch)
+        with metrics.stage('write'):
+            fatture = batch.iter_fatture() if streaming_excel else batch.to_fatture()
+            # Both writers replace output_file only once complete, so cancelling leaves it as it was
+            write_excel(totali, _cancellable(fatture, cancel), output_file, streaming=streaming_excel)
+    elif excel and not streaming_excel:
+        with metrics.stage('aggregate'):
+            totali = aggregate_by_cedente(fatture)
+            for fattura in fatture:
+                if cashflow:
+                    schedule.add(fattura)
+                if vat:
+                    vat_summary.add(fattura)
+        count = len(fatture)
+        tables = []
+        if cashflow:
+            with metrics.stage('cashflow'):
+                cash_tables = cashflow_tables(schedule.build(), cashflow, as_of)
+                tables = [schedule_table(fatture)] + cash_tables
+        if vat:
+            tables.append(vat_summary.table())
+        with metrics.stage('write'):
+            write_excel(totali, _cancellable(fatture, cancel), output_file, fields=fields, tables=tables)
+    if cashflow and not excel:
+        from xml_invoice_sinks import export_tables
+        with metrics.stage('cashflow'):
+            cash_tables = cashflow_tables(schedule.build(), cashflow, as_of)
+            export_tables(cash_tables, output_file)
+    if vat and not excel:
+        from xml_invoice_sinks import export_tables
+        export_tables([vat_summary.table()], output_file)
+    if lines_file:
+        from xml_invoice_lines import export_lines
+        with metrics.stage('lines'):
+            file_paths = iter_xml_files(folder_path)
+            kept = duplicates.kept if duplicates is not None else None
+            if kept is not None:
+                kept_paths = {key[0] for key in kept}
+                file_paths = (file_path for file_path in file_paths if file_path in kept_paths)
+            lines, lines_files, lines_errors = export_lines(file_paths, lines_file, start_date, end_date,
+                                                            invoices=kept)
+    metrics.finish()
+
+    if metrics.errors:
+        breakdown = ', '.join(f"{name}: {n}" for name, n in sorted(metrics.errors.items()))
+        print(f"Errors: {sum(metrics.errors.values())} files could not be processed ({breakdown})")
+    print(f"\nProcessed {count} invoices")
     print(f"Generated summary for {len(totali)} suppliers in {output_file}")
+    if cashflow:
+        overdue = sum(row[-1] for row in cash_tables[-1][3])
+        print(f"Cash flow: {len(schedule)} installments due in {len(cash_tables[-2][3])} {cashflow}s, "
+              f"{to_decimal(overdue):,.2f} overdue as of {as_of}")
+    if vat:
+        for key_periodo, (imponibile, imposta) in vat_summary.totals_by_periodo().items():
+            print(f"VAT {key_periodo}: imponibile {to_decimal(imponibile):,.2f}, "
+                  f"imposta {to_decimal(imposta):,.2f}")
+    if lines_file:
+        print(f"Exported {lines} lines from {lines_files} files to {lines_file}")
+        if lines_errors:
+            # Mostly the files already counted in the errors above, hence not added to them
+            print(f"Line items: {lines_errors} files could not be read in full")
+    if metrics_json:
+        metrics.write_json(metrics_json)
+    if metrics_prom:
+        metrics.write_prometheus(metrics_prom)
 
 if __name__ == "__main__":
-    import sys
-    if len(sys.argv) != 4:
-        print("Usage: python script.py <folder_path> <start_date> <end_date>")
-        print("Dates should be in YYYY-MM-DD format")
-        sys.exit(1)
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Summarize FatturaPA XML invoices into an Excel file or a data export.",
+        epilog="Dates should be in YYYY-MM-DD format")
+    parser.add_argument("folder_path", help="folder of invoices, or a .zip archive of them")
+    parser.add_argument("start_date")
+    parser.add_argument("end_date")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of parser processes (0 = one per CPU, default 1)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="parse every file again, ignoring the parse cache")
+    parser.add_argument("--cache-file", default=DEFAULT_CACHE_FILE,
+                        help=f"parse cache location (default {DEFAULT_CACHE_FILE})")
+    parser.add_argument("--no-index", action="store_true",
+                        help="do not use the date index to skip out-of-range files")
+    parser.add_argument("--index-file", default=DEFAULT_INDEX_FILE,
+                        help=f"date index location (default {DEFAULT_INDEX_FILE})")
+    parser.add_argument("--columnar", action="store_true",
+                        help="collect invoices in a NumPy-backed FatturaBatch (needs numpy)")
+    parser.add_argument("--streaming-excel", action="store_true",
+                        help="write the workbook with the constant-memory streaming writer")
+    parser.add_argument("-o", "--output", default=DEFAULT_OUTPUT_FILE,
+                        help="output file; .xlsx, .csv[.gz], .jsonl[.gz], .parquet or .arrow "
+                             f"(default {DEFAULT_OUTPUT_FILE})")
+    parser.add_argument("--summary-output",
+                        help="per-cedente totals file for non-Excel outputs (default <output>-totali)")
+    parser.add_argument("--metrics-json", help="write per-stage run metrics to this JSON file")
+    parser.add_argument("--metrics-prom",
+                        help="write run metrics to this .prom file for the Prometheus textfile collector")
+    parser.add_argument("--verify-signatures", action="store_true",
+                        help="verify the signatures of .p7m files first (needs cryptography)")
+    parser.add_argument("--signature-cache-file",
+                        help="signature verification cache (default fattura-pa-signatures.sqlite)")
+    parser.add_argument("--fields",
+                        help="JSON file of extra columns to extract, e.g. "
+                             '{"fields": ["importo_totale_documento", "causale"]}')
+    parser.add_argument("--validate", action="store_true",
+                        help="validate every file against the bundled FatturaPA XSD first (needs lxml)")
+    parser.add_argument("--validation-report",
+                        help="violation report of --validate, CSV (default fattura-pa-validation.csv)")
+    parser.add_argument("--cashflow", choices=['week', 'month'],
+                        help="list every installment and report the amounts due per week or month "
+                             "and the overdue ageing (needs numpy)")
+    parser.add_argument("--vat", choices=['quarter', 'month'],
+                        help="sum the VAT summaries (DatiRiepilogo) per quarter or month, "
+                             "aliquota and natura, credit notes subtracted")
+    parser.add_argument("--as-of", help="reference date of the ageing, YYYY-MM-DD (default today)")
+    parser.add_argument("--lines",
+                        help="also stream every DettaglioLinee to this .csv[.gz], .jsonl[.gz], "
+                             ".parquet or .arrow file, in constant memory")
+    parser.add_argument("--dedup", choices=['first-wins', 'newest-wins', 'report-only'],
+                        help="check invoices found in more than one file: keep the first copy, "
+                             "the newest one, or all of them, and report the duplicates")
+    parser.add_argument("--dedup-index",
+                        help="persistent invoice index of --dedup (default fattura-pa-dedup.sqlite)")
+    parser.add_argument("--dedup-report",
+                        help="duplicate report of --dedup; .csv, .jsonl, .parquet or .arrow "
+                             "(default fattura-pa-duplicates.csv)")
+    parser.add_argument("--no-bloom", action="store_true",
+                        help="look every invoice up in the --dedup index, without the Bloom filter")
+    parser.add_argument("--parser", choices=BACKENDS, default='auto',
+                        help="XML parser backend (default auto: lxml when installed, else ElementTree)")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default='off',
+                        help="per-file log on stderr (default off)")
+    args = parser.parse_args()
+    configure_logging(args.log_level)
         
-    main(sys.argv[1], sys.argv[2], sys.argv[3])
\ No newline at end of file
+    main(args.folder_path, args.start_date, args.end_date, workers=args.workers,
+         use_cache=not args.no_cache, cache_file=args.cache_file, use_index=not args.no_index,
+         columnar=args.columnar, streaming_excel=args.streaming_excel,
+         output_file=args.output, summary_file=args.summary_output,
+         metrics_json=args.metrics_json, metrics_prom=args.metrics_prom,
+         verify_signatures=args.verify_signatures, signature_cache_file=args.signature_cache_file,
+         fields_config=args.fields, parser_backend=args.parser,
+         validate=args.validate, validation_report=args.validation_report,
+         cashflow=args.cashflow, as_of_str=args.as_of, lines_file=args.lines, vat=args.vat,
+         dedup=args.dedup, dedup_index_file=args.dedup_index, dedup_report=args.dedup_report,
+         bloom=not args.no_bloom, index_file=args.index_file)
@@ -1,15 +1,23 @@
+import queue
+import threading
+import time
 import tkinter as tk
 from tkinter import ttk
 from tkinter import filedialog
 from tkcalendar import DateEntry
-from datetime import datetime
+from datetime import datetime, timedelta
 import xml_invoice_processor
 
+# Seconds between progress messages sent by the worker thread
+PROGRESS_INTERVAL = 0.1
+
 class InvoiceProcessorGUI:
     def __init__(self, root):
         self.root = root
         self.root.title("XML Invoice Processor")
-        self.root.geometry("600x400")
+        self.root.geometry("600x420")
+        self.messages = queue.Queue()
+        self.cancel_event = None
         
         # Create main frame with padding
         main_frame = ttk.Frame(root, padding="20")
@@ -34,58 +42,151 @@ class InvoiceProcessorGUI:
                                 foreground='white', borderwidth=2)
         self.end_date.grid(row=2, column=1, sticky=tk.W, padx=5, pady=5)
         
-        # Process Button
-        self.process_button = ttk.Button(main_frame, text="Process Invoices", 
+        # Output File
+        ttk.Label(main_frame, text="Output File:").grid(row=3, column=0, sticky=tk.W, pady=5)
+        self.output_path = tk.StringVar(value=xml_invoice_processor.DEFAULT_OUTPUT_FILE)
+        ttk.Entry(main_frame, textvariable=self.output_path, width=50).grid(row=3, column=1, padx=5, pady=5)
+        ttk.Button(main_frame, text="Save As", command=self.browse_output).grid(row=3, column=2, pady=5)
+        
+        # Parse cache
+        self.use_cache = tk.BooleanVar(value=True)
+        ttk.Checkbutton(main_frame, text="Reuse unchanged invoices from the parse cache",
+                        variable=self.use_cache).grid(row=4, column=1, sticky=tk.W, padx=5, pady=5)
+        
+        # Process and Cancel Buttons
+        buttons = ttk.Frame(main_frame)
+        buttons.grid(row=5, column=0, columnspan=3, pady=20)
+        self.process_button = ttk.Button(buttons, text="Process Invoices", 
                                        command=self.process_invoices)
-        self.process_button.grid(row=3, column=0, columnspan=3, pady=20)
+        self.process_button.grid(row=0, column=0, padx=5)
+        self.cancel_button = ttk.Button(buttons, text="Cancel", command=self.cancel_processing,
+                                        state='disabled')
+        self.cancel_button.grid(row=0, column=1, padx=5)
         
         # Status Label
         self.status_label = ttk.Label(main_frame, text="")
-        self.status_label.grid(row=4, column=0, columnspan=3, pady=5)
+        self.status_label.grid(row=6, column=0, columnspan=3, pady=5)
         
         # Progress Bar
-        self.progress = ttk.Progressbar(main_frame, length=400, mode='indeterminate')
-        self.progress.grid(row=5, column=0, columnspan=3, pady=5)
+        self.progress = ttk.Progressbar(main_frame, length=400, mode='determinate')
+        self.progress.grid(row=7, column=0, columnspan=3, pady=5)
         
     def browse_folder(self):
         folder_selected = filedialog.askdirectory()
         self.folder_path.set(folder_selected)
         
+    def browse_output(self):
+        output_selected = filedialog.asksaveasfilename(
+            defaultextension='.xlsx',
+            initialfile=self.output_path.get(),
+            filetypes=[('Excel workbook', '*.xlsx'), ('CSV', '*.csv'), ('JSON Lines', '*.jsonl'),
+                       ('Parquet', '*.parquet'), ('All files', '*.*')])
+        if output_selected:
+            self.output_path.set(output_selected)
+        
     def process_invoices(self):
         # Get values
         folder = self.folder_path.get()
         start_date = self.start_date.get_date().strftime('%Y-%m-%d')
         end_date = self.end_date.get_date().strftime('%Y-%m-%d')
         
+        output_file = self.output_path.get()
+        
         if not folder:
             self.status_label.config(text="Please select a folder first!", foreground="red")
             return
+        if not output_file:
+            self.status_label.config(text="Please choose an output file first!", foreground="red")
+            return
             
         # Update UI
         self.status_label.config(text="Processing...", foreground="blue")
         self.process_button.config(state='disabled')
-        self.progress.start()
+        self.cancel_button.config(state='normal')
+        self.progress.config(value=0, maximum=1)
         
-        # Schedule the processing to run in a separate thread
-        self.root.after(100, lambda: self.run_processing(folder, start_date, end_date))
+        # Run the pipeline on a worker thread; it reports back through self.messages
+        self.cancel_event = threading.Event()
+        worker = threading.Thread(
+            target=self.run_processing,
+            args=(folder, start_date, end_date, self.use_cache.get(), output_file, self.cancel_event),
+            daemon=True)
+        worker.start()
+        self.started = time.monotonic()
+        self.root.after(100, self.poll_messages)
+        
+    def cancel_processing(self):
+        if self.cancel_event is not None:
+            self.cancel_event.set()
+            self.cancel_button.config(state='disabled')
+            self.status_label.config(text="Cancelling...", foreground="blue")
+        
+    def run_processing(self, folder, start_date, end_date, use_cache, output_file, cancel_event):
+        """Worker thread: never touches Tk widgets, only posts messages to the queue."""
+        last_report = [0.0]
+        
+        def progress(done, total):
+            now = time.monotonic()
+            if done == total or now - last_report[0] >= PROGRESS_INTERVAL:
+                last_report[0] = now
+                self.messages.put(('progress', done, total))
         
-    def run_processing(self, folder, start_date, end_date):
         try:
             # Call the main function from your existing script
-            xml_invoice_processor.main(folder, start_date, end_date)
-            self.status_label.config(
-                text="Processing completed! Output file: fattura-pa-summary.xlsx",
-                foreground="green"
-            )
+            xml_invoice_processor.main(folder, start_date, end_date, use_cache=use_cache,
+                                       output_file=output_file, progress=progress, cancel=cancel_event)
+            self.messages.put(('done', output_file))
+        except xml_invoice_processor.ProcessingCancelled:
+            self.messages.put(('cancelled',))
         except Exception as e:
-            self.status_label.config(
-                text=f"Error: {str(e)}",
-                foreground="red"
-            )
-        finally:
+            self.messages.put(('error', str(e)))
+        
+    def poll_messages(self):
+        """Apply the worker's messages on the Tk thread, then check again shortly."""
+        finished = False
+        while True:
+            try:
+                message = self.messages.get_nowait()
+            except queue.Empty:
+                break
+            kind = message[0]
+            if kind == 'progress':
+                self.show_progress(message[1], message[2])
+            elif kind == 'done':
+                self.status_label.config(
+                    text=f"Processing completed! Output file: {message[1]}",
+                    foreground="green"
+                )
+                finished = True
+            elif kind == 'cancelled':
+                self.status_label.config(text="Processing cancelled", foreground="red")
+                finished = True
+            elif kind == 'error':
+                self.status_label.config(
+                    text=f"Error: {message[1]}",
+                    foreground="red"
+                )
+                finished = True
+        if finished:
             # Reset UI
-            self.progress.stop()
+            self.cancel_event = None
             self.process_button.config(state='normal')
+            self.cancel_button.config(state='disabled')
+        else:
+            self.root.after(100, self.poll_messages)
+        
+    def show_progress(self, done, total):
+        self.progress.config(maximum=max(total, 1), value=done)
+        if done == total:
+            self.status_label.config(text=f"Read {total} files, writing the output...", foreground="blue")
+            return
+        elapsed = time.monotonic() - self.started
+        rate = done / elapsed if elapsed > 0 else 0
+        eta = timedelta(seconds=round((total - done) / rate)) if rate > 0 else "unknown"
+        self.status_label.config(
+            text=f"{done}/{total} files, {rate:.0f} files/s, ETA {eta}",
+            foreground="blue"
+        )
 
 def main():
     root = tk.Tk()
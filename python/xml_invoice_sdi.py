@@ -0,0 +1,359 @@
+import base64
+import binascii
+import contextlib
+import datetime
+import http.client
+import os
+import queue
+import random
+import socket
+import ssl
+import threading
+import time
+import urllib.parse
+import xml.etree.ElementTree as ET
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Tuple
+
+from xml_invoice_metrics import LOG_LEVELS, configure_logging, log
+
+SOAP_NAMESPACE = 'http://schemas.xmlsoap.org/soap/envelope/'
+SDI_NAMESPACE = 'http://www.fatturapa.gov.it/sdi/ws/ricerca/v1.0'
+DEFAULT_CONNECTIONS = 8
+DEFAULT_TIMEOUT = 30.0
+DEFAULT_RETRIES = 4
+# Search windows, in days: a month is searched with one request per day, concurrently
+DEFAULT_WINDOW_DAYS = 1
+# HTTP statuses worth another attempt: throttling and transient gateway errors
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+class SDIError(Exception):
+    """A request failed for good: a SOAP fault, a non-retryable status or retries exhausted."""
+
+@dataclass
+class FatturaRicevuta:
+    """One entry of a RicercaFatture result."""
+    identificativo_sdi: str
+    nome_file: str
+    data: datetime.date
+
+@dataclass
+class DownloadSummary:
+    downloaded: int
+    skipped: int
+    failed: int
+    bytes: int
+    retries: int
+
+def _envelope(operation: str, **params: str) -> bytes:
+    ET.register_namespace('soapenv', SOAP_NAMESPACE)
+    envelope = ET.Element(f'{{{SOAP_NAMESPACE}}}Envelope')
+    request = ET.SubElement(ET.SubElement(envelope, f'{{{SOAP_NAMESPACE}}}Body'), f'{{{SDI_NAMESPACE}}}{operation}')
+    for name, value in params.items():
+        ET.SubElement(request, f'{{{SDI_NAMESPACE}}}{name}').text = value
+    return ET.tostring(envelope, encoding='utf-8', xml_declaration=True)
+
+class ConnectionPool:
+    """Up to `size` keep-alive HTTP(S) connections to one host, shared by threads.
+
+    A connection is taken for one request and given back afterwards; one that
+    failed is closed instead, and a fresh one is opened on the next demand.
+    """
+
+    def __init__(self, url: str, size: int = DEFAULT_CONNECTIONS, timeout: float = DEFAULT_TIMEOUT,
+                 ssl_context: Optional[ssl.SSLContext] = None):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError(f"Unsupported SDI endpoint {url}: use an http(s) URL")
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path or '/'
+        self.https = parts.scheme == 'https'
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+        self._idle = queue.LifoQueue()
+        # Bounds the connections open at once, idle or in use
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self) -> http.client.HTTPConnection:
+        if self.https:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout,
+                                               context=self.ssl_context)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    @contextlib.contextmanager
+    def connection(self):
+        self._slots.acquire()
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            yield conn
+        except BaseException:
+            conn.close()
+            self._slots.release()
+            raise
+        self._idle.put(conn)
+        self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+class SDIClient:
+    """Client of the SDI invoice search service, safe to share between threads.
+
+    Requests go through a pool of keep-alive connections, at most `connections`
+    at a time. A request that times out (`timeout` seconds for the whole
+    exchange), loses its connection or gets a RETRY_STATUSES answer is retried
+    up to `retries` times, after an exponential backoff with jitter
+    (backoff x 2^attempt seconds, at most max_backoff, or the server's Retry-After).
+    For mutual TLS, cert_file (and key_file) are PEM files; convert a .p12 first.
+    """
+
+    def __init__(self, url: str, cert_file: Optional[str] = None, key_file: Optional[str] = None,
+                 password: Optional[str] = None, connections: int = DEFAULT_CONNECTIONS,
+                 timeout: float = DEFAULT_TIMEOUT, retries: int = DEFAULT_RETRIES,
+                 backoff: float = 0.5, max_backoff: float = 30.0, ca_file: Optional[str] = None):
+        context = None
+        if url.startswith('https:'):
+            context = ssl.create_default_context(cafile=ca_file)
+            if cert_file:
+                context.load_cert_chain(cert_file, key_file, password)
+        self.connections = connections
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retried = 0
+        self._pool = ConnectionPool(url, connections, timeout, context)
+        self._lock = threading.Lock()
+
+    def close(self):
+        self._pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _post(self, operation: str, body: bytes) -> Tuple[int, Optional[str], bytes]:
+        """One POST on a pooled connection: (status, Retry-After, body).
+
+        The socket timeout only bounds each wait, so a watchdog shuts the socket
+        down once `timeout` seconds have passed: connecting, sending, the headers
+        and the body all count, and a server answering a byte at a time is cut off.
+        """
+        with self._pool.connection() as conn:
+            expired = threading.Event()
+
+            def expire():
+                expired.set()
+                sock = conn.sock
+                if sock is not None:
+                    with contextlib.suppress(OSError):
+                        sock.shutdown(socket.SHUT_RDWR)
+
+            watchdog = threading.Timer(self.timeout, expire)
+            watchdog.start()
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                # A connection made after the watchdog fired was not shut down
+                if expired.is_set():
+                    raise TimeoutError()
+                conn.request('POST', self._pool.path, body=body, headers={
+                    'Content-Type': 'text/xml; charset=utf-8',
+                    'SOAPAction': f'"{SDI_NAMESPACE}/{operation}"',
+                })
+                response = conn.getresponse()
+                content = response.read()
+            except (OSError, http.client.HTTPException):
+                if expired.is_set():
+                    raise TimeoutError(f"{operation} took more than {self.timeout}s") from None
+                raise
+            finally:
+                watchdog.cancel()
+            if expired.is_set():
+                # Answered just in time, but the socket may be shut down: don't pool it
+                raise TimeoutError(f"{operation} took more than {self.timeout}s")
+            if response.will_close:
+                conn.close()
+            return response.status, response.getheader('Retry-After'), content
+
+    def _delay(self, attempt: int, retry_after: Optional[str]) -> float:
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.max_backoff)
+        return random.uniform(0.5, 1.0) * min(self.max_backoff, self.backoff * 2 ** attempt)
+
+    def call(self, operation: str, **params: str) -> ET.Element:
+        """Invoke a SOAP operation and return the element of its response."""
+        body = _envelope(operation, **params)
+        for attempt in range(self.retries + 1):
+            retry_after = None
+            try:
+                status, retry_after, content = self._post(operation, body)
+            except (OSError, http.client.HTTPException) as e:
+                # Timeouts and dropped connections: the request may be repeated safely
+                error = f"{type(e).__name__}: {e}"
+            else:
+                if status == 200 or (status == 500 and b'Fault>' in content):
+                    return self._parse(operation, content)
+                error = f"HTTP {status}"
+                if status not in RETRY_STATUSES:
+                    raise SDIError(f"{operation} failed with {error}")
+            if attempt == self.retries:
+                raise SDIError(f"{operation} failed after {attempt + 1} attempts: {error}")
+            delay = self._delay(attempt, retry_after)
+            log.info(f"{operation} failed ({error}), retrying in {delay:.2f}s")
+            with self._lock:
+                self.retried += 1
+            time.sleep(delay)
+
+    @staticmethod
+    def _parse(operation: str, content: bytes) -> ET.Element:
+        try:
+            body = ET.fromstring(content).find(f'{{{SOAP_NAMESPACE}}}Body')
+        except ET.ParseError as e:
+            raise SDIError(f"{operation}: malformed response: {e}") from None
+        if body is None:
+            raise SDIError(f"{operation}: response without a SOAP Body")
+        fault = body.find(f'{{{SOAP_NAMESPACE}}}Fault')
+        if fault is not None:
+            raise SDIError(f"{operation}: SOAP fault {fault.findtext('faultcode')}: "
+                           f"{fault.findtext('faultstring')}")
+        response = body.find(f'{{{SDI_NAMESPACE}}}{operation}Response')
+        if response is None:
+            raise SDIError(f"{operation}: no {operation}Response in the SOAP Body")
+        return response
+
+    def ricerca_fatture(self, data_inizio: datetime.date, data_fine: datetime.date) -> List[FatturaRicevuta]:
+        """The invoices dated from data_inizio to data_fine, both included (one request)."""
+        response = self.call('RicercaFatture', DataInizio=data_inizio.isoformat(),
+                             DataFine=data_fine.isoformat())
+        return [FatturaRicevuta(item.findtext(f'{{{SDI_NAMESPACE}}}IdentificativoSdI'),
+                                item.findtext(f'{{{SDI_NAMESPACE}}}NomeFile'),
+                                datetime.date.fromisoformat(item.findtext(f'{{{SDI_NAMESPACE}}}Data')))
+                for item in response.iter(f'{{{SDI_NAMESPACE}}}Fattura')]
+
+    def scarica_fattura(self, identificativo_sdi: str) -> bytes:
+        """The file of an invoice, as received by SDI (XML or signed .p7m)."""
+        response = self.call('DownloadFattura', IdentificativoSdI=identificativo_sdi)
+        return base64.b64decode(response.findtext(f'{{{SDI_NAMESPACE}}}File') or '')
+
+    def iter_ricerca(self, data_inizio: datetime.date, data_fine: datetime.date,
+                     window_days: int = DEFAULT_WINDOW_DAYS) -> Iterator[FatturaRicevuta]:
+        """Search the period in windows of window_days, concurrently; results come by window."""
+        windows = []
+        start = data_inizio
+        while start <= data_fine:
+            end = min(data_fine, start + datetime.timedelta(days=window_days - 1))
+            windows.append((start, end))
+            start = end + datetime.timedelta(days=1)
+        with ThreadPoolExecutor(max_workers=self.connections) as executor:
+            for result in executor.map(lambda window: self.ricerca_fatture(*window), windows):
+                yield from result
+
+    def scarica_periodo(self, data_inizio: datetime.date, data_fine: datetime.date, folder_path: str,
+                        window_days: int = DEFAULT_WINDOW_DAYS) -> DownloadSummary:
+        """Download every invoice of the period into folder_path, `connections` at a time.
+
+        Each file is written under its NomeFile as soon as it arrives (through a
+        temporary name, so an interrupted run leaves no partial file); files
+        already in the folder are not downloaded again. An invoice without a
+        NomeFile, that still fails after the retries, or that cannot be decoded or
+        written, is logged and counted, and the others go on.
+        """
+        os.makedirs(folder_path, exist_ok=True)
+        downloaded = skipped = failed = size = 0
+        # The NomeFile of each download queued, bounded whatever the number of invoices
+        in_flight = {}
+        with ThreadPoolExecutor(max_workers=self.connections) as executor:
+            def collect(done):
+                nonlocal downloaded, failed, size
+                for future in done:
+                    nome_file = in_flight.pop(future)
+                    try:
+                        size += future.result()
+                        downloaded += 1
+                    except (SDIError, binascii.Error, OSError, TypeError) as e:
+                        # Malformed base64, a full disk or an odd answer cost this invoice only
+                        log.warning(f"Download of {nome_file} failed: {e}")
+                        failed += 1
+
+            for fattura in self.iter_ricerca(data_inizio, data_fine, window_days):
+                name = os.path.basename(fattura.nome_file or '')
+                if name in ('', '.', '..'):
+                    log.warning(f"Invoice {fattura.identificativo_sdi} has no usable NomeFile "
+                                f"({fattura.nome_file!r}), not downloaded")
+                    failed += 1
+                    continue
+                target = os.path.join(folder_path, name)
+                if os.path.exists(target):
+                    skipped += 1
+                    continue
+                if len(in_flight) >= 2 * self.connections:
+                    collect(wait(in_flight, return_when=FIRST_COMPLETED).done)
+                in_flight[executor.submit(self._scarica_in, fattura, target)] = fattura.nome_file
+            collect(wait(in_flight).done)
+        return DownloadSummary(downloaded=downloaded, skipped=skipped, failed=failed, bytes=size,
+                               retries=self.retried)
+
+    def _scarica_in(self, fattura: FatturaRicevuta, target: str) -> int:
+        content = self.scarica_fattura(fattura.identificativo_sdi)
+        partial = target + '.part'
+        try:
+            with open(partial, 'wb') as f:
+                f.write(content)
+            os.replace(partial, target)
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(partial)
+            raise
+        return len(content)
+
+def main(url: str, start_date_str: str, end_date_str: str, folder_path: str, **options):
+    """Download the invoices of the period from the SDI endpoint into the folder."""
+    from xml_invoice_processor import parse_date
+    start = time.perf_counter()
+    with SDIClient(url, **options) as client:
+        summary = client.scarica_periodo(parse_date(start_date_str), parse_date(end_date_str), folder_path)
+    elapsed = time.perf_counter() - start
+    print(f"Downloaded {summary.downloaded} invoices ({summary.bytes / 2 ** 20:.1f} MB) to {folder_path} "
+          f"in {elapsed:.1f}s, {summary.skipped} already there")
+    print(f"Retries: {summary.retries}, failed: {summary.failed}")
+    return 1 if summary.failed else 0
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(
+        description="Download the invoices of a period from the SDI search service, concurrently.",
+        epilog="Dates should be in YYYY-MM-DD format")
+    parser.add_argument("url", help="service endpoint, e.g. https://servizi.fatturapa.it/ServizioSDI")
+    parser.add_argument("start_date")
+    parser.add_argument("end_date")
+    parser.add_argument("-o", "--output", required=True, help="folder the invoices are saved to")
+    parser.add_argument("--cert", help="client certificate, PEM")
+    parser.add_argument("--key", help="private key of the certificate, PEM (default: in --cert)")
+    parser.add_argument("--password", help="password of the private key")
+    parser.add_argument("--ca-file", help="CA bundle to verify the server with (default: system)")
+    parser.add_argument("--connections", type=int, default=DEFAULT_CONNECTIONS,
+                        help=f"concurrent requests and pooled connections (default {DEFAULT_CONNECTIONS})")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT,
+                        help=f"seconds allowed per request (default {DEFAULT_TIMEOUT:g})")
+    parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES,
+                        help=f"attempts after the first for a failed request (default {DEFAULT_RETRIES})")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default='off',
+                        help="per-request log on stderr (default off)")
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+    sys.exit(main(args.url, args.start_date, args.end_date, args.output, cert_file=args.cert,
+                  key_file=args.key, password=args.password, ca_file=args.ca_file,
+                  connections=args.connections, timeout=args.timeout, retries=args.retries))
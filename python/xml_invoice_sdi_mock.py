@@ -0,0 +1,187 @@
+import base64
+import datetime
+import os
+import random
+import threading
+import time
+import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+from xml_invoice_index import prefilter_dates
+from xml_invoice_metrics import LOG_LEVELS, configure_logging, log
+from xml_invoice_sdi import SDI_NAMESPACE, SOAP_NAMESPACE
+from xml_invoice_zip import open_raw
+
+DEFAULT_PORT = 8089
+
+class MockSDIServer(ThreadingHTTPServer):
+    """Local stand-in for the SDI search service, serving the invoices of a folder.
+
+    RicercaFatture lists the files whose first invoice date is in the range, and
+    DownloadFattura returns one file base64-encoded, as SDIClient expects. Every
+    request waits `latency` seconds, mimicking a network round trip, and with
+    probability failure_rate fails: half the time with a 503, half the time by
+    dropping the connection. stall_rate answers after `stall` seconds instead,
+    to exercise client timeouts. `requests` counts the requests by operation.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, folder_path: str, host: str = '127.0.0.1', port: int = DEFAULT_PORT,
+                 latency: float = 0.0, failure_rate: float = 0.0, stall_rate: float = 0.0,
+                 stall: float = 60.0, seed: Optional[int] = None):
+        from xml_invoice_processor import iter_fatture_from_file, iter_xml_files
+        self.files: Dict[str, Tuple[str, datetime.date]] = {}
+        for file_path in iter_xml_files(folder_path):
+            dates = prefilter_dates(file_path)
+            if not dates:
+                try:
+                    dates = [fattura.data for fattura in iter_fatture_from_file(file_path)]
+                except (ET.ParseError, ValueError, OSError) as e:
+                    log.warning(f"Not served, unreadable: {file_path}: {e}")
+                    continue
+            if dates:
+                self.files[str(len(self.files) + 1)] = (file_path, dates[0])
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.stall_rate = stall_rate
+        self.stall = stall
+        self.requests: Dict[str, int] = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        super().__init__((host, port), _Handler)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/ServizioSDI"
+
+    def handle_error(self, request, client_address):
+        # Clients that timed out and hung up during a stall are expected here
+        log.debug(f"Request from {client_address[0]}:{client_address[1]} aborted")
+
+    def draw(self) -> float:
+        with self._lock:
+            return self._random.random()
+
+    def count(self, operation: str):
+        with self._lock:
+            self.requests[operation] = self.requests.get(operation, 0) + 1
+
+    def ricerca(self, start: datetime.date, end: datetime.date) -> List[Tuple[str, str, datetime.date]]:
+        return [(identificativo, os.path.basename(file_path), data)
+                for identificativo, (file_path, data) in self.files.items() if start <= data <= end]
+
+def _envelope(body: ET.Element) -> bytes:
+    ET.register_namespace('soapenv', SOAP_NAMESPACE)
+    envelope = ET.Element(f'{{{SOAP_NAMESPACE}}}Envelope')
+    ET.SubElement(envelope, f'{{{SOAP_NAMESPACE}}}Body').append(body)
+    return ET.tostring(envelope, encoding='utf-8', xml_declaration=True)
+
+def _fault(code: str, message: str) -> bytes:
+    fault = ET.Element(f'{{{SOAP_NAMESPACE}}}Fault')
+    ET.SubElement(fault, 'faultcode').text = f'soapenv:{code}'
+    ET.SubElement(fault, 'faultstring').text = message
+    return _envelope(fault)
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep-alive, so pooled client connections are reused
+    protocol_version = 'HTTP/1.1'
+    server: MockSDIServer
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+    def _send(self, status: int, content: bytes, headers: Optional[Dict[str, str]] = None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        draw = server.draw()
+        if draw < server.failure_rate / 2:
+            self._send(503, b'', {'Retry-After': '0'})
+            return
+        if draw < server.failure_rate:
+            self.close_connection = True
+            return
+        if draw < server.failure_rate + server.stall_rate:
+            time.sleep(server.stall)
+
+        try:
+            request = ET.fromstring(body).find(f'{{{SOAP_NAMESPACE}}}Body')[0]
+        except (ET.ParseError, TypeError, IndexError):
+            self._send(500, _fault('Client', "Malformed SOAP request"))
+            return
+        operation = request.tag.rpartition('}')[2]
+        server.count(operation)
+        response = ET.Element(f'{{{SDI_NAMESPACE}}}{operation}Response')
+        if operation == 'RicercaFatture':
+            try:
+                start = datetime.date.fromisoformat(request.findtext(f'{{{SDI_NAMESPACE}}}DataInizio')[:10])
+                end = datetime.date.fromisoformat(request.findtext(f'{{{SDI_NAMESPACE}}}DataFine')[:10])
+            except (TypeError, ValueError):
+                self._send(500, _fault('Client', "DataInizio and DataFine must be YYYY-MM-DD dates"))
+                return
+            for identificativo, nome_file, data in server.ricerca(start, end):
+                item = ET.SubElement(response, f'{{{SDI_NAMESPACE}}}Fattura')
+                ET.SubElement(item, f'{{{SDI_NAMESPACE}}}IdentificativoSdI').text = identificativo
+                ET.SubElement(item, f'{{{SDI_NAMESPACE}}}NomeFile').text = nome_file
+                ET.SubElement(item, f'{{{SDI_NAMESPACE}}}Data').text = data.isoformat()
+        elif operation == 'DownloadFattura':
+            entry = server.files.get(request.findtext(f'{{{SDI_NAMESPACE}}}IdentificativoSdI'))
+            if entry is None:
+                self._send(500, _fault('Client', "Unknown IdentificativoSdI"))
+                return
+            with open_raw(entry[0]) as f:
+                content = f.read()
+            ET.SubElement(response, f'{{{SDI_NAMESPACE}}}NomeFile').text = os.path.basename(entry[0])
+            ET.SubElement(response, f'{{{SDI_NAMESPACE}}}File').text = base64.b64encode(content).decode('ascii')
+        else:
+            self._send(500, _fault('Client', f"Unknown operation {operation}"))
+            return
+        self._send(200, _envelope(response))
+
+def serve_in_thread(folder_path: str, port: int = 0, **options) -> MockSDIServer:
+    """Start a mock server on a background thread (port 0 picks a free one); call shutdown() to stop."""
+    server = MockSDIServer(folder_path, port=port, **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Serve a folder of invoices as a mock SDI search service, for SDIClient tests.")
+    parser.add_argument("folder_path", help="folder of invoices, or a .zip archive of them")
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"default {DEFAULT_PORT}")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--failure-rate", type=float, default=0.0,
+                        help="share of requests failing with a 503 or a dropped connection")
+    parser.add_argument("--stall-rate", type=float, default=0.0,
+                        help="share of requests answered only after --stall seconds")
+    parser.add_argument("--stall", type=float, default=60.0)
+    parser.add_argument("--seed", type=int, help="seed of the failure draws")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default='off',
+                        help="request log on stderr (default off)")
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+    server = MockSDIServer(args.folder_path, args.host, args.port, latency=args.latency,
+                           failure_rate=args.failure_rate, stall_rate=args.stall_rate, stall=args.stall,
+                           seed=args.seed)
+    print(f"Serving {len(server.files)} invoices at {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
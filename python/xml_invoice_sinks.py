@@ -0,0 +1,319 @@
+import csv
+import datetime
+import gzip
+import json
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from xml_invoice_amounts import amount_scale, format_amount, to_decimal
+from xml_invoice_fields import FieldSpec
+from xml_invoice_processor import Fattura, TotaleFattureCedente, aggregate_by_cedente
+
+# Column schemas: (name, kind) with kind one of 'str', 'int', 'date', 'amount' (integer cents)
+# or 'amount:<scale>'; amounts stay integers until a sink writes them
+Columns = Sequence[Tuple[str, str]]
+
+FATTURA_COLUMNS: Columns = [
+    ('cedente_id_fiscale', 'str'),
+    ('cedente_denominazione', 'str'),
+    ('cedente_regime_fiscale', 'str'),
+    ('divisa', 'str'),
+    ('data', 'date'),
+    ('numero', 'str'),
+    ('data_scadenza_pagamento', 'date'),
+    ('importo_pagamento', 'amount'),
+]
+
+TOTALE_COLUMNS: Columns = [
+    ('cedente_id_fiscale', 'str'),
+    ('cedente_denominazione', 'str'),
+    ('totale_pagamenti', 'amount'),
+]
+
+def fattura_columns(fields: Sequence[FieldSpec] = ()) -> Columns:
+    """FATTURA_COLUMNS followed by a column per extra field."""
+    return list(FATTURA_COLUMNS) + [(spec.name, spec.column_kind) for spec in fields]
+
+def fattura_row(fattura: Fattura, fields: Sequence[FieldSpec] = ()) -> tuple:
+    return (
+        fattura.cedente_id_fiscale,
+        fattura.cedente_denominazione,
+        fattura.cedente_regime_fiscale,
+        fattura.divisa,
+        fattura.data,
+        fattura.numero,
+        fattura.data_scadenza_pagamento,
+        fattura.importo_pagamento
+    ) + tuple(fattura.extra.get(spec.name) for spec in fields)
+
+def totale_row(totale: TotaleFattureCedente) -> tuple:
+    return (totale.cedente_id_fiscale, totale.cedente_denominazione, totale.totale_pagamenti)
+
+class Sink:
+    """Streaming output writer.
+
+    Rows are tuples in `columns` order and can be written one at a time or in
+    batches of columns ({name: array-like}), e.g. FatturaBatch.to_columns().
+    """
+
+    def __init__(self, path: str, columns: Columns):
+        self.path = path
+        self.columns = list(columns)
+        self.rows = 0
+
+    def write_rows(self, rows: Iterable[Sequence]):
+        raise NotImplementedError
+
+    def write_batch(self, columns: Dict[str, Sequence]):
+        """Write a batch given as one array-like per column."""
+        # tolist() turns NumPy values (datetime64[D] included) into plain Python objects
+        data = [columns[name] for name, _ in self.columns]
+        data = [col.tolist() if hasattr(col, 'tolist') else col for col in data]
+        self.write_rows(zip(*data))
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+def _open_text(path: str):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'wt', newline='', encoding='utf-8')
+    return open(path, 'w', newline='', encoding='utf-8')
+
+class CsvSink(Sink):
+    """CSV writer, gzip-compressed when the path ends in .gz."""
+
+    def __init__(self, path: str, columns: Columns):
+        super().__init__(path, columns)
+        self._file = _open_text(path)
+        self._writer = csv.writer(self._file)
+        self._writer.writerow([name for name, _ in self.columns])
+        self._amounts = _amount_columns(self.columns)
+
+    def write_rows(self, rows: Iterable[Sequence]):
+        amounts = self._amounts
+        for row in rows:
+            if amounts:
+                row = list(row)
+                for i, scale in amounts:
+                    if row[i] is not None:
+                        row[i] = format_amount(row[i], scale)
+            self._writer.writerow(row)
+            self.rows += 1
+
+    def close(self):
+        self._file.close()
+
+class JsonLinesSink(Sink):
+    """JSON Lines writer (one object per row), gzip-compressed when the path ends in .gz."""
+
+    def __init__(self, path: str, columns: Columns):
+        super().__init__(path, columns)
+        self._file = _open_text(path)
+        self._keys = [json.dumps(name, ensure_ascii=False) + ': ' for name, _ in self.columns]
+        self._scales = [amount_scale(kind) for _, kind in self.columns]
+        self._encode = json.JSONEncoder(ensure_ascii=False, default=_json_default).encode
+
+    def write_rows(self, rows: Iterable[Sequence]):
+        keys = self._keys
+        scales = self._scales
+        encode = self._encode
+        write = self._file.write
+        for row in rows:
+            # Amounts are written as JSON numbers with their exact decimals, never through float
+            write('{' + ', '.join(
+                key + ('null' if value is None
+                       else format_amount(value, scale) if scale is not None
+                       else encode(value))
+                for key, scale, value in zip(keys, scales, row)) + '}\n')
+            self.rows += 1
+
+    def close(self):
+        self._file.close()
+
+def _amount_columns(columns: Columns) -> List[Tuple[int, int]]:
+    """(index, scale) of the amount columns."""
+    return [(i, amount_scale(kind)) for i, (_, kind) in enumerate(columns) if amount_scale(kind) is not None]
+
+def _json_default(value):
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError("Parquet and Arrow output need pyarrow: pip install pyarrow") from None
+    return pyarrow
+
+class _ArrowSink(Sink):
+    """Base for the pyarrow sinks: rows are buffered into record batches of batch_size."""
+
+    def __init__(self, path: str, columns: Columns, batch_size: int = 65536):
+        super().__init__(path, columns)
+        self._pa = _import_pyarrow()
+        pa = self._pa
+        arrow_types = {'str': pa.string(), 'int': pa.int64(), 'date': pa.date32()}
+        # Amounts are exact decimals; 18 digits fit the int64 units and Parquet stores them as int64
+        self.schema = pa.schema([
+            (name, arrow_types[kind] if amount_scale(kind) is None else pa.decimal128(18, amount_scale(kind)))
+            for name, kind in self.columns])
+        self.batch_size = batch_size
+        self._pending: List[Sequence] = []
+
+    def write_rows(self, rows: Iterable[Sequence]):
+        for row in rows:
+            self._pending.append(row)
+            if len(self._pending) >= self.batch_size:
+                self._flush()
+
+    def write_batch(self, columns: Dict[str, Sequence]):
+        self._flush()
+        pa = self._pa
+        arrays = [self._array(columns[field.name], field.type) for field in self.schema]
+        self._write(pa.record_batch(arrays, schema=self.schema))
+
+    def close(self):
+        self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        pa = self._pa
+        arrays = [self._array(list(col), field.type)
+                  for col, field in zip(zip(*self._pending), self.schema)]
+        self._pending = []
+        self._write(pa.record_batch(arrays, schema=self.schema))
+
+    def _array(self, values, arrow_type):
+        pa = self._pa
+        if not pa.types.is_decimal(arrow_type):
+            return pa.array(values, type=arrow_type)
+        if hasattr(values, 'dtype') and values.dtype.kind == 'i':
+            # int64 units (a batch column): build the 128-bit decimal buffer directly
+            import numpy as np
+            units = values.astype(np.int64)
+            words = np.empty((len(units), 2), dtype=np.int64)
+            words[:, 0] = units
+            words[:, 1] = np.where(units < 0, -1, 0)
+            return pa.Array.from_buffers(arrow_type, len(units), [None, pa.py_buffer(words.tobytes())])
+        return pa.array([None if v is None else to_decimal(v, arrow_type.scale) for v in values],
+                        type=arrow_type)
+
+    def _write(self, batch):
+        self.rows += batch.num_rows
+        self._writer.write_batch(batch)
+
+class ParquetSink(_ArrowSink):
+    """Parquet writer; every flushed batch becomes a row group."""
+
+    def __init__(self, path: str, columns: Columns, batch_size: int = 65536):
+        super().__init__(path, columns, batch_size)
+        import pyarrow.parquet as pq
+        self._writer = pq.ParquetWriter(path, self.schema)
+
+    def close(self):
+        super().close()
+        self._writer.close()
+
+class ArrowIpcSink(_ArrowSink):
+    """Arrow IPC file (Feather v2) writer."""
+
+    def __init__(self, path: str, columns: Columns, batch_size: int = 65536):
+        super().__init__(path, columns, batch_size)
+        self._writer = self._pa.ipc.new_file(path, self.schema)
+
+    def close(self):
+        super().close()
+        self._writer.close()
+
+SINKS = {
+    'csv': CsvSink,
+    'jsonl': JsonLinesSink,
+    'parquet': ParquetSink,
+    'arrow': ArrowIpcSink,
+}
+
+_EXTENSIONS = {
+    '.csv': 'csv',
+    '.jsonl': 'jsonl',
+    '.ndjson': 'jsonl',
+    '.parquet': 'parquet',
+    '.arrow': 'arrow',
+    '.feather': 'arrow',
+    '.ipc': 'arrow',
+}
+
+def sink_format(path: str) -> Optional[str]:
+    """Return the sink format implied by the path's extension (.gz ignored), or None."""
+    base = path[:-3] if path.endswith('.gz') else path
+    for extension, format_name in _EXTENSIONS.items():
+        if base.endswith(extension):
+            return format_name
+    return None
+
+def open_sink(path: str, columns: Columns, format_name: Optional[str] = None) -> Sink:
+    """Open the sink for `format_name`, or for the format implied by the path."""
+    format_name = format_name or sink_format(path)
+    if format_name not in SINKS:
+        raise ValueError(f"Unsupported output format for {path}: use one of {', '.join(SINKS)}")
+    return SINKS[format_name](path, columns)
+
+def summary_path(output_file: str, name: str = 'totali') -> str:
+    """Derive a companion path from the detail path: out.csv.gz -> out-totali.csv.gz"""
+    suffix = '.gz' if output_file.endswith('.gz') else ''
+    base = output_file[:len(output_file) - len(suffix)]
+    stem, dot, extension = base.rpartition('.')
+    if not dot:
+        return f"{base}-{name}{suffix}"
+    return f"{stem}-{name}.{extension}{suffix}"
+
+def export_fatture(fatture: Iterable[Fattura], output_file: str, summary_file: Optional[str] = None,
+                   format_name: Optional[str] = None,
+                   fields: Sequence[FieldSpec] = ()) -> Tuple[int, List[TotaleFattureCedente]]:
+    """Stream fatture into a detail sink while aggregating, then write the per-cedente totals.
+
+    The extra `fields` are written as further detail columns.
+    Returns (number of invoices written, totals).
+    """
+    summary_file = summary_file or summary_path(output_file)
+    with open_sink(output_file, fattura_columns(fields), format_name) as sink:
+        def written():
+            for fattura in fatture:
+                sink.write_rows((fattura_row(fattura, fields),))
+                yield fattura
+        totali = aggregate_by_cedente(written())
+    count = sink.rows
+    with open_sink(summary_file, TOTALE_COLUMNS, format_name) as summary:
+        summary.write_rows(totale_row(totale) for totale in totali)
+    return count, totali
+
+def export_batch(batch, output_file: str, summary_file: Optional[str] = None,
+                 format_name: Optional[str] = None) -> Tuple[int, List[TotaleFattureCedente]]:
+    """Write a FatturaBatch column-wise to a detail sink, plus its per-cedente totals."""
+    summary_file = summary_file or summary_path(output_file)
+    with open_sink(output_file, FATTURA_COLUMNS, format_name) as sink:
+        sink.write_batch(batch.to_columns())
+    totali = batch.aggregate_by_cedente()
+    with open_sink(summary_file, TOTALE_COLUMNS, format_name) as summary:
+        summary.write_rows(totale_row(totale) for totale in totali)
+    return len(batch), totali
+
+def export_tables(tables: Iterable[tuple], output_file: str,
+                  format_name: Optional[str] = None) -> List[str]:
+    """Write (name, title, columns, rows) report tables next to output_file, one file per name.
+
+    out.csv gets out-<name>.csv; returns the paths written.
+    """
+    paths = []
+    for name, _, columns, rows in tables:
+        path = summary_path(output_file, name)
+        with open_sink(path, columns, format_name) as sink:
+            sink.write_rows(rows)
+        paths.append(path)
+    return paths
@@ -0,0 +1,188 @@
+import csv
+import datetime
+import functools
+import glob
+import os
+import xml.etree.ElementTree as ET
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from xml_invoice_backend import get_backend
+from xml_invoice_metrics import LOG_LEVELS, configure_logging, log
+from xml_invoice_zip import open_source
+
+DEFAULT_SCHEMA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'formato-fattura-pa')
+DEFAULT_REPORT_FILE = "fattura-pa-validation.csv"
+
+# Schema folders under DEFAULT_SCHEMA_DIR and the first invoice date each applies to, newest first
+SCHEMA_VERSIONS: List[Tuple[datetime.date, str]] = [
+    (datetime.date(2024, 2, 1), 'valid-from-24.02.01'),
+    (datetime.date.min, 'valid-until-24.01.31'),
+]
+
+_XMLDSIG_NS = 'http://www.w3.org/2000/09/xmldsig#'
+# The schemas import xmldsig from w3.org. Signatures are checked by xml_invoice_p7m, not
+# here, so a local stand-in accepting any ds:Signature keeps compilation offline
+_XMLDSIG_STUB = f"""<?xml version="1.0" encoding="utf-8"?>
+<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema" targetNamespace="{_XMLDSIG_NS}"
+           elementFormDefault="qualified">
+  <xs:element name="Signature">
+    <xs:complexType>
+      <xs:sequence>
+        <xs:any namespace="##any" processContents="skip" minOccurs="0" maxOccurs="unbounded"/>
+      </xs:sequence>
+      <xs:anyAttribute namespace="##any" processContents="skip"/>
+    </xs:complexType>
+  </xs:element>
+</xs:schema>
+"""
+
+_DATA_PATH = 'FatturaElettronicaBody/DatiGenerali/DatiGeneraliDocumento/Data'
+
+@dataclass
+class Violation:
+    line: int
+    column: int
+    path: str
+    message: str
+
+@dataclass
+class ValidationResult:
+    file_path: str
+    schema: Optional[str] = None
+    violations: List[Violation] = field(default_factory=list)
+    # Set when the file could not be read or is not well-formed XML
+    error: Optional[str] = None
+
+    @property
+    def valid(self) -> bool:
+        return self.error is None and not self.violations
+
+def _import_lxml():
+    try:
+        from lxml import etree
+    except ImportError:
+        raise ImportError("XSD validation needs lxml: pip install lxml") from None
+    return etree
+
+def schema_version(data: Optional[datetime.date]) -> str:
+    """The schema folder in force on an invoice date (the newest one when it is unknown)."""
+    for first_day, version in SCHEMA_VERSIONS:
+        if data is None or data >= first_day:
+            return version
+    return SCHEMA_VERSIONS[-1][1]
+
+@functools.lru_cache(maxsize=None)
+def compiled_schema(schema_dir: str, version: str):
+    """Compile the .xsd of a schema folder; compiled once per process and version."""
+    etree = _import_lxml()
+    paths = sorted(glob.glob(os.path.join(glob.escape(os.path.join(schema_dir, version)), '*.xsd')))
+    if not paths:
+        raise FileNotFoundError(f"No .xsd schema in {os.path.join(schema_dir, version)}")
+
+    class _Resolver(etree.Resolver):
+        def resolve(self, url, pubid, context):
+            if 'xmldsig' in url:
+                return self.resolve_string(_XMLDSIG_STUB, context)
+            return None
+
+    parser = etree.XMLParser(no_network=True)
+    parser.resolvers.add(_Resolver())
+    return etree.XMLSchema(etree.parse(paths[0], parser))
+
+def _invoice_date(root) -> Optional[datetime.date]:
+    data = root.find(_DATA_PATH)
+    try:
+        return datetime.date.fromisoformat(data.text.strip())
+    except (AttributeError, ValueError):
+        return None
+
+def validate_file(file_path: str, schema_dir: str = DEFAULT_SCHEMA_DIR) -> ValidationResult:
+    """Validate one invoice (plain, signed or in a ZIP) against the schema in force on its Data."""
+    result = ValidationResult(file_path)
+    try:
+        with open_source(file_path) as f:
+            root = get_backend('lxml').parse(f)
+    except (ET.ParseError, ValueError, OSError, zipfile.BadZipFile) as e:
+        result.error = str(e)
+        return result
+    result.schema = schema_version(_invoice_date(root))
+    schema = compiled_schema(os.path.abspath(schema_dir), result.schema)
+    if not schema.validate(root):
+        result.violations = [Violation(entry.line, entry.column, entry.path or '', entry.message)
+                             for entry in schema.error_log]
+    return result
+
+def validate_files(file_paths: List[str], workers: int = 1,
+                   schema_dir: str = DEFAULT_SCHEMA_DIR) -> Iterator[ValidationResult]:
+    """Validate the files serially or on a process pool, yielding results in input order.
+
+    Each worker compiles the schemas it needs once; workers=0 uses every CPU.
+    """
+    _import_lxml()
+    if workers == 0:
+        workers = os.cpu_count() or 1
+    worker = functools.partial(validate_file, schema_dir=schema_dir)
+    if workers == 1 or len(file_paths) < 2:
+        yield from map(worker, file_paths)
+        return
+    chunksize = max(1, min(256, len(file_paths) // (workers * 8)))
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        yield from executor.map(worker, file_paths, chunksize=chunksize)
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+REPORT_HEADER = ['file', 'schema', 'line', 'column', 'path', 'message']
+
+def write_report(results: Iterable[ValidationResult], report_file: str) -> Tuple[int, int]:
+    """Write one CSV row per violation (or unreadable file) and return (valid, invalid) counts."""
+    valid = invalid = 0
+    with open(report_file, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(REPORT_HEADER)
+        for result in results:
+            if result.valid:
+                valid += 1
+                continue
+            invalid += 1
+            if result.error is not None:
+                log.warning(f"Cannot validate {result.file_path}: {result.error}")
+                writer.writerow([result.file_path, '', '', '', '', result.error])
+                continue
+            log.warning(f"Invalid {result.file_path}: {len(result.violations)} schema violations")
+            for v in result.violations:
+                writer.writerow([result.file_path, result.schema, v.line, v.column, v.path, v.message])
+    return valid, invalid
+
+def main(folder_path: str, workers: int = 1, report_file: str = DEFAULT_REPORT_FILE,
+         schema_dir: str = DEFAULT_SCHEMA_DIR) -> int:
+    """Validate every invoice in the folder and write the violation report; return the exit code."""
+    from xml_invoice_processor import iter_xml_files
+    file_paths = list(iter_xml_files(folder_path))
+    valid, invalid = write_report(validate_files(file_paths, workers, schema_dir), report_file)
+    print(f"Validation: {valid} valid, {invalid} invalid")
+    if invalid:
+        print(f"Violations written to {report_file}")
+    return 1 if invalid else 0
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(
+        description="Validate FatturaPA invoices against the bundled XSD schemas (needs lxml).")
+    parser.add_argument("folder_path", help="folder of invoices, or a .zip archive of them")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of validator processes (0 = one per CPU, default 1)")
+    parser.add_argument("--report", default=DEFAULT_REPORT_FILE,
+                        help=f"per-file violation report, CSV (default {DEFAULT_REPORT_FILE})")
+    parser.add_argument("--schema-dir", default=DEFAULT_SCHEMA_DIR,
+                        help="folder holding the schema version folders (default: the bundled formato-fattura-pa)")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default='off',
+                        help="per-file log on stderr (default off)")
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+    sys.exit(main(args.folder_path, workers=args.workers, report_file=args.report,
+                  schema_dir=args.schema_dir))
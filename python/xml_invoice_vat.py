@@ -0,0 +1,83 @@
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from xml_invoice_processor import Fattura
+
+PERIODS = ['quarter', 'month']
+# TipoDocumento of the notes that reverse earlier invoices: their amounts are subtracted
+CREDIT_NOTE_TYPES = {'TD04', 'TD08'}
+
+# Sink column schema, see xml_invoice_sinks
+VAT_COLUMNS = [
+    ('periodo', 'str'),
+    ('aliquota_iva', 'amount'),
+    ('natura', 'str'),
+    ('esigibilita_iva', 'str'),
+    ('documenti', 'int'),
+    ('imponibile', 'amount'),
+    ('imposta', 'amount'),
+]
+
+# (periodo, aliquota, natura, esigibilita)
+VatKey = Tuple[str, int, Optional[str], str]
+
+def periodo(fattura: Fattura, period: str = 'quarter') -> str:
+    """Settlement period of the invoice date: "2024-Q1" by quarter, "2024-01" by month."""
+    if period == 'quarter':
+        return f"{fattura.data.year}-Q{(fattura.data.month - 1) // 3 + 1}"
+    return f"{fattura.data.year}-{fattura.data.month:02d}"
+
+class VatSummary:
+    """Single-pass hash aggregation of the DatiRiepilogo of fatture.
+
+    Every DatiRiepilogo adds to the running [documenti, imponibile, imposta] of its
+    (periodo, aliquota, natura, esigibilita) key, so the summary of any number of
+    periods is built in the same scan that extracts the invoices. Credit notes
+    (CREDIT_NOTE_TYPES) subtract their amounts as written in the XML.
+    """
+
+    def __init__(self, period: str = 'quarter'):
+        if period not in PERIODS:
+            raise ValueError(f"Unknown VAT period {period}: use one of {', '.join(PERIODS)}")
+        self.period = period
+        self.totals: Dict[VatKey, List[int]] = {}
+        self.fatture = 0
+
+    def add(self, fattura: Fattura):
+        self.fatture += 1
+        sign = -1 if fattura.tipo_documento in CREDIT_NOTE_TYPES else 1
+        key_periodo = periodo(fattura, self.period)
+        counted = set()
+        for riepilogo in fattura.riepilogo_iva:
+            key = (key_periodo, riepilogo.aliquota, riepilogo.natura, riepilogo.esigibilita)
+            totals = self.totals.get(key)
+            if totals is None:
+                totals = self.totals[key] = [0, 0, 0]
+            # An invoice counts once per key, however many of its summaries fall in it
+            if key not in counted:
+                counted.add(key)
+                totals[0] += 1
+            totals[1] += sign * riepilogo.imponibile
+            totals[2] += sign * riepilogo.imposta
+
+    def collect(self, fatture: Iterable[Fattura]) -> Iterator[Fattura]:
+        """Pass fatture through, adding their VAT summaries."""
+        for fattura in fatture:
+            self.add(fattura)
+            yield fattura
+
+    def rows(self) -> List[tuple]:
+        """VAT_COLUMNS rows sorted by periodo, aliquota, natura and esigibilita."""
+        return [key + tuple(totals) for key, totals in
+                sorted(self.totals.items(), key=lambda item: (item[0][0], item[0][1], item[0][2] or '', item[0][3]))]
+
+    def totals_by_periodo(self) -> Dict[str, Tuple[int, int]]:
+        """(imponibile, imposta) of each period."""
+        result = {}
+        for (key_periodo, _, _, _), (_, imponibile, imposta) in self.totals.items():
+            totals = result.get(key_periodo, (0, 0))
+            result[key_periodo] = (totals[0] + imponibile, totals[1] + imposta)
+        return dict(sorted(result.items()))
+
+    def table(self):
+        """The summary as a report table, see xml_invoice_cashflow.Table."""
+        return ('iva', "Liquidazione IVA", VAT_COLUMNS, self.rows())
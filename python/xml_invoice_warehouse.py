@@ -0,0 +1,296 @@
+import datetime
+import os
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Iterator, List, Optional
+
+from xml_invoice_metrics import LOG_LEVELS, configure_logging, log
+from xml_invoice_processor import (DEFAULT_OUTPUT_FILE, Fattura, TotaleFattureCedente, iter_xml_files,
+                                   parse_date, parse_files, write_excel)
+from xml_invoice_zip import ZIP_SEPARATOR, source_stat
+
+DEFAULT_WAREHOUSE_FILE = "fattura-pa-warehouse.sqlite"
+# Rows inserted per transaction while loading
+DEFAULT_BATCH_SIZE = 10000
+# files.seq is the id of the folder loaded, shifted by this many bits, plus the walk position
+ROOT_SEQ_BITS = 32
+
+@dataclass
+class LoadSummary:
+    added: int
+    changed: int
+    removed: int
+    errors: int
+    fatture: int
+
+class InvoiceWarehouse:
+    """Local SQLite database of the extracted invoices, answering range queries by index.
+
+    One row per invoice holds the Fattura base values (dates as ordinals, amounts
+    in cents) and the file it came from. Loading is incremental like
+    AggregateStore.refresh: only new files and files whose size or mtime changed
+    are parsed, and the rows of removed files are deleted. Queries never touch
+    the XML: the cedente, data and data_scadenza_pagamento indexes narrow them
+    to the rows asked for, returned in the file order of process_folder.
+    """
+
+    def __init__(self, db_path: str = DEFAULT_WAREHOUSE_FILE):
+        self.db_path = db_path
+        self._conn = sqlite3.connect(db_path, timeout=30)
+        # WAL lets queries run while a load is writing; NORMAL sync is safe with it
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                seq INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS roots (
+                id INTEGER PRIMARY KEY,
+                path TEXT NOT NULL UNIQUE
+            );
+            CREATE TABLE IF NOT EXISTS fatture (
+                id INTEGER PRIMARY KEY,
+                path TEXT NOT NULL,
+                cedente_id_fiscale TEXT,
+                cedente_denominazione TEXT,
+                cedente_regime_fiscale TEXT,
+                divisa TEXT,
+                data INTEGER NOT NULL,
+                numero TEXT,
+                data_scadenza_pagamento INTEGER NOT NULL,
+                importo_pagamento INTEGER NOT NULL,
+                tipo_documento TEXT,
+                cedente_id_paese TEXT
+            );
+            CREATE INDEX IF NOT EXISTS fatture_path ON fatture (path);
+            CREATE INDEX IF NOT EXISTS fatture_cedente ON fatture (cedente_id_fiscale, data);
+            CREATE INDEX IF NOT EXISTS fatture_data ON fatture (data);
+            CREATE INDEX IF NOT EXISTS fatture_scadenza ON fatture (data_scadenza_pagamento);
+        """)
+
+    def load(self, folder_path: str, workers: int = 1, batch_size: int = DEFAULT_BATCH_SIZE) -> LoadSummary:
+        """Ingest the new and changed files of the folder and drop the removed ones.
+
+        Rows are inserted with executemany and committed every batch_size rows.
+        Paths are stored absolute, so a folder is the same however it is named.
+        """
+        folder_path = os.path.abspath(folder_path)
+        self._conn.execute("INSERT OR IGNORE INTO roots (path) VALUES (?)", (folder_path,))
+        root_id = self._conn.execute("SELECT id FROM roots WHERE path = ?", (folder_path,)).fetchone()[0]
+        # Files sort by the order their folders were first loaded, then by walk position
+        base = root_id << ROOT_SEQ_BITS
+        on_disk = {}
+        for seq, file_path in enumerate(iter_xml_files(folder_path), base):
+            st = source_stat(file_path)
+            on_disk[file_path] = (st.st_size, st.st_mtime_ns, seq)
+
+        # Files of a folder, or members of an archive given in its place
+        prefix = folder_path + ZIP_SEPARATOR if os.path.isfile(folder_path) else os.path.join(folder_path, '')
+        known = {
+            path: (size, mtime_ns)
+            for path, size, mtime_ns in self._conn.execute(
+                "SELECT path, size, mtime_ns FROM files WHERE substr(path, 1, ?) = ?",
+                (len(prefix), prefix))
+        }
+        pending = [path for path, stat in on_disk.items() if known.get(path) != stat[:2]]
+        removed = [path for path in known if path not in on_disk]
+
+        for file_path in removed:
+            self._conn.execute("DELETE FROM fatture WHERE path = ?", (file_path,))
+            self._conn.execute("DELETE FROM files WHERE path = ?", (file_path,))
+        # Walk positions shift as files come and go
+        self._conn.executemany("UPDATE files SET seq = ? WHERE path = ?",
+                               ((stat[2], path) for path, stat in on_disk.items() if path in known))
+
+        errors = fatture = 0
+        batch = []
+        for file_path, values, error in parse_files(pending, workers):
+            if file_path in known:
+                self._conn.execute("DELETE FROM fatture WHERE path = ?", (file_path,))
+            if error is not None:
+                # Remember the file anyway, so it is retried only once it changes
+                log.warning(f"Error processing file {file_path}: {error}")
+                errors += 1
+            else:
+                # v[0:8]: the Fattura base values; v[9]: TipoDocumento; v[11]: IdPaese
+                batch.extend((file_path,) + tuple(v[:8]) + (v[9], v[11]) for v in values)
+            self._conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                               (file_path,) + on_disk[file_path])
+            if len(batch) >= batch_size:
+                fatture += self._insert(batch)
+                batch = []
+        fatture += self._insert(batch)
+        changed = sum(1 for path in pending if path in known)
+        return LoadSummary(added=len(pending) - changed, changed=changed, removed=len(removed),
+                           errors=errors, fatture=fatture)
+
+    def _insert(self, rows: List[tuple]) -> int:
+        self._conn.executemany("""
+            INSERT INTO fatture (path, cedente_id_fiscale, cedente_denominazione, cedente_regime_fiscale,
+                                 divisa, data, numero, data_scadenza_pagamento, importo_pagamento,
+                                 tipo_documento, cedente_id_paese)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+        self._conn.commit()
+        return len(rows)
+
+    @staticmethod
+    def _where(start_date: datetime.date, end_date: datetime.date, cedente: Optional[str],
+               due_from: Optional[datetime.date], due_to: Optional[datetime.date]):
+        clauses = ["f.data BETWEEN ? AND ?"]
+        params = [start_date.toordinal(), end_date.toordinal()]
+        if cedente is not None:
+            clauses.append("f.cedente_id_fiscale = ?")
+            params.append(cedente)
+        if due_from is not None or due_to is not None:
+            clauses.append("f.data_scadenza_pagamento BETWEEN ? AND ?")
+            params += [(due_from or datetime.date.min).toordinal(), (due_to or datetime.date.max).toordinal()]
+        return ' AND '.join(clauses), params
+
+    def query(self, start_date: datetime.date, end_date: datetime.date, cedente: Optional[str] = None,
+              due_from: Optional[datetime.date] = None,
+              due_to: Optional[datetime.date] = None) -> Iterator[Fattura]:
+        """Yield the invoices dated in the range, optionally of one cedente (IdCodice) and
+        due between due_from and due_to, in the order process_folder returns them.
+
+        Only the base values are stored: the payment schedule, VAT summary and extra
+        fields of the yielded Fattura objects are empty.
+        """
+        where, params = self._where(start_date, end_date, cedente, due_from, due_to)
+        rows = self._conn.execute(f"""
+            SELECT f.cedente_id_fiscale, f.cedente_denominazione, f.cedente_regime_fiscale, f.divisa,
+                   f.data, f.numero, f.data_scadenza_pagamento, f.importo_pagamento,
+                   f.tipo_documento, f.cedente_id_paese
+            FROM fatture f JOIN files USING (path)
+            WHERE {where}
+            ORDER BY files.seq, f.id
+        """, params)
+        for (id_fiscale, denominazione, regime_fiscale, divisa, data, numero, data_scadenza, importo,
+             tipo_documento, id_paese) in rows:
+            yield Fattura(
+                cedente_id_fiscale=id_fiscale,
+                cedente_denominazione=denominazione,
+                cedente_regime_fiscale=regime_fiscale,
+                divisa=divisa,
+                data=datetime.date.fromordinal(data),
+                numero=numero,
+                data_scadenza_pagamento=datetime.date.fromordinal(data_scadenza),
+                importo_pagamento=importo,
+                tipo_documento=tipo_documento,
+                cedente_id_paese=id_paese
+            )
+
+    def count(self, start_date: datetime.date, end_date: datetime.date, cedente: Optional[str] = None,
+              due_from: Optional[datetime.date] = None, due_to: Optional[datetime.date] = None) -> int:
+        """Number of invoices query would yield."""
+        where, params = self._where(start_date, end_date, cedente, due_from, due_to)
+        return self._conn.execute(f"SELECT COUNT(*) FROM fatture f WHERE {where}", params).fetchone()[0]
+
+    def totals(self, start_date: datetime.date, end_date: datetime.date, cedente: Optional[str] = None,
+               due_from: Optional[datetime.date] = None,
+               due_to: Optional[datetime.date] = None) -> List[TotaleFattureCedente]:
+        """Per-cedente totals of the same selection as query, summed in SQL, in the
+        first-seen order of aggregate_by_cedente (a file has a single cedente)."""
+        where, params = self._where(start_date, end_date, cedente, due_from, due_to)
+        rows = self._conn.execute(f"""
+            SELECT f.cedente_id_fiscale, f.cedente_denominazione, SUM(f.importo_pagamento)
+            FROM fatture f JOIN files USING (path)
+            WHERE {where}
+            GROUP BY f.cedente_id_fiscale, f.cedente_denominazione
+            ORDER BY MIN(files.seq)
+        """, params)
+        return [
+            TotaleFattureCedente(
+                cedente_id_fiscale=id_fiscale,
+                cedente_denominazione=denominazione,
+                totale_pagamenti=cents
+            )
+            for id_fiscale, denominazione, cents in rows
+        ]
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+def load(folder_path: str, db_file: str = DEFAULT_WAREHOUSE_FILE, workers: int = 1):
+    """Load the invoices of the folder into the warehouse."""
+    start = time.perf_counter()
+    with InvoiceWarehouse(db_file) as warehouse:
+        summary = warehouse.load(folder_path, workers=workers)
+    print(f"Loaded {summary.fatture} invoices into {db_file} in {time.perf_counter() - start:.1f}s: "
+          f"{summary.added} new, {summary.changed} changed, {summary.removed} removed files, "
+          f"{summary.errors} errors")
+
+def report(start_date_str: str, end_date_str: str, db_file: str = DEFAULT_WAREHOUSE_FILE,
+           output_file: str = DEFAULT_OUTPUT_FILE, summary_file: Optional[str] = None,
+           cedente: Optional[str] = None, due_from_str: Optional[str] = None,
+           due_to_str: Optional[str] = None, streaming_excel: bool = False):
+    """Write the summary and detail outputs of process_folder from the warehouse alone."""
+    start_date = parse_date(start_date_str)
+    end_date = parse_date(end_date_str)
+    due_from = parse_date(due_from_str) if due_from_str else None
+    due_to = parse_date(due_to_str) if due_to_str else None
+    if not os.path.exists(db_file):
+        raise FileNotFoundError(f"No warehouse at {db_file}: run the load command first")
+    start = time.perf_counter()
+    with InvoiceWarehouse(db_file) as warehouse:
+        fatture = warehouse.query(start_date, end_date, cedente, due_from, due_to)
+        if output_file.endswith('.xlsx'):
+            totali = warehouse.totals(start_date, end_date, cedente, due_from, due_to)
+            count = warehouse.count(start_date, end_date, cedente, due_from, due_to)
+            write_excel(totali, fatture if streaming_excel else list(fatture), output_file,
+                        streaming=streaming_excel)
+        else:
+            from xml_invoice_sinks import export_fatture
+            count, totali = export_fatture(fatture, output_file, summary_file)
+    print(f"Reported {count} invoices of {len(totali)} suppliers from {db_file} "
+          f"in {(time.perf_counter() - start) * 1000:.0f} ms")
+    print(f"Output written to {output_file}")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Load FatturaPA invoices into a local SQLite warehouse and report from it.")
+    parser.add_argument("--db", default=DEFAULT_WAREHOUSE_FILE,
+                        help=f"warehouse location (default {DEFAULT_WAREHOUSE_FILE})")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default='off',
+                        help="per-file log on stderr (default off)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    load_parser = commands.add_parser("load", help="ingest new and changed files of a folder")
+    load_parser.add_argument("folder_path", help="folder of invoices, or a .zip archive of them")
+    load_parser.add_argument("--workers", type=int, default=1,
+                             help="number of parser processes (0 = one per CPU, default 1)")
+    report_parser = commands.add_parser("report", aliases=["query"],
+                                        help="write the summary and details of a date range",
+                                        epilog="Dates should be in YYYY-MM-DD format")
+    report_parser.add_argument("start_date")
+    report_parser.add_argument("end_date")
+    report_parser.add_argument("-o", "--output", default=DEFAULT_OUTPUT_FILE,
+                               help="output file; .xlsx, .csv[.gz], .jsonl[.gz], .parquet or .arrow "
+                                    f"(default {DEFAULT_OUTPUT_FILE})")
+    report_parser.add_argument("--summary-output",
+                               help="per-cedente totals file for non-Excel outputs (default <output>-totali)")
+    report_parser.add_argument("--cedente", help="only the invoices of this IdFiscaleIVA/IdCodice")
+    report_parser.add_argument("--due-from", help="only the invoices due from this date, YYYY-MM-DD")
+    report_parser.add_argument("--due-to", help="only the invoices due up to this date, YYYY-MM-DD")
+    report_parser.add_argument("--streaming-excel", action="store_true",
+                               help="write the workbook with the constant-memory streaming writer")
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+
+    if args.command == "load":
+        load(args.folder_path, args.db, workers=args.workers)
+    else:
+        report(args.start_date, args.end_date, args.db, output_file=args.output,
+               summary_file=args.summary_output, cedente=args.cedente,
+               due_from_str=args.due_from, due_to_str=args.due_to, streaming_excel=args.streaming_excel)
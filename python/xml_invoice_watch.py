@@ -0,0 +1,460 @@
+import ctypes
+import ctypes.util
+import datetime
+import os
+import select
+import struct
+import sys
+import time
+import zipfile
+from typing import Dict, List, Optional, Set, Tuple
+
+from xml_invoice_cache import DEFAULT_CACHE_FILE, ParseCache
+from xml_invoice_metrics import LOG_LEVELS, configure_logging, log
+from xml_invoice_processor import (DEFAULT_OUTPUT_FILE, EXTRACTOR_VERSION, TotaleFattureCedente,
+                                   fattura_from_tuple, is_invoice_file, iter_xml_files, parse_date,
+                                   parse_files, write_excel)
+from xml_invoice_zip import ZIP_SEPARATOR, is_zip, iter_zip_members, outer_path
+
+# Backend events: ('changed', file path), ('removed', file path), ('removed_dir', dir path),
+# ('rescan', None) when the backend lost track and the watcher must resynchronize.
+Event = Tuple[str, Optional[str]]
+
+def _is_source(name: str) -> bool:
+    """Invoices and the ZIP archives that may hold them."""
+    return is_invoice_file(name) or is_zip(name)
+
+_IN_MODIFY = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_WATCH_MASK = (_IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO |
+               _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF)
+_EVENT_HEADER = struct.Struct('iIII')
+
+class InotifyBackend:
+    """Linux inotify watches on every directory of the tree, through ctypes."""
+
+    def __init__(self, folder_path: str):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._dirs: Dict[int, str] = {}
+        for root, _, _ in os.walk(folder_path):
+            self._watch(root)
+
+    def _watch(self, dir_path: str):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dir_path), _WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {dir_path}")
+        self._dirs[wd] = dir_path
+
+    def poll(self, timeout: float) -> List[Event]:
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self._fd, 256 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & _IN_Q_OVERFLOW:
+                events.append(('rescan', None))
+                continue
+            if mask & _IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            parent = self._dirs.get(wd)
+            if parent is None or not name:
+                continue
+            path = os.path.join(parent, name)
+            if mask & _IN_ISDIR:
+                if mask & (_IN_CREATE | _IN_MOVED_TO):
+                    # Files may have landed before the watch existed: report them too
+                    for root, _, _ in os.walk(path):
+                        self._watch(root)
+                    events.extend(('changed', p) for p in iter_xml_files(path))
+                elif mask & (_IN_DELETE | _IN_MOVED_FROM):
+                    events.append(('removed_dir', path))
+            elif _is_source(name):
+                if mask & (_IN_DELETE | _IN_MOVED_FROM):
+                    events.append(('removed', path))
+                else:
+                    events.append(('changed', path))
+        return events
+
+    def close(self):
+        os.close(self._fd)
+
+class PollingBackend:
+    """Portable fallback that polls the size and mtime of every file.
+
+    Each poll lists every directory again and compares the size and mtime of its
+    files with the previous poll, so files added, removed, renamed or rewritten in
+    place are all noticed, at the cost of a stat per file and interval.
+    """
+
+    def __init__(self, folder_path: str):
+        # Per directory: (size, mtime_ns) of its files, and its subdirectories
+        self._dirs: Dict[str, Tuple[Dict[str, Tuple[int, int]], Set[str]]] = {}
+        self._scan_dir(folder_path, [])
+
+    def _scan_dir(self, dir_path: str, events: List[Event]):
+        files = {}
+        subdirs = set()
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir():
+                            subdirs.add(entry.name)
+                        elif _is_source(entry.name) and entry.is_file():
+                            st = entry.stat()
+                            files[entry.name] = (st.st_size, st.st_mtime_ns)
+                    except FileNotFoundError:
+                        continue
+        except FileNotFoundError:
+            return
+        old = self._dirs.get(dir_path)
+        self._dirs[dir_path] = (files, subdirs)
+        old_files, old_subdirs = old if old else ({}, set())
+        if old is not None:
+            events.extend(('changed', os.path.join(dir_path, n))
+                          for n in sorted(files) if old_files.get(n) != files[n])
+            events.extend(('removed', os.path.join(dir_path, n)) for n in sorted(old_files.keys() - files.keys()))
+        for name in sorted(subdirs - old_subdirs):
+            sub = os.path.join(dir_path, name)
+            self._scan_dir(sub, events)
+            if old is not None:
+                events.extend(('changed', p) for p in iter_xml_files(sub))
+        for name in sorted(old_subdirs - subdirs):
+            self._forget_dir(os.path.join(dir_path, name))
+            events.append(('removed_dir', os.path.join(dir_path, name)))
+
+    def _forget_dir(self, dir_path: str):
+        prefix = os.path.join(dir_path, '')
+        for path in [d for d in self._dirs if d == dir_path or d.startswith(prefix)]:
+            del self._dirs[path]
+
+    def poll(self, timeout: float) -> List[Event]:
+        time.sleep(timeout)
+        events: List[Event] = []
+        for dir_path in list(self._dirs):
+            # Skip directories forgotten while scanning their parents
+            if dir_path in self._dirs:
+                self._scan_dir(dir_path, events)
+        return events
+
+    def close(self):
+        pass
+
+def open_backend(folder_path: str, polling: bool = False):
+    """Use inotify on Linux and fall back to polling elsewhere or when it is unavailable."""
+    if not polling and sys.platform.startswith('linux'):
+        try:
+            return InotifyBackend(folder_path)
+        except (OSError, AttributeError) as e:
+            print(f"inotify unavailable ({str(e)}), falling back to polling")
+    return PollingBackend(folder_path)
+
+class InvoiceWatcher:
+    """Keep per-file records, per-cedente totals and the output file in sync with a folder.
+
+    Only the files named by backend events are parsed after startup. A path is
+    ingested once it has seen no events and an unchanged size/mtime for `settle`
+    seconds, so invoices still being written are not read half-way. ZIP archives
+    settle as a whole and then have their members ingested in place.
+    Rewriting the outputs costs time in the number of invoices, so run() batches
+    the changes of a burst of arrivals into one export (see run).
+    """
+
+    # Exports may take at most this share of the time, however large the outputs grow
+    EXPORT_SHARE = 0.1
+
+    def __init__(self, folder_path: str, start_date: datetime.date, end_date: datetime.date,
+                 output_file: str = DEFAULT_OUTPUT_FILE, summary_file: Optional[str] = None,
+                 workers: int = 1, settle: float = 2.0, cache: Optional[ParseCache] = None):
+        self.folder_path = folder_path
+        self.start_date = start_date
+        self.end_date = end_date
+        self.output_file = output_file
+        self.summary_file = summary_file
+        self.workers = workers
+        self.settle = settle
+        self.cache = cache
+        # In-range fattura tuples of every ingested file, and running [cents, fatture] per cedente
+        self.records: Dict[str, List[tuple]] = {}
+        self.totals: Dict[Tuple[str, str], List[int]] = {}
+        self._pending: Dict[str, Tuple[float, Optional[Tuple[int, int]]]] = {}
+        self._dirty = False
+        # When the records first changed since the last export, and last changed
+        self._dirty_since = self._changed_at = 0.0
+        self.export_seconds = 0.0
+
+    def scan(self):
+        """Ingest the whole folder once, at startup or after the backend lost events."""
+        on_disk = list(iter_xml_files(self.folder_path))
+        for file_path in set(self.records) - set(on_disk):
+            self._drop(file_path)
+        self._ingest(on_disk)
+
+    def handle(self, events: List[Event]):
+        now = time.monotonic()
+        for kind, path in events:
+            if kind == 'changed':
+                # Members listed in a new subfolder wait for their archive to settle
+                self._pending[outer_path(path)] = (now, None)
+            elif kind == 'removed':
+                self._pending.pop(path, None)
+                if is_zip(path):
+                    self._drop_prefix(path + ZIP_SEPARATOR)
+                else:
+                    self._drop(path)
+            elif kind == 'removed_dir':
+                self._drop_prefix(os.path.join(path, ''))
+            elif kind == 'rescan':
+                print("Watch events were lost, rescanning the folder")
+                self.scan()
+
+    def settle_pending(self):
+        """Ingest the pending files that stopped changing."""
+        now = time.monotonic()
+        ready = []
+        for path, (since, last_stat) in list(self._pending.items()):
+            if now - since < self.settle:
+                continue
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                del self._pending[path]
+                self._drop(path)
+                continue
+            stat = (st.st_size, st.st_mtime_ns)
+            if stat != last_stat:
+                # Still growing (or first check): wait another settle period
+                self._pending[path] = (now, stat)
+                continue
+            del self._pending[path]
+            if is_zip(path):
+                ready.extend(self._archive_members(path))
+            else:
+                ready.append(path)
+        if ready:
+            self._ingest(sorted(ready))
+
+    def _archive_members(self, zip_path: str) -> List[str]:
+        """List a settled archive and drop the records of members it no longer holds."""
+        try:
+            members = list(iter_zip_members(zip_path, is_invoice_file))
+        except (zipfile.BadZipFile, OSError) as e:
+            log.warning(f"Skipping unreadable archive {zip_path}: {e}")
+            members = []
+        prefix = zip_path + ZIP_SEPARATOR
+        current = set(members)
+        for file_path in [p for p in self.records if p.startswith(prefix) and p not in current]:
+            self._drop(file_path)
+        return members
+
+    def _drop_prefix(self, prefix: str):
+        for file_path in [p for p in self.records if p.startswith(prefix)]:
+            self._drop(file_path)
+        for file_path in [p for p in self._pending if p.startswith(prefix)]:
+            del self._pending[file_path]
+
+    def _ingest(self, file_paths: List[str]):
+        pending = []
+        cache_keys = {}
+        for file_path in file_paths:
+            if self.cache is not None:
+                try:
+                    payload, cache_keys[file_path] = self.cache.lookup(file_path)
+                except FileNotFoundError:
+                    self._drop(file_path)
+                    continue
+                if payload is not None:
+                    values, error, _ = payload
+                    self._apply(file_path, values, error)
+                    continue
+            pending.append(file_path)
+        if self.cache is None:
+            for file_path, values, error in parse_files(pending, self.workers):
+                self._apply(file_path, values, error)
+            return
+        for file_path, values, error, digest, error_type in parse_files(pending, self.workers, digests=True):
+            self.cache.store(file_path, cache_keys[file_path], (values, error, error_type), digest)
+            self._apply(file_path, values, error)
+
+    def _apply(self, file_path: str, values: Optional[List[tuple]], error: Optional[str]):
+        self._drop(file_path)
+        if error is not None:
+            log.warning(f"Error processing file {file_path}: {error}")
+            return
+        start, end = self.start_date.toordinal(), self.end_date.toordinal()
+        in_range = [tuple(v) for v in values if start <= v[4] <= end]
+        if not in_range:
+            return
+        self.records[file_path] = in_range
+        for v in in_range:
+            total = self.totals.setdefault((v[0], v[1]), [0, 0])
+            total[0] += v[7]
+            total[1] += 1
+        self._changed()
+        log.info(f"Successfully processed: {file_path}")
+
+    def _drop(self, file_path: str):
+        old = self.records.pop(file_path, None)
+        if old is None:
+            return
+        for v in old:
+            key = (v[0], v[1])
+            total = self.totals[key]
+            total[0] -= v[7]
+            total[1] -= 1
+            if total[1] == 0:
+                del self.totals[key]
+        self._changed()
+
+    def _changed(self):
+        now = time.monotonic()
+        if not self._dirty:
+            self._dirty_since = now
+        self._changed_at = now
+        self._dirty = True
+
+    def export(self, force: bool = False):
+        """Rewrite the output file if anything changed, replacing it atomically.
+
+        Rows are streamed from the records to the writer, without a list of every Fattura.
+        """
+        if not (self._dirty or force):
+            return
+        started = time.monotonic()
+        totali = [
+            TotaleFattureCedente(cedente_id_fiscale=id_fiscale, cedente_denominazione=denominazione,
+                                 totale_pagamenti=cents)
+            for (id_fiscale, denominazione), (cents, _) in self.totals.items()
+        ]
+        fatture = (fattura_from_tuple(v) for path in sorted(self.records) for v in self.records[path])
+
+        directory, name = os.path.split(self.output_file)
+        tmp_file = os.path.join(directory, '.~' + name)
+        if self.output_file.endswith('.xlsx'):
+            write_excel(totali, fatture, tmp_file, streaming=True)
+            os.replace(tmp_file, self.output_file)
+        else:
+            from xml_invoice_sinks import export_fatture, summary_path
+            summary_file = self.summary_file or summary_path(self.output_file)
+            summary_dir, summary_name = os.path.split(summary_file)
+            tmp_summary = os.path.join(summary_dir, '.~' + summary_name)
+            export_fatture(fatture, tmp_file, tmp_summary)
+            os.replace(tmp_file, self.output_file)
+            os.replace(tmp_summary, summary_file)
+        self._dirty = False
+        self.export_seconds = time.monotonic() - started
+        count = sum(n for _, n in self.totals.values())
+        print(f"Updated {self.output_file}: {count} invoices, {len(totali)} suppliers")
+
+    def export_due(self, now: float, quiet: float, max_delay: float, last_export: float) -> bool:
+        """Tell whether pending changes should be exported now.
+
+        Changes are exported once no file changed for `quiet` seconds, or at the
+        latest `max_delay` seconds after the first of them while files keep coming;
+        either way no sooner after the last export than EXPORT_SHARE allows.
+        """
+        if not self._dirty:
+            return False
+        if now - last_export < self.export_seconds / self.EXPORT_SHARE:
+            return False
+        return now - self._changed_at >= quiet or now - self._dirty_since >= max_delay
+
+    def run(self, backend, poll_interval: float = 1.0, export_interval: float = 5.0,
+            max_delay: float = 60.0, max_iterations: Optional[int] = None):
+        """Process backend events until interrupted (or for max_iterations loops).
+
+        The outputs are rewritten once arrivals pause for export_interval seconds,
+        and at least every max_delay seconds under a steady stream (see export_due).
+        """
+        last_export = 0.0
+        iterations = 0
+        while max_iterations is None or iterations < max_iterations:
+            iterations += 1
+            self.handle(backend.poll(poll_interval))
+            self.settle_pending()
+            if self.export_due(time.monotonic(), export_interval, max_delay, last_export):
+                self.export()
+                if self.cache is not None:
+                    self.cache.commit()
+                last_export = time.monotonic()
+
+def main(folder_path: str, start_date_str: str = "0001-01-01", end_date_str: str = "9999-12-31",
+         workers: int = 1, output_file: str = DEFAULT_OUTPUT_FILE, summary_file: Optional[str] = None,
+         settle: float = 2.0, polling: bool = False, use_cache: bool = True,
+         cache_file: str = DEFAULT_CACHE_FILE):
+    """Watch a drop folder and keep the summary output up to date."""
+    start_date = parse_date(start_date_str)
+    end_date = parse_date(end_date_str)
+    if not output_file.endswith('.xlsx'):
+        from xml_invoice_sinks import sink_format
+        if sink_format(output_file) is None:
+            raise ValueError(f"Unsupported output format for {output_file}")
+    cache = ParseCache(cache_file, extractor_version=EXTRACTOR_VERSION) if use_cache else None
+    watcher = InvoiceWatcher(folder_path, start_date, end_date, output_file=output_file,
+                             summary_file=summary_file, workers=workers, settle=settle, cache=cache)
+
+    # Start watching before the initial scan so nothing landing meanwhile is missed
+    backend = open_backend(folder_path, polling=polling)
+    print(f"Watching {folder_path} with {type(backend).__name__}")
+    try:
+        watcher.scan()
+        watcher.export(force=True)
+        watcher.run(backend)
+    except KeyboardInterrupt:
+        print("\nStopping")
+        watcher.export()
+    finally:
+        backend.close()
+        if cache is not None:
+            cache.close()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Watch a folder and ingest FatturaPA invoices as they arrive.",
+        epilog="Dates should be in YYYY-MM-DD format")
+    parser.add_argument("folder_path")
+    parser.add_argument("start_date", nargs='?', default="0001-01-01")
+    parser.add_argument("end_date", nargs='?', default="9999-12-31")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of parser processes (0 = one per CPU, default 1)")
+    parser.add_argument("-o", "--output", default=DEFAULT_OUTPUT_FILE,
+                        help="output file; .xlsx, .csv[.gz], .jsonl[.gz], .parquet or .arrow")
+    parser.add_argument("--summary-output",
+                        help="per-cedente totals file for non-Excel outputs (default <output>-totali)")
+    parser.add_argument("--settle", type=float, default=2.0,
+                        help="seconds a file must stay unchanged before it is parsed (default 2)")
+    parser.add_argument("--poll", action="store_true",
+                        help="poll directory mtimes instead of using inotify")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="parse every file again, ignoring the parse cache")
+    parser.add_argument("--cache-file", default=DEFAULT_CACHE_FILE,
+                        help=f"parse cache location (default {DEFAULT_CACHE_FILE})")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default='off',
+                        help="per-file log on stderr (default off)")
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+
+    main(args.folder_path, args.start_date, args.end_date, workers=args.workers,
+         output_file=args.output, summary_file=args.summary_output, settle=args.settle,
+         polling=args.poll, use_cache=not args.no_cache, cache_file=args.cache_file)
@@ -0,0 +1,270 @@
+import datetime
+import decimal
+import shutil
+import tempfile
+import zipfile
+from typing import Iterable, List, Optional, Sequence, Tuple
+from xml.sax.saxutils import escape, quoteattr
+
+from xml_invoice_amounts import amount_scale, to_decimal
+
+# Excel's hard limit on rows per worksheet
+MAX_ROWS = 1048576
+
+_EXCEL_EPOCH = datetime.date(1899, 12, 30)
+
+# Style ids into the cellXfs table of _STYLES_XML, built once per workbook
+STYLE_DEFAULT = 0
+STYLE_HEADER = 1
+STYLE_EURO = 2
+STYLE_DATE = 3
+
+_STYLES_XML = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+<numFmts count="2"><numFmt numFmtId="164" formatCode="#,##0.00 &#8364;"/><numFmt numFmtId="165" formatCode="yyyy-mm-dd"/></numFmts>
+<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font><font><b/><sz val="11"/><name val="Calibri"/></font></fonts>
+<fills count="3"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill><fill><patternFill patternType="solid"><fgColor rgb="00CCCCCC"/><bgColor rgb="00CCCCCC"/></patternFill></fill></fills>
+<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>
+<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>
+<cellXfs count="4">
+<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>
+<xf numFmtId="0" fontId="1" fillId="2" borderId="0" xfId="0" applyFont="1" applyFill="1" applyAlignment="1"><alignment horizontal="center"/></xf>
+<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>
+<xf numFmtId="165" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>
+</cellXfs>
+<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>
+</styleSheet>
+"""
+
+def _column_letter(index: int) -> str:
+    """Return the Excel column letter for a 1-based column index."""
+    letters = ''
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+class StreamingSheet:
+    """Worksheet whose rows are written straight to a temporary file.
+
+    Column widths are tracked as rows are appended (the longest `str(value)` plus 2,
+    like write_excel), so nothing has to be kept in memory or re-read at the end.
+    """
+
+    def __init__(self, title: str, headers: Sequence[str], styles: Sequence[int]):
+        self.title = title
+        self.styles = list(styles)
+        self.rows = 0
+        self._letters = [_column_letter(i) for i in range(1, len(headers) + 1)]
+        self._widths = [0] * len(headers)
+        self._data = tempfile.TemporaryFile(mode='w+', encoding='utf-8')
+        self.append(headers, [STYLE_HEADER] * len(headers))
+
+    def append(self, values: Sequence, styles: Optional[Sequence[int]] = None):
+        """Write one row; `styles` defaults to the per-column styles of the sheet."""
+        self.rows += 1
+        styles = styles or self.styles
+        cells = []
+        for col, value in enumerate(values):
+            if value is None:
+                continue
+            ref = f'{self._letters[col]}{self.rows}'
+            text = str(value)
+            if len(text) > self._widths[col]:
+                self._widths[col] = len(text)
+            if isinstance(value, datetime.date):
+                serial = (value - _EXCEL_EPOCH).days
+                cells.append(f'<c r="{ref}" s="{STYLE_DATE}"><v>{serial}</v></c>')
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                cells.append(f'<c r="{ref}" s="{styles[col]}"><v>{value!r}</v></c>')
+            elif isinstance(value, decimal.Decimal):
+                cells.append(f'<c r="{ref}" s="{styles[col]}"><v>{value:f}</v></c>')
+            else:
+                cells.append(f'<c r="{ref}" s="{styles[col]}" t="inlineStr">'
+                             f'<is><t xml:space="preserve">{escape(text)}</t></is></c>')
+        self._data.write(f'<row r="{self.rows}">{"".join(cells)}</row>')
+
+    def write_to(self, archive: zipfile.ZipFile, name: str):
+        """Copy the finished sheet into the archive, with the <cols> computed so far."""
+        cols = ''.join(
+            f'<col min="{i}" max="{i}" width="{width + 2}" customWidth="1"/>'
+            for i, width in enumerate(self._widths, 1))
+        with archive.open(name, 'w', force_zip64=True) as out:
+            out.write(('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                       '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                       f'<cols>{cols}</cols><sheetData>').encode('utf-8'))
+            self._data.seek(0)
+            for chunk in iter(lambda: self._data.read(1024 * 1024), ''):
+                out.write(chunk.encode('utf-8'))
+            out.write(b'</sheetData></worksheet>')
+        self._data.close()
+
+class StreamingWorkbook:
+    """Minimal constant-memory xlsx writer for the report sheets.
+
+    Strings are written inline (no shared string table) and the styles are a fixed
+    table of header, euro amount and date formats.
+    """
+
+    def __init__(self, output_file: str):
+        self.output_file = output_file
+        self.sheets: List[StreamingSheet] = []
+
+    def add_sheet(self, title: str, headers: Sequence[str], styles: Sequence[int]) -> StreamingSheet:
+        sheet = StreamingSheet(title, headers, styles)
+        self.sheets.append(sheet)
+        return sheet
+
+    def close(self):
+        """Assemble the xlsx package; sheet data is copied from the temporary files."""
+        tmp_file = self.output_file + '.tmp'
+        with zipfile.ZipFile(tmp_file, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('[Content_Types].xml', self._content_types_xml())
+            archive.writestr('_rels/.rels', (
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/'
+                'relationships/officeDocument" Target="xl/workbook.xml"/></Relationships>'))
+            archive.writestr('xl/workbook.xml', self._workbook_xml())
+            archive.writestr('xl/_rels/workbook.xml.rels', self._workbook_rels_xml())
+            archive.writestr('xl/styles.xml', _STYLES_XML)
+            for i, sheet in enumerate(self.sheets, 1):
+                sheet.write_to(archive, f'xl/worksheets/sheet{i}.xml')
+        shutil.move(tmp_file, self.output_file)
+
+    def _content_types_xml(self) -> str:
+        sheets = ''.join(
+            f'<Override PartName="/xl/worksheets/sheet{i}.xml" ContentType="application/'
+            'vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            for i in range(1, len(self.sheets) + 1))
+        return (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" ContentType="application/'
+            'vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/styles.xml" ContentType="application/'
+            'vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+            f'{sheets}</Types>')
+
+    def _workbook_xml(self) -> str:
+        sheets = ''.join(
+            f'<sheet name={quoteattr(sheet.title)} sheetId="{i}" r:id="rId{i}"/>'
+            for i, sheet in enumerate(self.sheets, 1))
+        return (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            f'<sheets>{sheets}</sheets></workbook>')
+
+    def _workbook_rels_xml(self) -> str:
+        rels = ''.join(
+            f'<Relationship Id="rId{i}" Type="http://schemas.openxmlformats.org/officeDocument/2006/'
+            f'relationships/worksheet" Target="worksheets/sheet{i}.xml"/>'
+            for i in range(1, len(self.sheets) + 1))
+        styles_id = len(self.sheets) + 1
+        return (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            f'{rels}<Relationship Id="rId{styles_id}" Type="http://schemas.openxmlformats.org/'
+            'officeDocument/2006/relationships/styles" Target="styles.xml"/></Relationships>')
+
+SUMMARY_TITLE = "Riepilogo per Fornitore"
+DETAILS_TITLE = "Dettaglio Fatture"
+HEADERS_SUMMARY = ['Cedente.IdFiscaleIVA', 'Cedente.Anagrafica.Denominazione', 'Totale Pagamenti']
+HEADERS_DETAILS = [
+    'Cedente.IdFiscaleIVA',
+    'Cedente.Denominazione',
+    'Regime Fiscale',
+    'Divisa',
+    'Data Fattura',
+    'Numero Fattura',
+    'Data Scadenza',
+    'Importo'
+]
+
+def _extra_cell(spec, value):
+    if spec.type == 'amount' and value is not None:
+        return to_decimal(value, spec.scale)
+    return value
+
+def table_cell(kind: str, value):
+    """Excel value of a sink column value: amounts become Decimals."""
+    scale = amount_scale(kind)
+    if scale is not None and value is not None:
+        return to_decimal(value, scale)
+    return value
+
+class _SheetSeries:
+    """The sheets of one table: rows past `max_rows` (header included) spill into
+    further sheets named "<title> (2)", "(3)", ... each with its own header row."""
+
+    def __init__(self, title: str, headers: Sequence[str], styles: Sequence[int], max_rows: int):
+        self.title = title
+        self.headers = headers
+        self.styles = styles
+        self.max_rows = max_rows
+        self.sheets = [StreamingSheet(title, headers, styles)]
+
+    def append(self, values: Sequence):
+        if self.sheets[-1].rows >= self.max_rows:
+            self.sheets.append(StreamingSheet(f"{self.title} ({len(self.sheets) + 1})",
+                                              self.headers, self.styles))
+        self.sheets[-1].append(values)
+
+def _table_series(table, max_rows: int) -> Tuple[_SheetSeries, List[str]]:
+    """Empty sheets for a report table (name, title, columns, rows), and its column kinds."""
+    _, title, columns, _ = table
+    kinds = [kind for _, kind in columns]
+    styles = [STYLE_DEFAULT if amount_scale(kind) is None else STYLE_EURO for kind in kinds]
+    return _SheetSeries(title, [name for name, _ in columns], styles, max_rows), kinds
+
+def write_excel_streaming(totali, fatture: Iterable, output_file: str,
+                          max_rows: int = MAX_ROWS, fields: Sequence = (), tables=(),
+                          fattura_tables: Sequence = ()):
+    """Write the same sheets as write_excel in constant memory.
+
+    Details past `max_rows` (header included) spill into further sheets named
+    "Dettaglio Fatture (2)", "(3)", ... each with its own header row. The extra
+    `fields` (FieldSpecs) are appended as detail columns, and each of the report
+    `tables` (name, title, columns, rows) gets sheets of its own after the details.
+    Each of `fattura_tables` (name, title, columns, function of a Fattura yielding
+    its rows) is filled as the details are written, into sheets placed before the
+    `tables`. `totali` and `tables` are read only once `fatture` is exhausted, and
+    may be given as callables returning them, so they can be summed on the way.
+    """
+    wb = StreamingWorkbook(output_file)
+    summary = _SheetSeries(SUMMARY_TITLE, HEADERS_SUMMARY, [STYLE_DEFAULT, STYLE_DEFAULT, STYLE_EURO], max_rows)
+
+    headers = HEADERS_DETAILS + [spec.name for spec in fields]
+    detail_styles = [STYLE_DEFAULT] * 7 + [STYLE_EURO] + [
+        STYLE_EURO if spec.type == 'amount' else STYLE_DEFAULT for spec in fields]
+    details = _SheetSeries(DETAILS_TITLE, headers, detail_styles, max_rows)
+    streamed = [(_table_series(table, max_rows), table[3]) for table in fattura_tables]
+    for fattura in fatture:
+        details.append((
+            fattura.cedente_id_fiscale,
+            fattura.cedente_denominazione,
+            fattura.cedente_regime_fiscale,
+            fattura.divisa,
+            fattura.data,
+            fattura.numero,
+            fattura.data_scadenza_pagamento,
+            to_decimal(fattura.importo_pagamento)
+        ) + tuple(_extra_cell(spec, fattura.extra.get(spec.name)) for spec in fields))
+        for (series, kinds), rows_of in streamed:
+            for row in rows_of(fattura):
+                series.append(tuple(table_cell(kind, value) for kind, value in zip(kinds, row)))
+
+    for totale in (totali() if callable(totali) else totali):
+        summary.append((totale.cedente_id_fiscale, totale.cedente_denominazione,
+                        to_decimal(totale.totale_pagamenti)))
+    series_list = [summary, details] + [series for (series, _), _ in streamed]
+    for table in (tables() if callable(tables) else tables):
+        series, kinds = _table_series(table, max_rows)
+        for row in table[3]:
+            series.append(tuple(table_cell(kind, value) for kind, value in zip(kinds, row)))
+        series_list.append(series)
+    wb.sheets = [sheet for series in series_list for sheet in series.sheets]
+    wb.close()
@@ -0,0 +1,120 @@
+import contextlib
+import os
+import zipfile
+from collections import OrderedDict
+from typing import Callable, Iterator, NamedTuple
+
+from xml_invoice_p7m import PayloadReader, extract_payload, is_p7m, open_invoice
+
+# Archive members are addressed as "<archive>!/<member>", nested archives as
+# "outer.zip!/inner.zip!/member.xml"
+ZIP_SEPARATOR = '!/'
+
+# Open archives kept per process, so listing or reading many members parses each
+# central directory once
+_MAX_OPEN_ARCHIVES = 16
+_archives: 'OrderedDict[str, tuple]' = OrderedDict()
+
+def _forget_archives():
+    # A forked worker shares the parent's file offsets: it must open its own handles
+    for _, archive in _archives.values():
+        archive.close()
+    _archives.clear()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_archives)
+
+class SourceStat(NamedTuple):
+    """The two os.stat fields the caches and the index compare."""
+    st_size: int
+    st_mtime_ns: int
+
+def is_zip(name: str) -> bool:
+    return name.lower().endswith('.zip')
+
+def is_member(path: str) -> bool:
+    return ZIP_SEPARATOR in path
+
+def outer_path(path: str) -> str:
+    """The file on disk holding a path: the outermost archive of a member, else the path itself."""
+    return path.split(ZIP_SEPARATOR, 1)[0]
+
+def _archive(chain: str) -> zipfile.ZipFile:
+    """Return the open ZipFile for an archive path (which may itself be a member)."""
+    st = os.stat(outer_path(chain))
+    key = (st.st_size, st.st_mtime_ns)
+    cached = _archives.get(chain)
+    if cached is not None and cached[0] == key:
+        _archives.move_to_end(chain)
+        return cached[1]
+    if is_member(chain):
+        # Nested archives are read through their (seekable) member stream, not extracted
+        parent, name = chain.rsplit(ZIP_SEPARATOR, 1)
+        archive = zipfile.ZipFile(_archive(parent).open(name))
+    else:
+        archive = zipfile.ZipFile(chain)
+    _archives[chain] = (key, archive)
+    _archives.move_to_end(chain)
+    while len(_archives) > _MAX_OPEN_ARCHIVES:
+        _, (_, oldest) = _archives.popitem(last=False)
+        oldest.close()
+    return archive
+
+def iter_zip_members(zip_path: str, accept: Callable[[str], bool]) -> Iterator[str]:
+    """Yield the member paths accepted by `accept`, descending into nested archives."""
+    archive = _archive(zip_path)
+    for name in sorted(info.filename for info in archive.infolist() if not info.is_dir()):
+        base = name.rsplit('/', 1)[-1]
+        # Skip the resource forks macOS adds to archives it creates
+        if name.startswith('__MACOSX/') or base.startswith('._'):
+            continue
+        member = zip_path + ZIP_SEPARATOR + name
+        if is_zip(base):
+            yield from iter_zip_members(member, accept)
+        elif accept(base):
+            yield member
+
+def source_stat(path: str) -> SourceStat:
+    """Size and mtime of a file; members get their own size and the outer archive's mtime."""
+    if not is_member(path):
+        st = os.stat(path)
+        return SourceStat(st.st_size, st.st_mtime_ns)
+    chain, name = path.rsplit(ZIP_SEPARATOR, 1)
+    try:
+        info = _archive(chain).getinfo(name)
+    except KeyError:
+        raise FileNotFoundError(f"No member {name} in {chain}") from None
+    return SourceStat(info.file_size, os.stat(outer_path(path)).st_mtime_ns)
+
+@contextlib.contextmanager
+def open_raw(path: str):
+    """Open the raw bytes of a file or archive member (for hashing)."""
+    if not is_member(path):
+        with open(path, 'rb') as f:
+            yield f
+        return
+    chain, name = path.rsplit(ZIP_SEPARATOR, 1)
+    with _archive(chain).open(name) as member:
+        yield member
+
+@contextlib.contextmanager
+def open_source(path: str):
+    """Open an invoice for parsing, whether a file or an archive member.
+
+    Members are decompressed as the parser reads them; signed members are read
+    whole (an archive stream cannot be memory-mapped) and their payload passed on.
+    """
+    if not is_member(path):
+        with open_invoice(path) as f:
+            yield f
+        return
+    chain, name = path.rsplit(ZIP_SEPARATOR, 1)
+    with _archive(chain).open(name) as member:
+        if not is_p7m(name):
+            yield member
+            return
+        reader = PayloadReader(extract_payload(memoryview(member.read())))
+        try:
+            yield reader
+        finally:
+            reader.release()